@@ -1,4 +1,6 @@
 
+from tornado.ioloop import IOLoop
+
 import anthill.common.admin as a
 from anthill.common.internal import Internal, InternalError
 from anthill.common.validate import validate
@@ -19,7 +21,12 @@ class IndexController(a.AdminController):
             a.links("Message service", [
                 a.link("users", "Edit user conversations", icon="user"),
                 a.link("groups", "Edit groups", icon="users"),
-                a.link("history", "Message history", icon="history")
+                a.link("history", "Message history", icon="history"),
+                a.link("dead_letters", "Dead letters", icon="exclamation-triangle"),
+                a.link("account_inbox", "Account inbox", icon="inbox"),
+                a.link("schema", "Database schema", icon="database"),
+                a.link("purge_jobs", "Purge jobs", icon="trash"),
+                a.link("archive", "Messages archive", icon="archive")
             ])
         ]
 
@@ -693,7 +700,8 @@ class MessagesHistoryController(a.AdminController):
                 "delivered": "yes" if message.delivered else "no",
                 "message_type": message.message_type,
                 "payload": [a.json_view(message.payload)],
-                "id": [
+                # archived messages cannot be edited
+                "id": message.message_id if data["archived"] == "yes" else [
                     a.link("message", message.message_id, icon="envelope-o", message_id=message.message_id)
                 ]
             }
@@ -737,7 +745,9 @@ class MessagesHistoryController(a.AdminController):
                 "message_type":
                     a.field("Message Type", "text", "primary", order=4),
                 "message_delivered":
-                    a.field("Message Delivered", "select", "primary", values=data["message_delivered_values"], order=5)
+                    a.field("Message Delivered", "select", "primary", values=data["message_delivered_values"], order=5),
+                "archived":
+                    a.field("Search the archive", "select", "primary", values=data["archived_values"], order=6)
             }, methods={
                 "filter": a.method("Filter", "primary")
             }, data=data, icon="filter"),
@@ -764,14 +774,15 @@ class MessagesHistoryController(a.AdminController):
         raise a.Redirect("history", **filters)
 
     @validate(page="int", message_sender="int", message_recipient_class="str",
-              message_recipient="str", message_type="str", message_delivered="int")
+              message_recipient="str", message_type="str", message_delivered="int", archived="str")
     async def get(self,
                   page=1,
                   message_sender=None,
                   message_recipient_class=None,
                   message_recipient=None,
                   message_type=None,
-                  message_delivered=None):
+                  message_delivered=None,
+                  archived="no"):
 
         page = to_int(page)
 
@@ -779,7 +790,10 @@ class MessagesHistoryController(a.AdminController):
 
             history = self.application.history
 
-            q = history.messages_query(self.gamespace)
+            if archived == "yes":
+                q = self.application.archive.messages_query(self.gamespace)
+            else:
+                q = history.messages_query(self.gamespace)
 
             q.offset = (page - 1) * MessagesHistoryController.MESSAGES_PER_PAGE
             q.limit = MessagesHistoryController.MESSAGES_PER_PAGE
@@ -791,7 +805,12 @@ class MessagesHistoryController(a.AdminController):
             if message_delivered:
                 q.message_delivered = message_delivered == "yes"
 
-            messages, count = await q.query(count=True)
+            if history.admin_approximate_count:
+                messages = await q.query()
+                count = await q.estimate()
+            else:
+                messages, count = await q.query(count=True)
+
             pages = int(math.ceil(float(count) / float(MessagesHistoryController.MESSAGES_PER_PAGE)))
         else:
             messages, pages = [], 0
@@ -808,6 +827,11 @@ class MessagesHistoryController(a.AdminController):
                 "": "Choose",
                 "yes": "Yes",
                 "no": "No"
+            },
+            "archived": archived,
+            "archived_values": {
+                "no": "No",
+                "yes": "Yes"
             }
         }
 
@@ -880,7 +904,8 @@ class UserMessagesController(a.AdminController):
 
         messages, count = await history.list_messages_account_with_count(
             gamespace=self.gamespace, account_id=account_id,
-            limit=UserMessagesController.MESSAGES_PER_PAGE, offset=offset)
+            limit=UserMessagesController.MESSAGES_PER_PAGE, offset=offset,
+            approximate=history.admin_approximate_count)
 
         pages = int(math.ceil(float(count) / float(UserMessagesController.MESSAGES_PER_PAGE)))
 
@@ -888,3 +913,454 @@ class UserMessagesController(a.AdminController):
             "messages": messages,
             "pages": pages
         }
+
+
+class DeadLettersController(a.AdminController):
+    LETTERS_LIMIT = 100
+
+    def render(self, data):
+        letters = [
+            {
+                "uuid": letter.message_uuid or "-",
+                "sender": letter.sender,
+                "recipient": str(letter.recipient_class) + " " + str(letter.recipient),
+                "message_type": letter.message_type,
+                "attempts": letter.attempts,
+                "error": letter.error,
+                "payload": [a.json_view(letter.payload)] if letter.payload is not None else letter.body
+            }
+            for letter in data["letters"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Dead letters"),
+            a.content("Messages failed to be processed", [
+                {
+                    "id": "uuid",
+                    "title": "UUID"
+                }, {
+                    "id": "sender",
+                    "title": "From"
+                }, {
+                    "id": "recipient",
+                    "title": "Recipient"
+                }, {
+                    "id": "message_type",
+                    "title": "Type"
+                }, {
+                    "id": "attempts",
+                    "title": "Attempts"
+                }, {
+                    "id": "error",
+                    "title": "Error"
+                }, {
+                    "id": "payload",
+                    "title": "Payload",
+                    "width": "40%"
+                }], letters, "default", empty="No dead letters."),
+            a.form("Replay or discard a message", fields={
+                "message_uuid": a.field("Message UUID (replay all if empty)", "text", "primary", order=1)
+            }, methods={
+                "replay": a.method("Replay", "primary", order=1),
+                "discard": a.method("Discard", "danger", order=2)
+            }, data=data),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        message_queue = self.application.message_queue
+
+        letters = await message_queue.list_dead_letters(limit=DeadLettersController.LETTERS_LIMIT)
+
+        return {
+            "letters": letters
+        }
+
+    @validate(message_uuid="str")
+    async def replay(self, message_uuid=None):
+        message_queue = self.application.message_queue
+
+        replayed = await message_queue.replay_dead_letters(
+            message_uuid=message_uuid, limit=DeadLettersController.LETTERS_LIMIT)
+
+        raise a.Redirect(
+            "dead_letters",
+            message="{0} message(s) have been replayed".format(replayed))
+
+    @validate(message_uuid="str")
+    async def discard(self, message_uuid=None):
+        if not message_uuid:
+            raise a.ActionError("Message UUID is required")
+
+        message_queue = self.application.message_queue
+
+        discarded = await message_queue.discard_dead_letters(
+            message_uuid, limit=DeadLettersController.LETTERS_LIMIT)
+
+        raise a.Redirect(
+            "dead_letters",
+            message="{0} message(s) have been discarded".format(discarded))
+
+
+class AccountInboxController(a.AdminController):
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Account inbox"),
+            a.form("Account inbox backfill", fields={
+                "maintained": a.field("The inbox is maintained", "readonly", "primary", order=1),
+                "enabled": a.field("Messages are read from the inbox", "readonly", "primary", order=2),
+                "status": a.field("Backfill status", "readonly", "primary", order=3),
+                "progress": a.field("Messages processed", "readonly", "primary", order=4)
+            }, methods={
+                "backfill": a.method("Start backfill", "primary")
+            }, data=data),
+            a.form("Conversation keys backfill", fields={
+                "conversations_maintained": a.field("The conversation keys are maintained", "readonly", "primary",
+                                                    order=1),
+                "conversations": a.field("Direct messages are read by conversation key", "readonly", "primary",
+                                         order=2),
+                "conversation_status": a.field("Backfill status", "readonly", "primary", order=3),
+                "conversation_progress": a.field("Messages processed", "readonly", "primary", order=4)
+            }, methods={
+                "backfill_conversations": a.method("Start backfill", "primary")
+            }, data=data),
+            a.form("Message counters", fields={
+                "counters": a.field("Totals are served from the counters", "readonly", "primary", order=1)
+            }, methods={
+                "recount": a.method("Recount", "danger")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("account_inbox", "Refresh", icon="refresh"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    @staticmethod
+    def dump_backfill(progress):
+        """
+        :returns: a pair of the status and the progress of a backfill
+        """
+
+        if progress is None:
+            return "Not started on this node", "-"
+
+        if progress["running"]:
+            status = "Running"
+        elif progress["error"]:
+            status = "Failed: " + progress["error"]
+        else:
+            status = "Complete"
+
+        return status, "{0} of {1}".format(
+            max(progress["position"] - progress["first"] + 1, 0),
+            max(progress["last"] - progress["first"] + 1, 0))
+
+    async def get(self):
+        history = self.application.history
+
+        status, processed = AccountInboxController.dump_backfill(history.inbox_backfill)
+        conversation_status, conversation_processed = AccountInboxController.dump_backfill(
+            history.conversation_backfill)
+
+        return {
+            "maintained": "Yes" if history.inbox_maintained else "No",
+            "enabled": "Yes" if history.account_inbox else "No",
+            "counters": "Yes" if history.counters else "No",
+            "conversations_maintained": "Yes" if history.conversation_keys_maintained else "No",
+            "conversations": "Yes" if history.conversation_keys else "No",
+            "status": status,
+            "progress": processed,
+            "conversation_status": conversation_status,
+            "conversation_progress": conversation_processed
+        }
+
+    async def backfill(self, **ignored):
+        history = self.application.history
+        progress = history.inbox_backfill
+
+        if progress and progress["running"]:
+            raise a.ActionError("The backfill is running already")
+
+        # the messages stored in the meantime would be missing otherwise
+        if not history.inbox_maintained:
+            raise a.ActionError("Enable 'message_account_inbox_maintain' first")
+
+        IOLoop.current().spawn_callback(history.backfill_account_inbox)
+
+        raise a.Redirect("account_inbox", message="The backfill has been started")
+
+    async def backfill_conversations(self, **ignored):
+        history = self.application.history
+        progress = history.conversation_backfill
+
+        if progress and progress["running"]:
+            raise a.ActionError("The backfill is running already")
+
+        # the messages stored in the meantime would be missing the keys otherwise
+        if not history.conversation_keys_maintained:
+            raise a.ActionError("Enable 'message_conversation_keys_maintain' first")
+
+        IOLoop.current().spawn_callback(history.backfill_conversation_keys)
+
+        raise a.Redirect("account_inbox", message="The backfill has been started")
+
+    async def recount(self, **ignored):
+        history = self.application.history
+
+        try:
+            await history.recount()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect("account_inbox", message="The counters have been recounted")
+
+
+class SchemaController(a.AdminController):
+    def render(self, data):
+        migrations = [
+            {
+                "version": migration.version,
+                "name": migration.name,
+                "applied": str(migration.applied) if migration.applied else "Pending"
+            }
+            for migration in data["migrations"]
+        ]
+
+        plans = [
+            {
+                "query": plan.query_name,
+                "table": plan.table,
+                "type": plan.type,
+                "key": plan.key or "-",
+                "rows": plan.rows,
+                "extra": plan.extra,
+                "problem": ", ".join(
+                    problem for problem, found in [
+                        ("Full scan", plan.full_scan),
+                        ("Filesort", plan.filesort)
+                    ] if found) or "-"
+            }
+            for plan in data["plans"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Database schema"),
+            a.content("Migrations", [
+                {
+                    "id": "version",
+                    "title": "Version"
+                }, {
+                    "id": "name",
+                    "title": "Name"
+                }, {
+                    "id": "applied",
+                    "title": "Applied"
+                }], migrations, "default", empty="No migrations."),
+            a.form("Apply pending migrations", fields={}, methods={
+                "migrate": a.method("Migrate", "primary")
+            }, data=data),
+            a.content("Hot query plans (EXPLAIN)", [
+                {
+                    "id": "query",
+                    "title": "Query"
+                }, {
+                    "id": "table",
+                    "title": "Table"
+                }, {
+                    "id": "type",
+                    "title": "Access"
+                }, {
+                    "id": "key",
+                    "title": "Index"
+                }, {
+                    "id": "rows",
+                    "title": "Rows"
+                }, {
+                    "id": "extra",
+                    "title": "Extra"
+                }, {
+                    "id": "problem",
+                    "title": "Problem"
+                }], plans, "default", empty="No queries."),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        schema = self.application.schema
+
+        try:
+            migrations = await schema.list_migrations()
+            plans = await schema.explain()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "migrations": migrations,
+            "plans": plans
+        }
+
+    async def migrate(self, **ignored):
+        schema = self.application.schema
+
+        try:
+            applied = await schema.migrate()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect(
+            "schema",
+            message="{0} migration(s) have been applied".format(len(applied)))
+
+
+class PurgeJobsController(a.AdminController):
+    def render(self, data):
+        jobs = [
+            {
+                "id": job.job_id,
+                "gamespace": job.gamespace_id if job.gamespace_id is not None else "All",
+                "kind": job.kind,
+                "status": job.status,
+                "step": "{0} of {1}".format(min(job.step + 1, job.steps), job.steps),
+                "deleted": job.deleted,
+                "created": str(job.created),
+                "updated": str(job.updated),
+                "error": job.error or "-"
+            }
+            for job in data["jobs"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Purge jobs"),
+            a.content("Purge jobs", [
+                {
+                    "id": "id",
+                    "title": "ID"
+                }, {
+                    "id": "gamespace",
+                    "title": "Gamespace"
+                }, {
+                    "id": "kind",
+                    "title": "Kind"
+                }, {
+                    "id": "status",
+                    "title": "Status"
+                }, {
+                    "id": "step",
+                    "title": "Step"
+                }, {
+                    "id": "deleted",
+                    "title": "Rows deleted"
+                }, {
+                    "id": "created",
+                    "title": "Created"
+                }, {
+                    "id": "updated",
+                    "title": "Updated"
+                }, {
+                    "id": "error",
+                    "title": "Last error"
+                }], jobs, "default", empty="No purge jobs."),
+            a.links("Navigate", [
+                a.link("purge_jobs", "Refresh", icon="refresh"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        purge = self.application.purge
+
+        try:
+            jobs = await purge.list_jobs()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        for job in jobs:
+            job.steps = len(purge.steps(job))
+
+        return {
+            "jobs": jobs
+        }
+
+
+class ArchiveController(a.AdminController):
+    def render(self, data):
+        partitions = [
+            {
+                "name": partition.name,
+                "bound": partition.bound.strftime("%Y-%m-%d") if partition.bound else "-",
+                "rows": partition.rows
+            }
+            for partition in data["partitions"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Messages archive"),
+            a.form("Retention", fields={
+                "retention": a.field("Messages are archived after", "readonly", "primary", order=1),
+                "archive_retention": a.field("Archive is kept for", "readonly", "primary", order=2)
+            }, methods={
+                "archive": a.method("Archive now", "primary")
+            }, data=data),
+            a.content("Archive partitions", [
+                {
+                    "id": "name",
+                    "title": "Partition"
+                }, {
+                    "id": "bound",
+                    "title": "Messages before"
+                }, {
+                    "id": "rows",
+                    "title": "Rows (estimate)"
+                }], partitions, "default", empty="No partitions."),
+            a.links("Navigate", [
+                a.link("history", "Search the archive", icon="history", archived="yes"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        archive = self.application.archive
+
+        try:
+            partitions = await archive.list_partitions()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "retention": "{0} days".format(archive.retention_days) if archive.enabled else "Never",
+            "archive_retention": "{0} months".format(archive.archive_retention_months)
+            if archive.archive_retention_months > 0 else "Forever",
+            "partitions": partitions
+        }
+
+    async def archive(self, **ignored):
+        archive = self.application.archive
+
+        if not archive.enabled:
+            raise a.ActionError("The retention is not enabled, see 'message_retention_days'")
+
+        try:
+            archived = await archive.maintain()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect("archive", message="{0} message(s) have been archived".format(archived))
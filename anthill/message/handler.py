@@ -8,14 +8,57 @@ from anthill.common.internal import InternalError
 from anthill.common.validate import validate, validate_value, ValidationError
 
 from .model.group import GroupParticipantNotFound, GroupNotFound, GroupError, UserAlreadyJoined, GroupAdapter
-from .model.history import MessageQueryError, MessageError, MessageNotFound
+from .model.history import MessageQueryError, MessageError, MessageNotFound, MessagesCursor, dump_messages_json
+from .model.markers import ReadMarkersBuffer
+from .model.sync import SyncCursor
 from .model import MessageSendError, MessageFlags, CLASS_USER
 
 import logging
 import ujson
 
 
-class ReadGroupInboxHandler(AuthenticatedHandler):
+class MessagesPageMixin(object):
+    def get_cursors(self):
+        """
+        :returns: a pair of 'before' and 'after' MessagesCursor arguments, None if not passed
+        """
+
+        try:
+            return MessagesCursor.parse(self.get_argument("before", None)), \
+                   MessagesCursor.parse(self.get_argument("after", None))
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+    @staticmethod
+    def dump_cursors(messages):
+        """
+        :param messages: a page of messages, newest first
+        :returns: cursors to request the older ('before') and the newer ('after') page from
+        """
+
+        if not messages:
+            return None
+
+        return {
+            "before": MessagesCursor.of(messages[-1]),
+            "after": MessagesCursor.of(messages[0])
+        }
+
+    def dumps_page(self, data, messages, gamespace_id):
+        """
+        Writes the response along with a page of messages (newest first, written oldest first), the payloads
+            of the messages are written as stored, see MessageAdapter.dump_json
+        """
+
+        data["cursors"] = self.dump_cursors(messages)
+
+        # same as 'dumps'
+        self.set_header("Content-Type", "application/json")
+        self.write(ujson.dumps(data, escape_forward_slashes=False)[:-1] + ',"messages":' +
+                   dump_messages_json(reversed(messages), gamespace_id) + "}")
+
+
+class ReadGroupInboxHandler(MessagesPageMixin, AuthenticatedHandler):
     @scoped()
     async def get(self, group_class, group_key):
         groups = self.application.groups
@@ -38,7 +81,7 @@ class ReadGroupInboxHandler(AuthenticatedHandler):
         message_recipient = group.calculate_recipient()
         message_type = self.get_argument("type", None)
 
-        q = history.messages_query(gamespace_id)
+        q = history.messages_query(gamespace_id, account_id)
 
         q.message_recipient_class = message_recipient_class
         q.message_recipient = message_recipient
@@ -47,32 +90,35 @@ class ReadGroupInboxHandler(AuthenticatedHandler):
             q.message_type = message_type
 
         q.limit = limit
+        q.before, q.after = self.get_cursors()
+
+        recent_messages = self.application.recent_messages
 
         try:
-            messages, count = await q.query(count=True)
+            if q.before or q.after:
+                # the total count is not calculated when paging by cursor
+                messages, count = await q.query(), None
+            elif not message_type and recent_messages.cacheable(message_recipient_class, limit):
+                messages, count = await recent_messages.get(
+                    gamespace_id, message_recipient_class, message_recipient, limit)
+            elif history.counters and not message_type:
+                messages = await q.query()
+                count = await history.count_recipient_messages(
+                    gamespace_id, message_recipient_class, message_recipient)
+            else:
+                messages, count = await q.query(count=True)
         except MessageQueryError as e:
             raise HTTPError(500, e.message)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
 
-        self.dumps({
+        self.dumps_page({
             "reply_to": {
                 "recipient_class": message_recipient_class,
                 "recipient": message_recipient,
             },
-            "total_count": count,
-            "messages": [
-                {
-                    "uuid": message.message_uuid,
-                    "recipient_class": message.recipient_class,
-                    "sender": message.sender,
-                    "recipient": message.recipient,
-                    "gamespace": int(gamespace_id),
-                    "time": str(message.time),
-                    "type": message.message_type,
-                    "payload": message.payload
-                }
-                for message in reversed(messages)
-            ]
-        })
+            "total_count": count
+        }, messages, gamespace_id)
 
 
 class MessageHandler(AuthenticatedHandler):
@@ -124,85 +170,114 @@ class MessageHandler(AuthenticatedHandler):
             raise HTTPError(e.code, e.message)
 
 
-class ReadMessagesHandler(AuthenticatedHandler):
+class ReadMessagesHandler(MessagesPageMixin, AuthenticatedHandler):
     @scoped()
     async def get(self):
         history = self.application.history
 
         limit = to_int(self.get_argument("limit", 100))
         offset = to_int(self.get_argument("offset", 0))
+        before, after = self.get_cursors()
 
         account_id = self.token.account
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
 
-        async with history.db.acquire() as db:
+        async with history.read_db(gamespace_id, account_id).acquire() as db:
             try:
-                messages, count = await history.list_messages_account_with_count_db(
-                    gamespace_id, account_id, db=db, limit=limit, offset=offset)
+                if before or after:
+                    # the total count is not calculated when paging by cursor
+                    messages, count = await history.list_messages_account(
+                        gamespace_id, account_id, limit=limit, db=db, before=before, after=after), None
+                else:
+                    messages, count = await history.list_messages_account_with_count_db(
+                        gamespace_id, account_id, db=db, limit=limit, offset=offset)
             except MessageError as e:
                 raise HTTPError(e.code, "Account is not joined in that group")
 
             read_messages = await history.list_read_messages(gamespace_id, account_id)
 
-            self.dumps({
+            self.dumps_page({
                 "last_read_messages": [
                     read_message.dump()
                     for read_message in read_messages
                 ],
-                "total_count": count,
-                "messages": [
-                    {
-                        "uuid": message.message_uuid,
-                        "recipient_class": message.recipient_class,
-                        "sender": message.sender,
-                        "recipient": message.recipient,
-                        "gamespace": int(gamespace_id),
-                        "time": str(message.time),
-                        "type": message.message_type,
-                        "payload": message.payload
-                    }
-                    for message in reversed(messages)
-                ]
-            })
+                "total_count": count
+            }, messages, gamespace_id)
+
+
+class ConversationsHandler(MessagesPageMixin, AuthenticatedHandler):
+    @scoped()
+    async def get(self):
+        history = self.application.history
+
+        limit = to_int(self.get_argument("limit", 100))
+        before, after = self.get_cursors()
+
+        account_id = self.token.account
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            conversations = await history.list_conversations(
+                gamespace_id, account_id, limit=limit, before=before, after=after)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+        # paged by the last activity, the same way as the messages are
+        self.set_header("Content-Type", "application/json")
+        self.write(ujson.dumps({
+            "cursors": self.dump_cursors(conversations)
+        }, escape_forward_slashes=False)[:-1] + ',"conversations":[' + ",".join(
+            conversation.dump_json(gamespace_id)
+            for conversation in conversations
+        ) + "]}")
 
 
-class ReadMessagesRecipientHandler(AuthenticatedHandler):
+class SyncHandler(AuthenticatedHandler):
+    @scoped()
+    async def get(self):
+        sync = self.application.sync
+
+        limit = to_int(self.get_argument("limit", 100))
+
+        account_id = self.token.account
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            cursor = SyncCursor.parse(self.get_argument("cursor", None))
+            page = await sync.sync(gamespace_id, account_id, cursor=cursor, limit=limit)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.set_header("Content-Type", "application/json")
+        self.write(page.dump_json(gamespace_id))
+
+
+class ReadMessagesRecipientHandler(MessagesPageMixin, AuthenticatedHandler):
     @scoped()
     async def get(self, recipient_account_id):
         history = self.application.history
 
         limit = to_int(self.get_argument("limit", 100))
         offset = to_int(self.get_argument("offset", 0))
+        before, after = self.get_cursors()
 
         account_id = self.token.account
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
 
         try:
             messages, count = await history.list_messages_recipient_count(
-                gamespace_id, account_id, recipient_account_id, limit=limit, offset=offset)
+                gamespace_id, account_id, recipient_account_id, limit=limit, offset=offset,
+                before=before, after=after)
         except MessageError as e:
             raise HTTPError(e.code, "Account is not joined in that group")
 
-        self.dumps({
+        self.dumps_page({
             "reply_to": {
                 "recipient_class": CLASS_USER,
                 "recipient": str(recipient_account_id),
             },
-            "total_count": count,
-            "messages": [
-                {
-                    "uuid": message.message_uuid,
-                    "recipient_class": message.recipient_class,
-                    "sender": message.sender,
-                    "recipient": message.recipient,
-                    "gamespace": int(gamespace_id),
-                    "time": str(message.time),
-                    "type": message.message_type,
-                    "payload": message.payload
-                }
-                for message in reversed(messages)
-            ]
-        })
+            "total_count": count
+        }, messages, gamespace_id)
 
 
 class JoinGroupHandler(AuthenticatedHandler):
@@ -242,6 +317,7 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
     def __init__(self, application, request, **kwargs):
         super(ConversationEndpointHandler, self).__init__(application, request, **kwargs)
         self.conversation = None
+        self.read_markers = None
         self.authoritative = False
 
     def required_scopes(self):
@@ -264,6 +340,7 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
 
         gamespace = self.token.get(AccessToken.GAMESPACE)
 
+        self.read_markers = ReadMarkersBuffer(self.application.history, gamespace, account_id)
         self.conversation = await online.conversation(gamespace, account_id)
 
         self.conversation.set_on_message(self._message)
@@ -367,23 +444,30 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
 
     @validate(message_id="str")
     async def mark_as_read(self, message_id):
+        # written behind, see ReadMarkersBuffer
+        self.read_markers.mark(message_id)
+        return True
 
-        account_id = str(self.token.account)
+    @validate(message_ids="json_list_of_strings")
+    async def mark_many_as_read(self, message_ids):
+        for message_id in message_ids:
+            self.read_markers.mark(message_id)
+        return True
+
+    @validate(cursor="str", limit="int")
+    async def sync(self, cursor=None, limit=100):
+
+        account_id = self.token.account
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
 
-        history = self.application.history
+        sync = self.application.sync
 
         try:
-            result = await history.mark_message_as_read(
-                gamespace_id,
-                account_id,
-                message_id)
-        except MessageNotFound:
-            raise JsonRPCError(404, "No such message.")
+            page = await sync.sync(gamespace_id, account_id, cursor=SyncCursor.parse(cursor), limit=limit)
         except MessageError as e:
             raise JsonRPCError(e.code, e.message)
 
-        return result
+        return page.dump(gamespace_id)
 
     @validate(message_id="str", payload="json_dict")
     async def update_message(self, message_id, payload):
@@ -407,6 +491,10 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
         return result
 
     async def on_closed(self):
+        if self.read_markers:
+            await self.read_markers.flush()
+            self.read_markers = None
+
         if not self.conversation:
             return
 
@@ -429,11 +517,15 @@ class SendMessagesHandler(AuthenticatedHandler):
             raise HTTPError(400, "Corrupted messages")
 
         try:
-            await message_queue.add_messages(gamespace_id, self.token.account, messages,
-                                             authoritative=authoritative)
+            results = await message_queue.add_messages(gamespace_id, self.token.account, messages,
+                                                       authoritative=authoritative)
         except MessageSendError as e:
             raise HTTPError(e.code, "Failed to deliver a message: " + e.message)
 
+        self.dumps({
+            "messages": results
+        })
+
 
 class SendMessageHandler(AuthenticatedHandler):
     @scoped()
@@ -563,7 +655,14 @@ class InternalHandler(object):
         message_queue = self.application.message_queue
         logging.info("Delivering batched messages...")
 
-        await message_queue.add_messages(gamespace, sender, messages, authoritative=authoritative)
+        try:
+            results = await message_queue.add_messages(gamespace, sender, messages, authoritative=authoritative)
+        except MessageSendError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            "messages": results
+        }
 
     @validate(gamespace="int", sender="int", recipient_class="str", recipient_key="str",
               message_type="str", payload="json_dict", flags="json_list_of_str_name",
@@ -0,0 +1,275 @@
+from tornado.gen import sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+from anthill.common.options import options
+
+from . import MessageError
+from . history import MessagesQuery
+
+import datetime
+import logging
+
+
+class ArchivePartitionAdapter(object):
+    def __init__(self, data):
+        self.name = data.get("PARTITION_NAME")
+        self.rows = data.get("TABLE_ROWS")
+
+        # the first day of the next month, or None for the last (catch-all) partition
+        bound = data.get("PARTITION_DESCRIPTION") or ""
+        if bound == "MAXVALUE":
+            self.bound = None
+        else:
+            self.bound = datetime.datetime.strptime(bound.strip("'")[:10], "%Y-%m-%d")
+
+
+class MessagesArchiveModel(Model):
+
+    """
+    Retention of the message history.
+
+    The messages older than 'message_retention_days' are moved (in chunks, oldest first) from the 'messages' table
+    into the 'messages_archive' one, compressed and partitioned by month of 'message_time'. Once a month is older
+    than 'message_archive_retention_months', its partition is dropped, which is instant, unlike a DELETE.
+
+    The 'messages' table itself cannot be partitioned, as a partitioned table cannot have foreign keys referring
+    to it (see 'account_inbox'), nor unique keys other than on the partitioning column ('message_uuid').
+
+    The archive keeps the columns of the 'messages' table, so it can be queried with MessagesQuery as well,
+    see 'messages_query'.
+    """
+
+    TABLE = "messages_archive"
+    CATCH_ALL = "p_max"
+
+    LOCK_NAME = "message_archive"
+
+    def __init__(self, db, history):
+        self.db = db
+        self.history = history
+
+        self.retention_days = options.message_retention_days
+        self.archive_retention_months = options.message_archive_retention_months
+        self.interval = options.message_archive_interval
+        self.chunk_size = max(options.message_archive_chunk_size, 1)
+        self.pause = options.message_archive_pause
+
+        self.maintain_callback = None
+        self.running = False
+
+    def get_setup_tables(self):
+        return [MessagesArchiveModel.TABLE]
+
+    def get_setup_db(self):
+        return self.db
+
+    @property
+    def enabled(self):
+        return self.retention_days > 0
+
+    async def started(self, application):
+        await super(MessagesArchiveModel, self).started(application)
+
+        if not self.enabled:
+            return
+
+        self.maintain_callback = PeriodicCallback(self.__maintain__, self.interval * 1000)
+        self.maintain_callback.start()
+
+        IOLoop.current().spawn_callback(self.__maintain__)
+
+    async def stopped(self):
+        if self.maintain_callback:
+            self.maintain_callback.stop()
+            self.maintain_callback = None
+
+    def messages_query(self, gamespace):
+        return MessagesQuery(gamespace, self.db, table=MessagesArchiveModel.TABLE)
+
+    async def list_partitions(self, db=None):
+        try:
+            partitions = await (db or self.db).query(
+                """
+                    SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION`, `TABLE_ROWS`
+                    FROM `information_schema`.`PARTITIONS`
+                    WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `PARTITION_NAME` IS NOT NULL
+                    ORDER BY `PARTITION_ORDINAL_POSITION` ASC;
+                """, MessagesArchiveModel.TABLE)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list archive partitions: " + e.args[1])
+
+        return list(map(ArchivePartitionAdapter, partitions))
+
+    @staticmethod
+    def __month__(time, months=0):
+        """
+        :returns: the first day of the month of the time, shifted by the amount of months
+        """
+
+        month = time.year * 12 + time.month - 1 + months
+        return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+    async def __maintain__(self):
+        if self.running:
+            return
+
+        self.running = True
+
+        try:
+            await self.maintain()
+        except MessageError as e:
+            logging.error("Failed to maintain the messages archive: " + e.message)
+        finally:
+            self.running = False
+
+    async def maintain(self):
+        """
+        Archives the messages past the retention period, and drops the expired archive partitions.
+        Only one node does that at a time, the others skip it.
+
+        :returns: how many messages have been archived
+        """
+
+        async with self.db.acquire() as db:
+            try:
+                lock = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, MessagesArchiveModel.LOCK_NAME)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to acquire the archive lock: " + e.args[1])
+
+            if not lock or not lock["locked"]:
+                return 0
+
+            try:
+                archived = await self.__archive__(db)
+                await self.__expire__(db)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to archive messages: " + e.args[1])
+            finally:
+                await db.get(
+                    """
+                        SELECT RELEASE_LOCK(%s) AS `released`;
+                    """, MessagesArchiveModel.LOCK_NAME)
+
+        if archived:
+            logging.info("Archived {0} messages".format(archived))
+            await self.history.app.recent_messages.invalidate()
+
+        return archived
+
+    async def __partition__(self, db, first, last):
+        """
+        Makes sure the archive has the partitions for the months from 'first' to 'last'. The months before
+            the first partition existing are stored in that partition.
+        """
+
+        partitions = await self.list_partitions(db)
+        bounds = [partition.bound for partition in partitions if partition.bound is not None]
+
+        month = MessagesArchiveModel.__month__(max(bounds)) if bounds else MessagesArchiveModel.__month__(first)
+        last = MessagesArchiveModel.__month__(last)
+
+        added = []
+
+        while month <= last:
+            added.append("PARTITION `p{0}` VALUES LESS THAN ('{1}')".format(
+                month.strftime("%Y%m"), MessagesArchiveModel.__month__(month, 1).strftime("%Y-%m-%d")))
+            month = MessagesArchiveModel.__month__(month, 1)
+
+        if not added:
+            return
+
+        added.append("PARTITION `{0}` VALUES LESS THAN (MAXVALUE)".format(MessagesArchiveModel.CATCH_ALL))
+
+        await db.execute(
+            """
+                ALTER TABLE `{0}`
+                REORGANIZE PARTITION `{1}` INTO ({2});
+            """.format(MessagesArchiveModel.TABLE, MessagesArchiveModel.CATCH_ALL, ", ".join(added)))
+
+    async def __archive__(self, db):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.retention_days)
+
+        oldest = await db.get(
+            """
+                SELECT MIN(`message_time`) AS `oldest`
+                FROM `messages`;
+            """)
+
+        if not oldest or oldest["oldest"] is None or oldest["oldest"] >= cutoff:
+            return 0
+
+        await self.__partition__(db, oldest["oldest"], cutoff)
+
+        archived = 0
+
+        while True:
+            async with self.db.acquire(auto_commit=False) as chunk:
+                messages = await chunk.query(
+                    """
+                        SELECT `message_id`
+                        FROM `messages`
+                        WHERE `message_time`<%s
+                        ORDER BY `message_time` ASC, `message_id` ASC
+                        LIMIT %s;
+                    """, cutoff, self.chunk_size)
+
+                message_ids = [message["message_id"] for message in messages]
+
+                if message_ids:
+                    # locks the messages being archived, so they are not updated before being deleted,
+                    #   the shared payloads are archived along with each message
+                    await chunk.execute(
+                        """
+                            INSERT IGNORE INTO `{0}`
+                            (`message_id`, `gamespace_id`, `message_uuid`, `message_sender`,
+                                `message_recipient_class`, `message_recipient`, `message_time`, `message_type`,
+                                `message_payload`, `message_delivered`, `message_flags`, `message_archived`)
+                            SELECT m.`message_id`, m.`gamespace_id`, m.`message_uuid`, m.`message_sender`,
+                                m.`message_recipient_class`, m.`message_recipient`, m.`message_time`,
+                                m.`message_type`, COALESCE(p.`payload`, m.`message_payload`),
+                                m.`message_delivered`, m.`message_flags`, NOW()
+                            FROM `messages` AS m
+                                LEFT JOIN `message_payloads` AS p
+                                ON p.`gamespace_id`=m.`gamespace_id` AND p.`payload_hash`=m.`message_payload_hash`
+                            WHERE m.`message_id` IN %s;
+                        """.format(MessagesArchiveModel.TABLE), message_ids)
+
+                    # the clients expire their copies of the history on their own
+                    await self.history.delete_messages_by_id(message_ids, db=chunk, changed=False)
+
+                await chunk.commit()
+
+            archived += len(message_ids)
+
+            if len(message_ids) < self.chunk_size:
+                return archived
+
+            await sleep(self.pause)
+
+    async def __expire__(self, db):
+        if self.archive_retention_months <= 0:
+            return
+
+        expired = MessagesArchiveModel.__month__(datetime.datetime.utcnow(), -self.archive_retention_months)
+
+        partitions = [
+            partition.name
+            for partition in await self.list_partitions(db)
+            if partition.bound is not None and partition.bound <= expired
+        ]
+
+        if not partitions:
+            return
+
+        logging.info("Dropping expired archive partitions: " + ", ".join(partitions))
+
+        await db.execute(
+            """
+                ALTER TABLE `{0}`
+                DROP PARTITION {1};
+            """.format(MessagesArchiveModel.TABLE, ", ".join("`{0}`".format(name) for name in partitions)))
@@ -0,0 +1,75 @@
+from tornado.gen import Future, convert_yielded
+from tornado.ioloop import IOLoop
+
+
+class BatchWriter(object):
+
+    """
+    Collects items to be written and flushes them together, either once 'max_size' items are collected,
+    or 'window' seconds after the first one of the batch has been added.
+
+    'flush' is a coroutine that accepts a list of items, and returns a list of results (one for each item,
+    in the same order). Each 'add' returns a Future that is resolved with the result for that item once the
+    batch is flushed, or fails if that result is an exception instead.
+    """
+
+    def __init__(self, flush, max_size, window):
+        self.flush_callback = flush
+        self.max_size = max(max_size, 1)
+        self.window = window
+
+        self.items = []
+        self.futures = []
+        self.timeout = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        f = Future()
+
+        self.items.append(item)
+        self.futures.append(f)
+
+        if len(self.items) >= self.max_size:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = IOLoop.current().call_later(self.window, self.flush)
+
+        return f
+
+    def flush(self):
+        """
+        Flushes the items collected so far.
+        :returns: a Future, resolved once the flush is complete
+        """
+
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+        items, futures = self.items, self.futures
+        self.items, self.futures = [], []
+
+        return convert_yielded(self.__flush__(items, futures))
+
+    async def __flush__(self, items, futures):
+        if not items:
+            return
+
+        # noinspection PyBroadException
+        try:
+            results = await self.flush_callback(items)
+        except Exception as e:
+            for f in futures:
+                if not f.done():
+                    f.set_exception(e)
+            return
+
+        for f, result in zip(futures, results):
+            if f.done():
+                continue
+            if isinstance(result, Exception):
+                f.set_exception(result)
+            else:
+                f.set_result(result)
@@ -40,6 +40,10 @@ class AccountConversation(object):
 
     EXCHANGE_PREFIX = "conv"
 
+    # a direct exchange every online exchange (account's or group's) is bound to with its own name
+    # as a routing key, so a message to someone offline is returned back instead of being lost
+    DELIVERY_EXCHANGE = "conv.delivery"
+
     MAX_EXCHANGES = 255
 
     """
@@ -57,6 +61,7 @@ class AccountConversation(object):
         self.custom_exchange = None
         self.receive_queue = None
         self.receive_consumer = None
+        self.present = False
 
         self.on_message = None
         self.on_deleted = None
@@ -78,6 +83,11 @@ class AccountConversation(object):
             exchange_type='fanout',
             auto_delete=True)
 
+        delivery_exchange = await self.receive_channel.exchange(
+            exchange=AccountConversation.DELIVERY_EXCHANGE,
+            exchange_type='direct',
+            durable=True)
+
         self.receive_queue = await self.receive_channel.queue(exclusive=True, arguments={
             "x-message-ttl": 1000
         })
@@ -117,6 +127,14 @@ class AccountConversation(object):
                 auto_delete=True)
 
             await self.receive_exchange.bind(exchange=group_exchange)
+            await group_exchange.bind(exchange=delivery_exchange, routing_key=exchange_name)
+
+        await self.receive_exchange.bind(
+            exchange=delivery_exchange,
+            routing_key=AccountConversation.__id__(CLASS_USER, self.account_id))
+
+        await self.online.presence.account_bound(self.account_id)
+        self.present = True
 
         def receiver(m):
             return self.on_message(
@@ -149,6 +167,13 @@ class AccountConversation(object):
     # noinspection PyBroadException
     async def release(self):
 
+        if self.present:
+            self.present = False
+            try:
+                await self.online.presence.account_released(self.account_id)
+            except Exception:
+                logging.exception("Failed to release the presence")
+
         if self.receive_queue:
             try:
                 await self.receive_queue.delete()
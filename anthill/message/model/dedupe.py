@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+
+class ProcessedMessages(object):
+
+    """
+    A bounded set of recently processed message uuids, the oldest ones are evicted first (LRU).
+    Used to acknowledge redelivered messages without delivering or storing them again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.uuids = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def check(self, message_uuid):
+        """
+        :returns: True if the message has been processed already
+        """
+
+        if message_uuid in self.uuids:
+            self.uuids.move_to_end(message_uuid)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, message_uuid):
+        if not self.size:
+            return
+
+        self.uuids[message_uuid] = True
+        self.uuids.move_to_end(message_uuid)
+
+        while len(self.uuids) > self.size:
+            self.uuids.popitem(last=False)
+
+    def dump(self):
+        return {
+            "size": len(self.uuids),
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -6,6 +6,7 @@ from anthill.common.options import options
 from anthill.common.validate import validate
 
 from . import MessageError, MessageFlags
+from . purge import PurgeModel
 
 
 class GroupAdapter(object):
@@ -58,25 +59,30 @@ class GroupsModel(Model):
     def get_setup_db(self):
         return self.db
 
+    def get_hot_queries(self):
+        return [
+            ("groups_account_participates",
+             """
+                SELECT g.*, p.*
+                FROM `group_participants` AS p
+                    INNER JOIN `groups` AS g
+                    ON p.`group_id`=`g`.`group_id`
+                WHERE p.`participation_account`=%s AND p.`gamespace_id`=%s;
+             """, [1, 1]),
+            ("group_participants",
+             """
+                SELECT * FROM `group_participants`
+                WHERE `gamespace_id`=%s AND `group_id`=%s;
+             """, [1, 1])
+        ]
+
     def has_delete_account_event(self):
         return True
 
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
-        try:
-            if gamespace_only:
-                await self.db.execute(
-                    """
-                        DELETE FROM `group_participants`
-                        WHERE `gamespace_id`=%s AND `participation_account` IN %s;
-                    """, gamespace, accounts)
-            else:
-                await self.db.execute(
-                    """
-                        DELETE FROM `group_participants`
-                        WHERE `participation_account` IN %s;
-                    """, accounts)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+        await self.app.purge.enqueue(
+            gamespace if gamespace_only else None,
+            PurgeModel.GROUP_PARTICIPANTS, {"accounts": accounts})
 
     @validate(gamespace="int", group_class="str", key="str", clustered="bool", cluster_size="int")
     async def new_group(self, gamespace, group_class, key, clustered=False, cluster_size=1000):
@@ -132,7 +138,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", group_class="str", key="str", account_id="int")
     async def find_group_with_participation(self, gamespace, group_class, key, account_id):
         try:
-            group = await self.db.get(
+            group = await self.app.replicas.read(gamespace, account_id).get(
                 """
                     SELECT *
                     FROM `groups`
@@ -174,9 +180,12 @@ class GroupsModel(Model):
 
         group_id = group.group_id
 
+        # the messages (and the inboxes of the participants along with them) are deleted in background
         try:
-            await self.history.delete_messages_like(
-                gamespace_id, group.group_class, group.key + "-%")
+            await self.app.purge.enqueue(gamespace_id, PurgeModel.GROUP, {
+                "group_class": group.group_class,
+                "group_key": group.key
+            })
         except MessageError as e:
             raise GroupError(500, "Failed to delete group's messages: " + e.message)
 
@@ -204,6 +213,8 @@ class GroupsModel(Model):
     @validate(gamespace="int", group=GroupAdapter, account="int", role="str", notify="json_dict", authoritative="bool")
     async def join_group(self, gamespace, group, account, role, notify=None, authoritative=False):
 
+        self.app.replicas.written(gamespace, account)
+
         group_id = group.group_id
 
         if group.clustered:
@@ -236,6 +247,12 @@ class GroupsModel(Model):
             "role": role
         })
 
+        try:
+            await self.history.group_joined(
+                gamespace, group.group_class, participation.calculate_recipient(), account)
+        except MessageError as e:
+            raise GroupError(500, "Failed to join a group: " + e.message)
+
         await self.online.bind_account_to_group(account, participation)
 
         if notify:
@@ -278,6 +295,8 @@ class GroupsModel(Model):
     @validate(gamespace="int", group=GroupAdapter, account="int", notify="json_dict", authoritative="bool")
     async def leave_group(self, gamespace, group, account, notify=None, authoritative=False):
 
+        self.app.replicas.written(gamespace, account)
+
         participation = await self.find_group_participant(gamespace, group.group_id, account)
 
         try:
@@ -289,6 +308,12 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to leave a group: " + e.args[1])
 
+        try:
+            await self.history.group_left(
+                gamespace, group.group_class, participation.calculate_recipient(), account)
+        except MessageError as e:
+            raise GroupError(500, "Failed to leave a group: " + e.message)
+
         if participation.cluster_id:
             try:
                 await self.cluster.leave_cluster(
@@ -323,7 +348,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", group_id="int")
     async def list_group_participants(self, gamespace, group_id):
         try:
-            participants = await self.db.query(
+            participants = await self.app.replicas.read(gamespace).query(
                 """
                     SELECT *
                     FROM `group_participants`
@@ -337,7 +362,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", account_id="int")
     async def list_groups_account_participates(self, gamespace, account_id):
         try:
-            groups = await self.db.query(
+            groups = await self.app.replicas.read(gamespace, account_id).query(
                 """
                     SELECT g.*, p.*
                     FROM `group_participants` AS p
@@ -353,7 +378,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", account_id="int")
     async def list_participants_by_account(self, gamespace, account_id):
         try:
-            participants = await self.db.query(
+            participants = await self.app.replicas.read(gamespace, account_id).query(
                 """
                     SELECT *
                     FROM `group_participants`
@@ -3,9 +3,20 @@ from anthill.common.model import Model
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.validate import validate
 from anthill.common.profile import Profile, ProfileError
+from anthill.common.options import options
 
 from . import MessageError, MessageFlags, CLASS_USER
+from . purge import PurgeModel
 
+from tornado.gen import multi
+from tornado.ioloop import IOLoop
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+import binascii
+import datetime
+import hashlib
+import logging
 import ujson
 
 
@@ -34,22 +45,87 @@ class LastReadMessageAdapter(object):
 
 
 class MessageAdapter(object):
+
+    """
+    A message, as stored. The payload and the flags are parsed on first access only, as most of the messages
+    listed are just serialized back as they are, see 'dump_json'.
+    """
+
+    __slots__ = (
+        "message_id", "gamespace_id", "message_uuid", "recipient_class", "sender", "recipient", "time",
+        "message_type", "payload_hash", "delivered", "raw_payload", "raw_flags", "_payload", "_flags")
+
+    NOT_PARSED = object()
+
     def __init__(self, data):
         self.message_id = data.get("message_id")
+        self.gamespace_id = data.get("gamespace_id")
         self.message_uuid = data.get("message_uuid")
         self.recipient_class = str(data.get("message_recipient_class"))
         self.sender = str(data.get("message_sender"))
         self.recipient = str(data.get("message_recipient"))
         self.time = data.get("message_time")
         self.message_type = data.get("message_type")
-        self.payload = data.get("message_payload")
-        if isinstance(self.payload, str):
-            self.payload = ujson.loads(self.payload)
+        # set if the payload is stored in 'message_payloads', see load_messages
+        self.payload_hash = data.get("message_payload_hash")
         self.delivered = data.get("message_delivered")
 
-        flags = data.get("message_flags", "").lower().split(",")
+        # either the serialized payload, or the payload itself
+        self.raw_payload = data.get("message_payload")
+        self.raw_flags = data.get("message_flags")
+
+        self._payload = MessageAdapter.NOT_PARSED
+        self._flags = None
+
+    @property
+    def payload(self):
+        if self._payload is MessageAdapter.NOT_PARSED:
+            payload = self.raw_payload
+            if isinstance(payload, (str, bytes)):
+                payload = ujson.loads(payload)
+            self._payload = payload
+
+        return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self.raw_payload = value
+        self._payload = value
+
+    @property
+    def flags(self):
+        if self._flags is None:
+            self._flags = MessageFlags((self.raw_flags or "").lower().split(","))
+
+        return self._flags
 
-        self.flags = MessageFlags(flags)
+    def dump_payload_json(self):
+        """
+        :returns: the payload serialized, as stored, unless it has been parsed already
+        """
+
+        if self._payload is MessageAdapter.NOT_PARSED and isinstance(self.raw_payload, str):
+            return self.raw_payload
+
+        return ujson.dumps(self.payload, escape_forward_slashes=False)
+
+    def dump_json(self, gamespace):
+        """
+        :returns: the message serialized the way the inboxes list it, the payload is written as stored,
+            without being parsed and serialized again
+        """
+
+        message = ujson.dumps({
+            "uuid": self.message_uuid,
+            "recipient_class": self.recipient_class,
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "gamespace": int(gamespace),
+            "time": str(self.time),
+            "type": self.message_type
+        }, escape_forward_slashes=False)
+
+        return message[:-1] + ',"payload":' + self.dump_payload_json() + "}"
 
     def dump(self):
         return {
@@ -62,10 +138,143 @@ class MessageAdapter(object):
         }
 
 
+def dump_messages_json(messages, gamespace):
+    """
+    :returns: a JSON array of the messages, see MessageAdapter.dump_json
+    """
+
+    return "[" + ",".join(message.dump_json(gamespace) for message in messages) + "]"
+
+
+class ConversationAdapter(object):
+    def __init__(self, data, last_message=None):
+        self.conversation_key = data.get("conversation_key")
+        self.recipient_class = str(data.get("conversation_class"))
+        self.recipient = str(data.get("conversation_recipient"))
+        self.unread = data.get("conversation_unread", 0)
+        # the position of the conversation, see MessagesCursor
+        self.message_id = data.get("message_id")
+        self.time = data.get("message_time")
+        self.last_message = last_message
+
+    def dump_json(self, gamespace):
+        conversation = ujson.dumps({
+            "recipient_class": self.recipient_class,
+            "recipient": self.recipient,
+            "unread_count": self.unread,
+            "time": str(self.time)
+        }, escape_forward_slashes=False)
+
+        last_message = self.last_message.dump_json(gamespace) if self.last_message else "null"
+        return conversation[:-1] + ',"last_message":' + last_message + "}"
+
+
+async def load_messages(db, rows):
+    """
+    :returns: a list of MessageAdapter of the rows of `messages`, with the payloads shared in the
+        'message_payloads' table filled in
+    """
+
+    messages = list(map(MessageAdapter, rows))
+
+    shared = list({
+        (message.gamespace_id, message.payload_hash)
+        for message in messages
+        if message.payload_hash
+    })
+
+    if not shared:
+        return messages
+
+    try:
+        payloads = await db.query(
+            """
+                SELECT `gamespace_id`, `payload_hash`, `payload`
+                FROM `message_payloads`
+                WHERE (`gamespace_id`, `payload_hash`) IN ({0});
+            """.format(", ".join(["(%s, %s)"] * len(shared))), *[value for key in shared for value in key])
+    except DatabaseError as e:
+        raise MessageError(500, "Failed to load message payloads: " + e.args[1])
+
+    payloads = {
+        (row["gamespace_id"], row["payload_hash"]): row["payload"]
+        for row in payloads
+    }
+
+    for message in messages:
+        if not message.payload_hash:
+            continue
+
+        payload = payloads.get((message.gamespace_id, message.payload_hash), {})
+        if isinstance(payload, str):
+            payload = ujson.loads(payload)
+        message.payload = payload
+
+    return messages
+
+
+class MessagesCursor(object):
+
+    """
+    An opaque position in a list of messages, made of (message_time, message_id) of a message.
+    Paging with a cursor costs the same however deep the page is, unlike with LIMIT offset.
+    """
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, time, message_id):
+        self.time = time
+        self.message_id = message_id
+
+    @staticmethod
+    def of(message):
+        value = message.time.strftime(MessagesCursor.TIME_FORMAT) + "|" + str(message.message_id)
+        return urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def parse(value):
+        if not value:
+            return None
+
+        try:
+            time, message_id = urlsafe_b64decode(value.encode()).decode().split("|")
+            return MessagesCursor(datetime.datetime.strptime(time, MessagesCursor.TIME_FORMAT), int(message_id))
+        except (ValueError, TypeError, binascii.Error):
+            raise MessageError(400, "Bad cursor")
+
+    @staticmethod
+    def keyset(before, after, table="`messages`"):
+        """
+        :returns: (an extra SQL condition, its arguments, sort direction) to select the page next to a cursor,
+            the direction is ascending for the 'after' cursor, so the page has to be reversed once selected
+        """
+
+        if before:
+            condition, data = before.condition(True, table)
+            return " AND " + condition, data, "DESC"
+
+        if after:
+            condition, data = after.condition(False, table)
+            return " AND " + condition, data, "ASC"
+
+        return "", [], "DESC"
+
+    def condition(self, before, table="`messages`"):
+        """
+        :returns: SQL condition and its arguments to select the messages before (or after) the cursor
+        """
+
+        op = "<" if before else ">"
+        return \
+            "({0}.`message_time` {1} %s OR ({0}.`message_time` = %s AND {0}.`message_id` {1} %s))".format(table, op), \
+            [self.time, self.time, self.message_id]
+
+
 class MessagesQuery(object):
-    def __init__(self, gamespace_id, db):
+    def __init__(self, gamespace_id, db, table="messages"):
         self.gamespace_id = gamespace_id
         self.db = db
+        self.table = table
 
         self.message_sender = None
         self.message_recipient_class = None
@@ -76,6 +285,10 @@ class MessagesQuery(object):
         self.offset = 0
         self.limit = 0
 
+        # MessagesCursor's, if set, the query pages by cursor instead of offset
+        self.before = None
+        self.after = None
+
     def __values__(self):
         conditions = [
             "`gamespace_id`=%s"
@@ -105,23 +318,63 @@ class MessagesQuery(object):
             conditions.append("`message_delivered`=%s")
             data.append(str(int(bool(self.message_delivered))))
 
+        cursor = self.before or self.after
+        if cursor:
+            condition, condition_data = cursor.condition(self.before is not None, "`{0}`".format(self.table))
+            conditions.append(condition)
+            data.extend(condition_data)
+
         return conditions, data
 
+    async def estimate(self):
+        """
+        :returns: the optimizer estimate of how many messages match the query (see EXPLAIN), much cheaper
+            than counting them, but can be way off
+        """
+
+        conditions, data = self.__values__()
+
+        try:
+            plan = await self.db.get(
+                """
+                    EXPLAIN SELECT * FROM `{0}`
+                    WHERE {1};
+                """.format(self.table, " AND ".join(conditions)), *data)
+        except DatabaseError as e:
+            raise MessageQueryError("Failed to estimate messages: " + e.args[1])
+
+        return int(plan["rows"] or 0) if plan else 0
+
     async def query(self, one=False, count=False):
         conditions, data = self.__values__()
 
         query = """
-            SELECT {0} * FROM `messages`
-            WHERE {1}
+            SELECT {0} * FROM `{1}`
+            WHERE {2}
         """.format(
             "SQL_CALC_FOUND_ROWS" if count else "",
+            self.table,
             " AND ".join(conditions))
 
-        query += """
-            ORDER BY `message_time` DESC
-        """
+        if self.after:
+            query += """
+                ORDER BY `message_time` ASC, `message_id` ASC
+            """
+        elif self.before:
+            query += """
+                ORDER BY `message_time` DESC, `message_id` DESC
+            """
+        else:
+            query += """
+                ORDER BY `message_time` DESC
+            """
 
-        if self.limit:
+        if self.limit and (self.before or self.after):
+            query += """
+                LIMIT %s
+            """
+            data.append(int(self.limit))
+        elif self.limit:
             query += """
                 LIMIT %s,%s
             """
@@ -139,7 +392,10 @@ class MessagesQuery(object):
             if not result:
                 return None
 
-            return MessageAdapter(result)
+            try:
+                return (await load_messages(self.db, [result]))[0]
+            except MessageError as e:
+                raise MessageQueryError(e.message)
         else:
             async with self.db.acquire() as db:
                 try:
@@ -156,95 +412,1148 @@ class MessagesQuery(object):
                         """)
                     count_result = count_result["count"]
 
-                items = map(MessageAdapter, result)
+                try:
+                    items = await load_messages(self.db, result)
+                except MessageError as e:
+                    raise MessageQueryError(e.message)
+
+                # messages are always returned newest first
+                if self.after:
+                    items.reverse()
+
+                if count:
+                    return (items, count_result)
+
+                return items
+
+
+class MessagesHistoryModel(Model):
+
+    INBOX_BACKFILL_BATCH = 1000
+
+    # the kinds of the changes recorded into 'message_changes'
+    CHANGE_NEW = "new"
+    CHANGE_UPDATED = "updated"
+    CHANGE_DELETED = "deleted"
+
+    # see 'conversation_key'
+    CONVERSATION_KEY_SQL = """
+        IF(`message_recipient_class`=%s,
+            CONCAT(%s, ':',
+                LEAST(`message_sender`, CAST(`message_recipient` AS UNSIGNED)), ':',
+                GREATEST(`message_sender`, CAST(`message_recipient` AS UNSIGNED))),
+            CONCAT(`message_recipient_class`, ':', `message_recipient`))
+    """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+
+        self.inbox_maintained = options.message_account_inbox_maintain
+        # the index cannot be read from unless it's maintained
+        self.account_inbox = options.message_account_inbox and self.inbox_maintained
+        self.inbox_backfill = None
+        self.counters = options.message_counters
+        self.admin_approximate_count = options.message_admin_approximate_count
+        self.incoming_chunk_size = max(options.message_incoming_chunk_size, 1)
+        self.conversation_keys_maintained = options.message_conversation_keys_maintain
+        # same as the inbox, the keys cannot be read by unless they're maintained
+        self.conversation_keys = options.message_conversation_keys and self.conversation_keys_maintained
+        self.conversation_backfill = None
+        self.payload_dedupe = options.message_payload_dedupe
+        # the changes of the messages are recorded for MessageSyncModel
+        self.sync_log = options.message_sync
+        self.payload_dedupe_size = options.message_payload_dedupe_size
+
+    def get_setup_tables(self):
+        return ["messages", "last_read_message", "account_inbox", "message_counters", "message_payloads",
+                "account_conversations"]
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_hot_queries(self):
+        """
+        :returns: a list of (name, query, sample arguments) of the queries that have to be served by an index,
+            see SchemaModel.explain
+        """
+
+        return [
+            ("read_incoming_messages",
+             """
+                SELECT * FROM `messages`
+                WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                    AND `message_delivered`=0 AND `message_id`>%s
+                ORDER BY `message_id` ASC
+                LIMIT 100;
+             """, [1, "user", "1", 0]),
+            ("group_inbox",
+             """
+                SELECT * FROM `messages`
+                WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                ORDER BY `message_time` DESC, `message_id` DESC
+                LIMIT 100;
+             """, [1, "group", "1"]),
+            ("messages_sent",
+             """
+                SELECT * FROM `messages`
+                WHERE `gamespace_id`=%s AND `message_sender`=%s
+                ORDER BY `message_time` DESC, `message_id` DESC
+                LIMIT 100;
+             """, [1, 1]),
+            ("account_inbox",
+             """
+                SELECT `messages`.* FROM `account_inbox`, `messages`
+                WHERE `account_inbox`.`gamespace_id`=%s AND `account_inbox`.`account_id`=%s
+                    AND `messages`.`message_id`=`account_inbox`.`message_id`
+                ORDER BY `account_inbox`.`message_id` DESC
+                LIMIT 100;
+             """, [1, 1]),
+            ("conversation",
+             """
+                SELECT * FROM `messages`
+                WHERE `gamespace_id`=%s AND `message_conversation_key`=%s
+                ORDER BY `message_time` DESC, `message_id` DESC
+                LIMIT 100;
+             """, [1, "user:1:2"]),
+            ("account_conversations",
+             """
+                SELECT * FROM `account_conversations`
+                WHERE `gamespace_id`=%s AND `account_id`=%s
+                ORDER BY `message_time` DESC, `message_id` DESC
+                LIMIT 100;
+             """, [1, 1]),
+            ("last_read_messages",
+             """
+                SELECT * FROM `last_read_message`
+                WHERE `gamespace_id`=%s AND `account_id`=%s;
+             """, [1, 1])
+        ]
+
+    def has_delete_account_event(self):
+        return True
+
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        # everything of the accounts is deleted in chunks, in background
+        await self.app.purge.enqueue(
+            gamespace if gamespace_only else None,
+            PurgeModel.ACCOUNTS, {"accounts": accounts})
+
+    def messages_query(self, gamespace, account_id=None):
+        """
+        :param account_id: the account the messages are queried for, if any, see ReplicaRouter
+        """
+        return MessagesQuery(gamespace, self.read_db(gamespace, account_id))
+
+    def read_db(self, gamespace, account_id=None):
+        """
+        :returns: the database to read the messages of the account from (a read replica, if possible)
+        """
+        return self.app.replicas.read(gamespace, account_id)
+
+    @validate(gamespace="int", sender="int", message_uuid="str", recipient_class="str",
+              recipient_key="str", time="datetime", message_type="str", payload="json",
+              flags=MessageFlags, delivered="bool")
+    async def add_message(self, gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+                          message_type, payload, flags, delivered=False):
+
+        if not isinstance(payload, dict):
+            raise MessageError(400, "payload should be a dict")
+
+        payload, payload_hash = self.__payload__(payload)
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    if payload_hash:
+                        await self.__share_payloads__(db, [(gamespace, payload_hash, payload)])
+
+                    columns = self.__message_columns__(
+                        gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+                        message_type, payload, payload_hash, flags, delivered)
+
+                    message_id = await db.insert(
+                        """
+                            INSERT INTO `messages`
+                            ({0})
+                            VALUES ({1});
+                        """.format(", ".join("`{0}`".format(column) for column, value in columns),
+                                   ", ".join(["%s"] * len(columns))),
+                        *[value for column, value in columns])
+
+                    if self.inbox_maintained:
+                        await self.__fan_out__(db, "`messages`.`message_id`=%s", message_id)
+                    await self.__messages_added__(
+                        db, "`messages`.`message_id`=%s", message_id, accounts=self.inbox_maintained)
+                    if self.conversation_keys_maintained:
+                        await self.__conversations_updated__(db, "`messages`.`message_id`=%s", message_id)
+                    if self.sync_log:
+                        await self.__changed__(
+                            db, MessagesHistoryModel.CHANGE_NEW, "`messages`.`message_id`=%s", message_id)
+                    await db.commit()
+                except DatabaseError:
+                    # the connection goes back into the pool, so does the transaction otherwise
+                    await db.rollback()
+                    raise
+        except DuplicateError:
+            raise MessageDuplicateError(400, "Message with that ID already exists")
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to add message: " + e.args[1])
+        else:
+            return message_id
+
+    async def add_messages(self, messages):
+        """
+        Stores a batch of messages with a single multi-row INSERT. If the batch cannot be stored as a whole
+            (for example, one of the messages is a duplicate), falls back to storing them one by one, so a single
+            bad message does not fail the rest of the batch.
+
+        :param messages: a list of (gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+            message_type, payload, flags, delivered) tuples
+        :returns: a list of results for each message: the message id if stored, None if it had been stored
+            already, or a MessageError instance otherwise
+        """
+
+        rows = []
+        values = []
+        shared = []
+        columns = []
+
+        for gamespace, sender, message_uuid, recipient_class, recipient_key, time, \
+                message_type, payload, flags, delivered in messages:
+
+            if not isinstance(payload, dict):
+                return await self.__add_messages_one_by_one__(messages)
+
+            payload, payload_hash = self.__payload__(payload)
+
+            if payload_hash:
+                shared.append((gamespace, payload_hash, payload))
+
+            # the same for each of the messages
+            columns = self.__message_columns__(
+                gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+                message_type, payload, payload_hash, flags, delivered)
+
+            rows.append("(" + ", ".join(["%s"] * len(columns)) + ")")
+            values.extend(value for column, value in columns)
+
+        if not rows:
+            return []
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    await self.__share_payloads__(db, shared)
+
+                    await db.execute(
+                        """
+                            INSERT INTO `messages`
+                            ({0})
+                            VALUES {1};
+                        """.format(", ".join("`{0}`".format(column) for column, value in columns),
+                                   ", ".join(rows)), *values)
+
+                    uuids = [m[2] for m in messages]
+
+                    if self.inbox_maintained:
+                        await self.__fan_out__(db, "`messages`.`message_uuid` IN %s", uuids)
+                    await self.__messages_added__(
+                        db, "`messages`.`message_uuid` IN %s", uuids, accounts=self.inbox_maintained)
+                    if self.conversation_keys_maintained:
+                        await self.__conversations_updated__(db, "`messages`.`message_uuid` IN %s", uuids)
+                    if self.sync_log:
+                        await self.__changed__(
+                            db, MessagesHistoryModel.CHANGE_NEW, "`messages`.`message_uuid` IN %s", uuids)
+
+                    stored = await db.query(
+                        """
+                            SELECT `message_uuid`, `message_id`
+                            FROM `messages`
+                            WHERE `message_uuid` IN %s;
+                        """, uuids)
+
+                    await db.commit()
+                except DatabaseError:
+                    # the connection goes back into the pool, so does the transaction otherwise
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            logging.warning("Failed to store a batch of {0} messages ({1}), storing one by one".format(
+                len(messages), e.args[1]))
+            return await self.__add_messages_one_by_one__(messages)
+
+        stored = {
+            row["message_uuid"]: row["message_id"]
+            for row in stored
+        }
+
+        return [stored.get(uuid) for uuid in uuids]
+
+    def __message_columns__(self, gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+                            message_type, payload, payload_hash, flags, delivered):
+        """
+        :returns: a list of (column, value) of a message to store. The columns added by the migrations are set
+            only while the features relying on them are enabled.
+        """
+
+        columns = [
+            ("gamespace_id", gamespace),
+            ("message_uuid", message_uuid),
+            ("message_recipient_class", recipient_class),
+            ("message_sender", sender),
+            ("message_recipient", recipient_key),
+            ("message_time", time),
+            ("message_type", message_type),
+            ("message_payload", "{}" if payload_hash else payload),
+            ("message_delivered", int(delivered)),
+            ("message_flags", flags.dump())
+        ]
+
+        if self.conversation_keys_maintained:
+            columns.append(("message_conversation_key",
+                            MessagesHistoryModel.conversation_key(sender, recipient_class, recipient_key)))
+
+        if self.payload_dedupe:
+            columns.append(("message_payload_hash", payload_hash))
+
+        return columns
+
+    @staticmethod
+    def conversation_key(sender, recipient_class, recipient):
+        """
+        :returns: the key of the conversation the message belongs to: the pair of the accounts (ordered, so
+            it's the same both ways) for the messages sent to an account, the recipient otherwise.
+            Has to match CONVERSATION_KEY_SQL.
+        """
+
+        if recipient_class == CLASS_USER:
+            recipient = int(recipient) if str(recipient).isdigit() else 0
+            first, second = sorted([int(sender), recipient])
+            return "{0}:{1}:{2}".format(CLASS_USER, first, second)
+
+        return "{0}:{1}".format(recipient_class, recipient)
+
+    def __payload__(self, payload):
+        """
+        :returns: a pair of the payload serialized, and its hash if the payload is to be shared in the
+            'message_payloads' table (None if it's to be stored in the message itself)
+        """
+
+        serialized = ujson.dumps(payload)
+
+        if not self.payload_dedupe or len(serialized) < self.payload_dedupe_size:
+            return serialized, None
+
+        # the same payload has to end up with the same hash, whatever the order of its keys is
+        serialized = ujson.dumps(payload, sort_keys=True)
+        return serialized, hashlib.sha1(serialized.encode()).hexdigest()
+
+    @staticmethod
+    async def __share_payloads__(db, payloads):
+        """
+        References the payloads in 'message_payloads', storing the ones not stored there yet
+        :param payloads: a list of (gamespace_id, payload hash, payload serialized), one for each message
+        """
+
+        refs = {}
+
+        for gamespace, payload_hash, payload in payloads:
+            count, _ = refs.get((gamespace, payload_hash), (0, payload))
+            refs[(gamespace, payload_hash)] = (count + 1, payload)
+
+        if not refs:
+            return
+
+        values = []
+
+        # always in the same order, so concurrent batches do not deadlock
+        for (gamespace, payload_hash), (count, payload) in sorted(refs.items()):
+            values.extend([gamespace, payload_hash, payload, count])
+
+        await db.execute(
+            """
+                INSERT INTO `message_payloads`
+                (`gamespace_id`, `payload_hash`, `payload`, `payload_refs`)
+                VALUES {0}
+                ON DUPLICATE KEY UPDATE `payload_refs`=`payload_refs`+VALUES(`payload_refs`);
+            """.format(", ".join(["(%s, %s, %s, %s)"] * len(refs))), *values)
+
+    @staticmethod
+    async def __payloads_removed__(db, condition, *args):
+        """
+        Dereferences the shared payloads of the messages matching the condition, about to be deleted (or to
+            have their payloads replaced), and deletes the payloads no longer referenced at all
+        """
+
+        removed = """
+            SELECT `messages`.`gamespace_id`, `messages`.`message_payload_hash`, COUNT(*) AS `refs`
+            FROM `messages`
+            WHERE {0} AND `messages`.`message_payload_hash` IS NOT NULL
+            GROUP BY `messages`.`gamespace_id`, `messages`.`message_payload_hash`
+        """.format(condition)
+
+        await db.execute(
+            """
+                UPDATE `message_payloads`, ({0}) AS `removed`
+                SET `message_payloads`.`payload_refs`=`message_payloads`.`payload_refs`-`removed`.`refs`
+                WHERE `message_payloads`.`gamespace_id`=`removed`.`gamespace_id`
+                    AND `message_payloads`.`payload_hash`=`removed`.`message_payload_hash`;
+            """.format(removed), *args)
+
+        await db.execute(
+            """
+                DELETE `message_payloads`
+                FROM `message_payloads`, ({0}) AS `removed`
+                WHERE `message_payloads`.`gamespace_id`=`removed`.`gamespace_id`
+                    AND `message_payloads`.`payload_hash`=`removed`.`message_payload_hash`
+                    AND `message_payloads`.`payload_refs`<=0;
+            """.format(removed), *args)
+
+    @staticmethod
+    def __fan_out_select__(condition, *args):
+        """
+        :returns: a query (and its arguments) that selects (gamespace_id, account_id, message_id, message_time)
+            of every account that would see the messages matching the condition: the sender, the recipient
+            account, and the participants of the recipient group. The participants of a clustered group see
+            the messages sent to their cluster only, the recipient of those is '<group_key>-<cluster_id>',
+            see GroupParticipationAdapter.calculate_recipient
+        """
+
+        return """
+                SELECT `messages`.`gamespace_id`, `messages`.`message_sender` AS `account_id`,
+                    `messages`.`message_id`, `messages`.`message_time`
+                FROM `messages`
+                WHERE {0}
+                UNION ALL
+                SELECT `messages`.`gamespace_id`, CAST(`messages`.`message_recipient` AS UNSIGNED),
+                    `messages`.`message_id`, `messages`.`message_time`
+                FROM `messages`
+                WHERE {0} AND `messages`.`message_recipient_class`=%s
+                UNION ALL
+                SELECT `messages`.`gamespace_id`, `group_participants`.`participation_account`,
+                    `messages`.`message_id`, `messages`.`message_time`
+                FROM `messages`, `groups`, `group_participants`
+                WHERE {0} AND `groups`.`gamespace_id`=`messages`.`gamespace_id`
+                    AND `groups`.`group_class`=`messages`.`message_recipient_class`
+                    AND `groups`.`group_key`=`messages`.`message_recipient`
+                    AND `group_participants`.`group_id`=`groups`.`group_id`
+                    AND `group_participants`.`cluster_id`=0
+                UNION ALL
+                SELECT `messages`.`gamespace_id`, `group_participants`.`participation_account`,
+                    `messages`.`message_id`, `messages`.`message_time`
+                FROM `messages`, `groups`, `group_participants`
+                WHERE {0} AND LOCATE('-', `messages`.`message_recipient`)>0
+                    AND `groups`.`gamespace_id`=`messages`.`gamespace_id`
+                    AND `groups`.`group_class`=`messages`.`message_recipient_class`
+                    AND `groups`.`group_key`=LEFT(`messages`.`message_recipient`,
+                        CHAR_LENGTH(`messages`.`message_recipient`)
+                            - CHAR_LENGTH(SUBSTRING_INDEX(`messages`.`message_recipient`, '-', -1)) - 1)
+                    AND `groups`.`group_clustered`=1
+                    AND `group_participants`.`group_id`=`groups`.`group_id`
+                    AND CONCAT(`groups`.`group_key`, '-', `group_participants`.`cluster_id`)
+                        =`messages`.`message_recipient`
+            """.format(condition), [*args, *args, CLASS_USER, *args, *args]
+
+    @staticmethod
+    async def __fan_out__(db, condition, *args):
+        """
+        Adds the messages matching the condition into the 'account_inbox' of every account that would see them
+        """
+
+        query, data = MessagesHistoryModel.__fan_out_select__(condition, *args)
+
+        await db.execute(
+            """
+                INSERT IGNORE INTO `account_inbox`
+                (`gamespace_id`, `account_id`, `message_id`, `message_time`)
+                {0};
+            """.format(query), *data)
+
+    @staticmethod
+    async def __count__(db, query, *args):
+        """
+        Adds the (gamespace_id, counter_kind, counter_class, counter_key, counter_value) rows selected by the query
+            to the message counters. The columns selected have to be named distinctly (literals are named after
+            their values), as the query is selected from as a derived table.
+        """
+
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT * FROM ({0}) AS `counted`
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value`+VALUES(`counter_value`);
+            """.format(query), *args)
+
+    @staticmethod
+    async def __messages_added__(db, condition, *args, accounts=True):
+        """
+        Counts the messages matching the condition, just stored (and fanned out), in the counters of their
+            recipients and of the accounts that see them
+        :param accounts: whether the messages have been fanned out into the 'account_inbox', the counters of the
+            accounts are discounted by the rows of it (see '__inbox_removed__'), so they're counted only if so
+        """
+
+        await MessagesHistoryModel.__count__(
+            db,
+            """
+                SELECT `messages`.`gamespace_id`, 'recipient', `messages`.`message_recipient_class`,
+                    `messages`.`message_recipient`, COUNT(*)
+                FROM `messages`
+                WHERE {0}
+                GROUP BY `messages`.`gamespace_id`, `messages`.`message_recipient_class`,
+                    `messages`.`message_recipient`
+            """.format(condition), *args)
+
+        if not accounts:
+            return
+
+        query, data = MessagesHistoryModel.__fan_out_select__(condition, *args)
+
+        # the sender may as well be the recipient, or a participant of the recipient group
+        await MessagesHistoryModel.__count__(
+            db,
+            """
+                SELECT `seen`.`gamespace_id`, 'account', '', `seen`.`account_id`, COUNT(DISTINCT `seen`.`message_id`)
+                FROM ({0}) AS `seen`
+                GROUP BY `seen`.`gamespace_id`, `seen`.`account_id`
+            """.format(query), *data)
+
+    @staticmethod
+    async def __messages_removed__(db, condition, *args):
+        """
+        Discounts the messages matching the condition, about to be deleted, from the counters of their
+            recipients and of the accounts that see them
+        """
+
+        await MessagesHistoryModel.__count__(
+            db,
+            """
+                SELECT `messages`.`gamespace_id`, 'recipient', `messages`.`message_recipient_class`,
+                    `messages`.`message_recipient`, -COUNT(*)
+                FROM `messages`
+                WHERE {0}
+                GROUP BY `messages`.`gamespace_id`, `messages`.`message_recipient_class`,
+                    `messages`.`message_recipient`
+            """.format(condition), *args)
+
+        await MessagesHistoryModel.__inbox_removed__(db, condition, *args)
+
+    @staticmethod
+    async def __inbox_removed__(db, condition, *args):
+        """
+        Discounts the 'account_inbox' rows matching the condition (on both `account_inbox` and `messages`),
+            about to be deleted, from the counters of their accounts
+        """
+
+        await MessagesHistoryModel.__count__(
+            db,
+            """
+                SELECT `account_inbox`.`gamespace_id`, 'account', '', `account_inbox`.`account_id`, -COUNT(*)
+                FROM `account_inbox`, `messages`
+                WHERE {0} AND `account_inbox`.`message_id`=`messages`.`message_id`
+                GROUP BY `account_inbox`.`gamespace_id`, `account_inbox`.`account_id`
+            """.format(condition), *args)
+
+    @staticmethod
+    async def __changed__(db, change_kind, condition, *args):
+        """
+        Records a change of the messages matching the condition into the 'message_changes' log of every
+            account that sees them, see MessageSyncModel
+        """
+
+        query, data = MessagesHistoryModel.__fan_out_select__(condition, *args)
+
+        # the sender may as well be the recipient, or a participant of the recipient group
+        await db.execute(
+            """
+                INSERT INTO `message_changes`
+                (`gamespace_id`, `account_id`, `message_id`, `message_uuid`, `change_kind`, `change_time`)
+                SELECT DISTINCT `seen`.`gamespace_id`, `seen`.`account_id`, `seen`.`message_id`,
+                    `messages`.`message_uuid`, %s, NOW()
+                FROM ({0}) AS `seen`, `messages`
+                WHERE `messages`.`message_id`=`seen`.`message_id`;
+            """.format(query), change_kind, *data)
+
+    @staticmethod
+    async def __seen__(db, condition, *args):
+        """
+        :returns: a list of (gamespace_id, account_id, message_id, message_uuid) of every account that sees
+            the messages matching the condition, to record their changes once the messages are gone,
+            see '__changes_recorded__'
+        """
+
+        query, data = MessagesHistoryModel.__fan_out_select__(condition, *args)
+
+        seen = await db.query(
+            """
+                SELECT DISTINCT `seen`.`gamespace_id`, `seen`.`account_id`, `seen`.`message_id`,
+                    `messages`.`message_uuid`
+                FROM ({0}) AS `seen`, `messages`
+                WHERE `messages`.`message_id`=`seen`.`message_id`;
+            """.format(query), *data)
+
+        return [
+            (row["gamespace_id"], row["account_id"], row["message_id"], row["message_uuid"])
+            for row in seen
+        ]
+
+    @staticmethod
+    async def __changes_recorded__(db, change_kind, seen):
+        """
+        Same as '__changed__', records a change for the accounts returned by '__seen__'
+        """
+
+        batch_size = MessagesHistoryModel.INBOX_BACKFILL_BATCH
+
+        for offset in range(0, len(seen), batch_size):
+            batch = seen[offset:offset + batch_size]
+            values = []
+
+            for gamespace_id, account_id, message_id, message_uuid in batch:
+                values.extend([gamespace_id, account_id, message_id, message_uuid, change_kind])
+
+            await db.execute(
+                """
+                    INSERT INTO `message_changes`
+                    (`gamespace_id`, `account_id`, `message_id`, `message_uuid`, `change_kind`, `change_time`)
+                    VALUES {0};
+                """.format(", ".join(["(%s, %s, %s, %s, %s, NOW())"] * len(batch))), *values)
+
+    @staticmethod
+    async def __conversations_updated__(db, condition, *args):
+        """
+        Updates the conversations of every account that sees the messages matching the condition, just stored:
+            the last message of each, and the amount of messages the account has not read (not counting
+            the ones the account has sent)
+        """
+
+        query, data = MessagesHistoryModel.__fan_out_select__(condition, *args)
+
+        # the assignments see the values updated before them, so the time goes last
+        await db.execute(
+            """
+                INSERT INTO `account_conversations`
+                (`gamespace_id`, `account_id`, `conversation_key`, `conversation_class`, `conversation_recipient`,
+                    `message_id`, `message_uuid`, `message_time`, `conversation_unread`)
+                SELECT `seen`.`gamespace_id`, `seen`.`account_id`, `messages`.`message_conversation_key`,
+                    `messages`.`message_recipient_class`,
+                    IF(`messages`.`message_recipient_class`=%s AND `messages`.`message_recipient`=`seen`.`account_id`,
+                        `messages`.`message_sender`, `messages`.`message_recipient`),
+                    `messages`.`message_id`, `messages`.`message_uuid`, `messages`.`message_time`,
+                    IF(`messages`.`message_sender`=`seen`.`account_id`, 0, 1)
+                FROM ({0}) AS `seen`, `messages`
+                WHERE `messages`.`message_id`=`seen`.`message_id`
+                    AND `messages`.`message_conversation_key` IS NOT NULL
+                ON DUPLICATE KEY UPDATE
+                    `conversation_unread`=`conversation_unread`+VALUES(`conversation_unread`),
+                    `message_id`=IF(VALUES(`message_time`)>=`message_time`, VALUES(`message_id`), `message_id`),
+                    `message_uuid`=IF(VALUES(`message_time`)>=`message_time`, VALUES(`message_uuid`), `message_uuid`),
+                    `message_time`=GREATEST(`message_time`, VALUES(`message_time`));
+            """.format(query), CLASS_USER, *data)
+
+    @staticmethod
+    async def __conversation_read__(db, gamespace, account_id, conversation_key, time):
+        """
+        Recounts the unread messages of a conversation of the account, once the messages up to the time
+            have been read
+        """
+
+        await db.execute(
+            """
+                UPDATE `account_conversations`
+                SET `conversation_unread`=(
+                        SELECT COUNT(*)
+                        FROM `messages`
+                        WHERE `messages`.`gamespace_id`=%s AND `messages`.`message_conversation_key`=%s
+                            AND `messages`.`message_time`>GREATEST(
+                                COALESCE(`account_conversations`.`conversation_read_time`, %s), %s)
+                            AND `messages`.`message_sender`!=%s
+                    ),
+                    `conversation_read_time`=GREATEST(COALESCE(`conversation_read_time`, %s), %s)
+                WHERE `gamespace_id`=%s AND `account_id`=%s AND `conversation_key`=%s;
+            """, gamespace, conversation_key, time, time, account_id, time, time,
+            gamespace, account_id, conversation_key)
+
+    @validate(gamespace="int", account_id="int", limit="int")
+    async def list_conversations(self, gamespace, account_id, limit=100, before=None, after=None):
+        """
+        Returns the conversations of the account (the accounts it has exchanged messages with directly,
+            and the groups it has seen messages of), the most recently active first.
+
+        :param before: a MessagesCursor to list the conversations less recently active than
+        :param after: a MessagesCursor to list the conversations more recently active than
+        :returns: a list of ConversationAdapter
+        """
+
+        if limit < 1 or limit > 1000:
+            raise MessageError(400, "Bad limit")
+
+        if not self.conversation_keys_maintained:
+            raise MessageError(409, "Conversations are not maintained")
+
+        condition, data, order = MessagesCursor.keyset(before, after, table="`account_conversations`")
+
+        try:
+            conversations = await self.read_db(gamespace, account_id).query(
+                """
+                    SELECT `account_conversations`.*, `messages`.`message_sender`, `messages`.`message_type`,
+                        `messages`.`message_payload`, `messages`.`message_payload_hash`,
+                        `messages`.`message_recipient_class`, `messages`.`message_recipient`,
+                        `messages`.`message_flags`
+                    FROM `account_conversations`
+                        LEFT JOIN `messages`
+                        ON `messages`.`message_id`=`account_conversations`.`message_id`
+                    WHERE `account_conversations`.`gamespace_id`=%s
+                        AND `account_conversations`.`account_id`=%s{0}
+                    ORDER BY `account_conversations`.`message_time` {1},
+                        `account_conversations`.`message_id` {1}
+                    LIMIT %s;
+                """.format(condition, order), gamespace, account_id, *data, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list conversations: " + e.args[1])
+
+        # the last message may have been deleted since
+        last_messages = await load_messages(self.db, [
+            conversation for conversation in conversations
+            if conversation["message_sender"] is not None
+        ])
+
+        last_messages = {
+            message.message_id: message
+            for message in last_messages
+        }
+
+        conversations = [
+            ConversationAdapter(conversation, last_messages.get(conversation["message_id"]))
+            for conversation in conversations
+        ]
+
+        if order == "ASC":
+            conversations.reverse()
+
+        return conversations
+
+    async def group_joined(self, gamespace, group_class, recipient, account_id):
+        """
+        Adds the history of a group into the 'account_inbox' of an account that has just joined it, in background
+        :param recipient: the recipient the account reads the group messages of, the group key, or the key
+            of its cluster for a clustered group
+        """
+
+        if not self.inbox_maintained:
+            return
+
+        IOLoop.current().spawn_callback(self.__group_joined__, gamespace, group_class, recipient, account_id)
+
+    async def __group_joined__(self, gamespace, group_class, recipient, account_id,
+                               batch_size=INBOX_BACKFILL_BATCH):
+        """
+        Adds the history of the group in batches (oldest first), each in a transaction of its own, so a large
+            group does not lock its whole history at once. Stops once the account is no longer in the group.
+        """
+
+        position = None
+
+        while True:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    participates = await db.get(
+                        """
+                            SELECT `participation_id`
+                            FROM `group_participants`
+                            WHERE `gamespace_id`=%s AND `participation_account`=%s AND `group_class`=%s
+                                AND IF(`cluster_id`, CONCAT(`group_key`, '-', `cluster_id`), `group_key`)=%s
+                            LIMIT 1;
+                        """, gamespace, account_id, group_class, recipient)
+
+                    if participates is None:
+                        return
+
+                    condition, data = position.condition(False) if position else ("TRUE", [])
+
+                    messages = await db.query(
+                        """
+                            SELECT `message_id`, `message_time`
+                            FROM `messages`
+                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                                AND {0}
+                            ORDER BY `message_time` ASC, `message_id` ASC
+                            LIMIT %s;
+                        """.format(condition), gamespace, group_class, recipient, *data, batch_size)
+
+                    if messages:
+                        await db.execute(
+                            """
+                                INSERT IGNORE INTO `account_inbox`
+                                (`gamespace_id`, `account_id`, `message_id`, `message_time`)
+                                VALUES {0};
+                            """.format(", ".join(["(%s, %s, %s, %s)"] * len(messages))),
+                            *[value for message in messages for value in (
+                                gamespace, account_id, message["message_id"], message["message_time"])])
+
+                        # the messages the account has sent into the group are there already
+                        added = await db.get(
+                            """
+                                SELECT ROW_COUNT() AS `count`;
+                            """)
+
+                        if added["count"] > 0:
+                            await self.__count__(
+                                db,
+                                """
+                                    SELECT %s AS `gamespace_id`, 'account' AS `counter_kind`,
+                                        '' AS `counter_class`, %s AS `counter_key`, %s AS `counter_value`
+                                """, gamespace, str(account_id), added["count"])
+
+                    await db.commit()
+                except DatabaseError as e:
+                    await db.rollback()
+                    logging.error("Failed to add the history of group {0}/{1} to the inbox of account {2}: "
+                                  "{3}".format(group_class, recipient, account_id, e.args[1]))
+                    return
+
+            if len(messages) < batch_size:
+                return
+
+            position = MessagesCursor(messages[-1]["message_time"], messages[-1]["message_id"])
+
+    async def group_left(self, gamespace, group_class, recipient, account_id=None):
+        """
+        Removes the messages of a group from the 'account_inbox' of an account that has left it (or of everyone,
+            if the group is deleted), except for the messages sent by the account itself
+        :param recipient: see 'group_joined'
+        """
+
+        condition = """
+            `messages`.`gamespace_id`=%s AND `messages`.`message_recipient_class`=%s
+                AND `messages`.`message_recipient`=%s
+                AND `account_inbox`.`account_id`<>`messages`.`message_sender`
+        """
+        args = [gamespace, group_class, recipient]
+
+        if account_id is not None:
+            condition += " AND `account_inbox`.`account_id`=%s"
+            args.append(account_id)
+
+        try:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    await self.__inbox_removed__(db, condition, *args)
+                    await db.execute(
+                        """
+                            DELETE `account_inbox`
+                            FROM `account_inbox`, `messages`
+                            WHERE {0} AND `account_inbox`.`message_id`=`messages`.`message_id`;
+                        """.format(condition), *args)
+                    await db.commit()
+                except DatabaseError:
+                    # the connection goes back into the pool, so does the transaction otherwise
+                    await db.rollback()
+                    raise
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to update account inbox: " + e.args[1])
+
+    async def backfill_account_inbox(self, batch_size=INBOX_BACKFILL_BATCH):
+        """
+        Fills the 'account_inbox' with the messages stored before it existed, in batches of message ids,
+            so it never locks too much of the messages table at once. Safe to run again, and to run while
+            the new messages are being stored. The progress is kept in 'inbox_backfill'.
+        """
+
+        if self.inbox_backfill and self.inbox_backfill["running"]:
+            raise MessageError(409, "Account inbox backfill is running already")
+
+        if not self.inbox_maintained:
+            raise MessageError(409, "Account inbox is not maintained")
+
+        self.inbox_backfill = progress = {
+            "running": True,
+            "first": 0,
+            "last": 0,
+            "position": 0,
+            "error": None
+        }
+
+        try:
+            boundaries = await self.db.get(
+                """
+                    SELECT MIN(`message_id`) AS `first`, MAX(`message_id`) AS `last`
+                    FROM `messages`;
+                """)
+
+            first, last = boundaries["first"] or 0, boundaries["last"] or 0
+
+            progress["first"] = first
+            progress["last"] = last
+            progress["position"] = max(first - 1, 0)
+
+            logging.info("Account inbox backfill started, messages {0}..{1}".format(first, last))
+
+            while progress["position"] < last:
+                position = progress["position"]
+                until = min(position + batch_size, last)
+
+                async with self.db.acquire() as db:
+                    await self.__fan_out__(
+                        db, "`messages`.`message_id` > %s AND `messages`.`message_id` <= %s", position, until)
+
+                progress["position"] = until
+
+            # the rows indexed by the backfill have not been counted
+            await self.recount()
+        except (DatabaseError, MessageError) as e:
+            progress["error"] = str(e)
+            logging.error("Account inbox backfill failed at message {0}: {1}".format(
+                progress["position"], str(e)))
+        else:
+            logging.info("Account inbox backfill complete")
+        finally:
+            progress["running"] = False
+
+    async def backfill_conversation_keys(self, batch_size=INBOX_BACKFILL_BATCH):
+        """
+        Sets the conversation keys of the messages stored before the keys existed, in batches of message ids,
+            the same way as 'backfill_account_inbox' does. The progress is kept in 'conversation_backfill'.
+        """
+
+        if self.conversation_backfill and self.conversation_backfill["running"]:
+            raise MessageError(409, "Conversation keys backfill is running already")
+
+        if not self.conversation_keys_maintained:
+            raise MessageError(409, "Conversation keys are not maintained")
+
+        self.conversation_backfill = progress = {
+            "running": True,
+            "first": 0,
+            "last": 0,
+            "position": 0,
+            "error": None
+        }
+
+        try:
+            boundaries = await self.db.get(
+                """
+                    SELECT MIN(`message_id`) AS `first`, MAX(`message_id`) AS `last`
+                    FROM `messages`;
+                """)
+
+            first, last = boundaries["first"] or 0, boundaries["last"] or 0
+
+            progress["first"] = first
+            progress["last"] = last
+            progress["position"] = max(first - 1, 0)
+
+            logging.info("Conversation keys backfill started, messages {0}..{1}".format(first, last))
+
+            while progress["position"] < last:
+                position = progress["position"]
+                until = min(position + batch_size, last)
+
+                await self.db.execute(
+                    """
+                        UPDATE `messages`
+                        SET `message_conversation_key`={0}
+                        WHERE `message_id` > %s AND `message_id` <= %s AND `message_conversation_key` IS NULL;
+                    """.format(MessagesHistoryModel.CONVERSATION_KEY_SQL), CLASS_USER, CLASS_USER, position, until)
+
+                progress["position"] = until
+        except DatabaseError as e:
+            progress["error"] = e.args[1]
+            logging.error("Conversation keys backfill failed at message {0}: {1}".format(
+                progress["position"], e.args[1]))
+        else:
+            logging.info("Conversation keys backfill complete")
+        finally:
+            progress["running"] = False
+
+    async def recount(self, batch_size=INBOX_BACKFILL_BATCH):
+        """
+        Rebuilds the message counters, a batch of counters at a time (each in a transaction of its own), so the
+            messages being stored, that update the same counters, are not stalled for the whole recount. The
+            messages stored or deleted while it runs may be miscounted still, so it is better done when the
+            service is not busy.
+        """
+
+        try:
+            # the recipients, (gamespace_id, recipient_class, recipient) of the messages
+            await self.__recount__(
+                "recipient",
+                """
+                    SELECT DISTINCT `gamespace_id`, `message_recipient_class`, `message_recipient`
+                    FROM `messages`
+                    WHERE (`gamespace_id`, `message_recipient_class`, `message_recipient`)>(%s, %s, %s)
+                    ORDER BY `gamespace_id`, `message_recipient_class`, `message_recipient`
+                    LIMIT %s;
+                """,
+                """
+                    SELECT `gamespace_id`, `message_recipient_class`, `message_recipient`, COUNT(*) AS `value`
+                    FROM `messages`
+                    WHERE (`gamespace_id`, `message_recipient_class`, `message_recipient`) IN %s
+                    GROUP BY `gamespace_id`, `message_recipient_class`, `message_recipient`;
+                """,
+                (0, "", ""), lambda key: key, lambda counter: counter, batch_size)
+
+            # the accounts, (gamespace_id, account_id) of the account inbox
+            await self.__recount__(
+                "account",
+                """
+                    SELECT DISTINCT `gamespace_id`, `account_id`
+                    FROM `account_inbox`
+                    WHERE (`gamespace_id`, `account_id`)>(%s, %s)
+                    ORDER BY `gamespace_id`, `account_id`
+                    LIMIT %s;
+                """,
+                """
+                    SELECT `gamespace_id`, `account_id`, COUNT(*) AS `value`
+                    FROM `account_inbox`
+                    WHERE (`gamespace_id`, `account_id`) IN %s
+                    GROUP BY `gamespace_id`, `account_id`;
+                """,
+                (0, 0), lambda key: (key[0], "", str(key[1])), lambda counter: (counter[0], int(counter[2])),
+                batch_size)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to recount messages: " + e.args[1])
+
+        logging.info("Message counters have been recounted")
 
-                if count:
-                    return (items, count_result)
+    async def __recount__(self, kind, keys_query, count_query, start, to_counter, from_counter, batch_size):
+        """
+        Recounts the counters of a kind: first the ones of every key the messages are counted by, in the order
+            of the keys, then the counters left without any messages are removed, in the order of the counters.
+
+        :param keys_query: selects the next batch of the distinct keys, past the key given
+        :param count_query: selects the keys IN the ones given, along with the 'value' counted for each
+        :param start: the key to start from, less than any key
+        :param to_counter: converts a key into (gamespace_id, counter_class, counter_key) of its counter
+        :param from_counter: converts (gamespace_id, counter_class, counter_key) of a counter into its key
+        """
 
-                return items
+        position = start
 
+        while True:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    keys = [tuple(row.values()) for row in await db.query(keys_query, *position, batch_size)]
 
-class MessagesHistoryModel(Model):
+                    if keys:
+                        counted = [tuple(row.values()) for row in await db.query(count_query, keys)]
+                        counters = [to_counter(row[:-1]) + (row[-1],) for row in counted]
 
-    def __init__(self, db, app):
-        self.db = db
-        self.app = app
+                        await db.execute(
+                            """
+                                INSERT INTO `message_counters`
+                                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                                VALUES {0}
+                                ON DUPLICATE KEY UPDATE `counter_value`=VALUES(`counter_value`);
+                            """.format(", ".join(["(%s, %s, %s, %s, %s)"] * len(counters))),
+                            *[value for c in counters for value in (c[0], kind, c[1], c[2], c[3])])
 
-    def get_setup_tables(self):
-        return ["messages", "last_read_message"]
+                    await db.commit()
+                except DatabaseError:
+                    await db.rollback()
+                    raise
 
-    def get_setup_db(self):
-        return self.db
+            if len(keys) < batch_size:
+                break
 
-    def has_delete_account_event(self):
-        return True
+            position = keys[-1]
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
-        try:
-            async with self.db.acquire() as db:
-                if gamespace_only:
-                    await db.execute(
-                        """
-                            DELETE FROM `last_read_message`
-                            WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                        """, gamespace, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_sender` IN %s;
-                        """, gamespace, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient` IN %s;
-                        """, gamespace, CLASS_USER, accounts)
-                else:
-                    await db.execute(
-                        """
-                            DELETE FROM `last_read_message`
-                            WHERE `account_id` IN %s;
-                        """, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `message_sender` IN %s;
-                        """, accounts)
-                    await db.execute(
+        position = (0, "", "")
+
+        while True:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    counters = await db.query(
                         """
-                            DELETE FROM `messages`
-                            WHERE `message_recipient_class`=%s AND `message_recipient` IN %s;
-                        """, CLASS_USER, accounts)
+                            SELECT `gamespace_id`, `counter_class`, `counter_key`
+                            FROM `message_counters`
+                            WHERE (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`)>(%s, %s, %s, %s)
+                                AND `counter_kind`=%s
+                            ORDER BY `gamespace_id`, `counter_kind`, `counter_class`, `counter_key`
+                            LIMIT %s;
+                        """, position[0], kind, position[1], position[2], kind, batch_size)
+                    counters = [tuple(row.values()) for row in counters]
+
+                    if counters:
+                        counted = await db.query(count_query, [from_counter(counter) for counter in counters])
+                        counted = set(to_counter(tuple(row.values())[:-1]) for row in counted)
+
+                        empty = [counter for counter in counters if counter not in counted]
+
+                        if empty:
+                            await db.execute(
+                                """
+                                    DELETE FROM `message_counters`
+                                    WHERE `counter_kind`=%s
+                                        AND (`gamespace_id`, `counter_class`, `counter_key`) IN %s;
+                                """, kind, empty)
+
+                    await db.commit()
+                except DatabaseError:
+                    await db.rollback()
+                    raise
+
+            if len(counters) < batch_size:
+                return
+
+            position = counters[-1]
+
+    async def __get_counter__(self, gamespace, kind, counter_class, counter_key, db=None):
+        try:
+            counter = await (db or self.db).get(
+                """
+                    SELECT `counter_value`
+                    FROM `message_counters`
+                    WHERE `gamespace_id`=%s AND `counter_kind`=%s AND `counter_class`=%s AND `counter_key`=%s;
+                """, gamespace, kind, counter_class, str(counter_key))
         except DatabaseError as e:
-            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+            raise MessageError(500, "Failed to get message counter: " + e.args[1])
 
-    def messages_query(self, gamespace):
-        return MessagesQuery(gamespace, self.db)
+        return max(counter["counter_value"], 0) if counter else 0
 
-    @validate(gamespace="int", sender="int", message_uuid="str", recipient_class="str",
-              recipient_key="str", time="datetime", message_type="str", payload="json",
-              flags=MessageFlags, delivered="bool")
-    async def add_message(self, gamespace, sender, message_uuid, recipient_class, recipient_key, time,
-                          message_type, payload, flags, delivered=False):
+    async def count_recipient_messages(self, gamespace, recipient_class, recipient, db=None):
+        """
+        :returns: a maintained total of the messages sent to the recipient
+        """
+        return await self.__get_counter__(gamespace, "recipient", recipient_class, recipient, db=db)
 
-        if not isinstance(payload, dict):
-            raise MessageError(400, "payload should be a dict")
+    async def count_account_messages(self, gamespace, account_id, db=None):
+        """
+        :returns: a maintained total of the messages 'list_messages_account' returns for the account
+        """
+        return await self.__get_counter__(gamespace, "account", "", account_id, db=db)
+
+    async def __add_messages_one_by_one__(self, messages):
+        result = []
 
+        for message in messages:
+            try:
+                message_id = await self.add_message(*message)
+            except MessageDuplicateError:
+                # the message is being redelivered, and has been stored already
+                result.append(None)
+            except MessageError as e:
+                result.append(e)
+            else:
+                result.append(message_id)
+
+        return result
+
+    async def message_exists(self, gamespace, message_uuid):
         try:
-            message_id = await self.db.insert(
+            message = await self.db.get(
                 """
-                    INSERT INTO `messages`
-                    (`gamespace_id`, `message_uuid`, `message_recipient_class`, `message_sender`,
-                        `message_recipient`, `message_time`, `message_type`, `message_payload`,
-                        `message_delivered`, `message_flags`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                """, gamespace, message_uuid, recipient_class, sender,
-                recipient_key, time, message_type, ujson.dumps(payload), int(delivered), flags.dump())
-        except DuplicateError:
-            raise MessageError(400, "Message with that ID already exists")
+                    SELECT `message_id`
+                    FROM `messages`
+                    WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                    LIMIT 1;
+                """, message_uuid, gamespace)
         except DatabaseError as e:
-            raise MessageError(500, "Failed to add message: " + e.args[1])
-        else:
-            return message_id
+            raise MessageError(500, "Failed to check a message: " + e.args[1])
+
+        return message is not None
 
     async def get_message(self, gamespace, message_id):
         try:
@@ -260,7 +1569,7 @@ class MessagesHistoryModel(Model):
         if not message:
             raise MessageNotFound()
 
-        return MessageAdapter(message)
+        return (await load_messages(self.db, [message]))[0]
 
     async def list_incoming_messages(self, gamespace, recipient_class, recipient, limit=100):
         try:
@@ -275,16 +1584,37 @@ class MessagesHistoryModel(Model):
         except DatabaseError as e:
             raise MessageError(500, "Failed to list incoming messages: " + e.args[1])
 
-        return list(map(MessageAdapter, messages))
+        return await load_messages(self.db, messages)
 
     @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account_with_count(self, gamespace, account_id, limit=100, offset=0):
-        async with self.db.acquire() as db:
-            result = await self.list_messages_account_with_count_db(gamespace, account_id, db, limit, offset)
+    async def list_messages_account_with_count(self, gamespace, account_id, limit=100, offset=0,
+                                               before=None, after=None, approximate=False):
+        """
+        Same as 'list_messages_account', the count is None if a cursor is passed, as it is not calculated
+
+        :param approximate: take the count from the counters, even if they are not enabled (so may be
+            not recounted yet)
+        """
+
+        if before or after:
+            messages = await self.list_messages_account(gamespace, account_id, limit, before=before, after=after)
+            return messages, None
+
+        async with self.read_db(gamespace, account_id).acquire() as db:
+            result = await self.list_messages_account_with_count_db(
+                gamespace, account_id, db, limit, offset, approximate=approximate)
             return result
 
-    @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account_with_count_db(self, gamespace, account_id, db, limit=100, offset=0):
+    @validate(gamespace="int", account_id="int", limit="int", offset="int", approximate="bool")
+    async def list_messages_account_with_count_db(self, gamespace, account_id, db, limit=100, offset=0,
+                                                  approximate=False):
+
+        # the account counters count the rows of the account inbox
+        if self.account_inbox and (self.counters or approximate):
+            messages = await self.list_messages_account(gamespace, account_id, limit, offset, db=db, found_rows=False)
+            count = await self.count_account_messages(gamespace, account_id, db=db)
+            return messages, count
+
         messages = await self.list_messages_account(gamespace, account_id, limit, offset, db=db)
         try:
             count_result = await db.get(
@@ -298,18 +1628,66 @@ class MessagesHistoryModel(Model):
         return messages, count_result
 
     @validate(gamespace="int", account_id="int", recipient_account_id="int", limit="int", offset="int")
-    async def list_messages_recipient_count(self, gamespace, account_id, recipient_account_id, limit=100, offset=0):
+    async def list_messages_recipient_count(self, gamespace, account_id, recipient_account_id, limit=100, offset=0,
+                                            before=None, after=None):
 
         """
         Returns messages that were sent between account_id and recipient_account_id
+
+        If either 'before' or 'after' MessagesCursor is passed, the page next to it is returned instead,
+            'offset' is ignored and the count is None, as it is not calculated.
         """
 
         if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
             raise MessageError(400, "Bad limit/offset")
 
-        async with self.db.acquire() as db:
+        if self.conversation_keys:
+            return await self.__list_conversation__(
+                gamespace, MessagesHistoryModel.conversation_key(account_id, CLASS_USER, recipient_account_id),
+                limit, offset, before, after, self.read_db(gamespace, account_id))
+
+        if before or after:
+            condition, data, order = MessagesCursor.keyset(before, after)
+
+            try:
+                messages = await self.read_db(gamespace, account_id).query(
+                    """
+                        (
+                            SELECT * 
+                            FROM `messages` 
+                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND 
+                                  `message_recipient`=%s AND `message_sender`=%s{0}
+                            ORDER BY `message_time` {1}, `message_id` {1}
+                            LIMIT %s
+                        )
+                        UNION DISTINCT
+                        (
+                            SELECT * 
+                            FROM `messages` 
+                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND 
+                                  `message_recipient`=%s AND `message_sender`=%s{0}
+                            ORDER BY `message_time` {1}, `message_id` {1}
+                            LIMIT %s
+                        )
+                        ORDER BY `message_time` {1}, `message_id` {1}
+                        LIMIT %s;
+                    """.format(condition, order),
+                    gamespace, CLASS_USER, str(account_id), str(recipient_account_id), *data, limit,
+                    gamespace, CLASS_USER, str(recipient_account_id), str(account_id), *data, limit,
+                    limit)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+
+            messages = await load_messages(self.db, messages)
+
+            if order == "ASC":
+                messages.reverse()
+
+            return messages, None
+
+        async with self.read_db(gamespace, account_id).acquire() as db:
             try:
-                messages = await (db or self.db).query(
+                messages = await db.query(
                     """
                         SELECT SQL_CALC_FOUND_ROWS * 
                         FROM `messages` 
@@ -336,20 +1714,78 @@ class MessagesHistoryModel(Model):
                 """)
             count_result = count_result["count"]
 
-            return list(map(MessageAdapter, messages)), count_result
+            return await load_messages(self.db, messages), count_result
+
+    async def __list_conversation__(self, gamespace, conversation_key, limit, offset, before, after, read_db):
+        """
+        Same as 'list_messages_recipient_count', reads a single range of the conversation index instead
+        """
+
+        condition, data, order = MessagesCursor.keyset(before, after)
+
+        if before or after:
+            calc = ""
+            paging, paging_data = "LIMIT %s", [limit]
+        else:
+            calc = "SQL_CALC_FOUND_ROWS"
+            paging, paging_data = "LIMIT %s, %s", [offset, limit]
+
+        async with read_db.acquire() as db:
+            try:
+                messages = await db.query(
+                    """
+                        SELECT {0} *
+                        FROM `messages`
+                        WHERE `gamespace_id`=%s AND `message_conversation_key`=%s{1}
+                        ORDER BY `message_time` {2}, `message_id` {2}
+                        {3};
+                    """.format(calc, condition, order, paging),
+                    gamespace, conversation_key, *data, *paging_data)
+
+                count_result = None
+
+                if not (before or after):
+                    count_result = await db.get(
+                        """
+                            SELECT FOUND_ROWS() AS count;
+                        """)
+                    count_result = count_result["count"]
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to list conversation messages: " + e.args[1])
+
+        messages = await load_messages(self.db, messages)
+
+        if order == "ASC":
+            messages.reverse()
+
+        return messages, count_result
 
     @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account(self, gamespace, account_id, limit=100, offset=0, db=None):
+    async def list_messages_account(self, gamespace, account_id, limit=100, offset=0, db=None,
+                                    before=None, after=None, found_rows=True):
         """
         Returns last N..M (offset to limit) messages being sent or received by the account,
             including the ones being sent to the groups the account participates in.
+
+        If either 'before' or 'after' MessagesCursor is passed, the page next to it is returned instead
+            (and 'offset' is ignored), each part of the query is then limited on its own, so the cost of
+            a page does not grow with its depth.
+
+        :param found_rows: if False, FOUND_ROWS() is not calculated for the offset pages, when possible
         """
 
         if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
             raise MessageError(400, "Bad limit/offset")
 
+        if self.account_inbox:
+            return await self.__list_messages_account_inbox__(
+                gamespace, account_id, limit, offset, before, after, db, found_rows=found_rows)
+
+        if before or after:
+            return await self.__list_messages_account_keyset__(gamespace, account_id, limit, before, after, db)
+
         try:
-            messages = await (db or self.db).query(
+            messages = await (db or self.read_db(gamespace, account_id)).query(
                 # now this I call a query. yet it executes in 1ms with 40000 messages in db
                 """
                     SELECT SQL_CALC_FOUND_ROWS * 
@@ -382,84 +1818,284 @@ class MessagesHistoryModel(Model):
         except DatabaseError as e:
             raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
 
-        return list(map(MessageAdapter, messages))
+        return await load_messages(self.db, messages)
+
+    async def __list_messages_account_inbox__(self, gamespace, account_id, limit, offset, before, after, db=None,
+                                              found_rows=True):
+        condition, data, order = MessagesCursor.keyset(before, after, table="`account_inbox`")
+
+        if before or after:
+            calc = ""
+            sort = "`account_inbox`.`message_time` {0}, `account_inbox`.`message_id` {0}".format(order)
+            paging, paging_data = "LIMIT %s", [limit]
+        else:
+            # keeps FOUND_ROWS() working for 'list_messages_account_with_count_db'
+            calc = "SQL_CALC_FOUND_ROWS" if found_rows else ""
+            sort = "`account_inbox`.`message_id` DESC"
+            paging, paging_data = "LIMIT %s, %s", [offset, limit]
 
-    async def read_incoming_messages(self, gamespace, recipient_class, recipient, receiver):
         try:
-            async with self.db.acquire(auto_commit=False) as db:
+            messages = await (db or self.read_db(gamespace, account_id)).query(
+                """
+                    SELECT {0} `messages`.*
+                    FROM `account_inbox`, `messages`
+                    WHERE `account_inbox`.`gamespace_id`=%s AND `account_inbox`.`account_id`=%s{1}
+                        AND `messages`.`message_id`=`account_inbox`.`message_id`
+                    ORDER BY {2}
+                    {3};
+                """.format(calc, condition, sort, paging),
+                gamespace, account_id, *data, *paging_data)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+
+        messages = await load_messages(self.db, messages)
+
+        if order == "ASC":
+            messages.reverse()
+
+        return messages
+
+    async def __list_messages_account_keyset__(self, gamespace, account_id, limit, before, after, db=None):
+        condition, data, order = MessagesCursor.keyset(before, after)
+
+        try:
+            messages = await (db or self.read_db(gamespace, account_id)).query(
+                """
+                    (
+                        SELECT * 
+                        FROM `messages` 
+                        WHERE `messages`.`gamespace_id`=%s{0}
+                        AND (`messages`.`message_recipient_class`, `messages`.`message_recipient`) IN (
+                            SELECT `groups`.`group_class`, `groups`.`group_key` 
+                            FROM `groups`, `group_participants`
+                            WHERE `groups`.`group_class`=`messages`.`message_recipient_class` 
+                                AND `groups`.`group_key`=`messages`.`message_recipient`
+                                AND `groups`.`group_id`=`group_participants`.`group_id` 
+                                AND `group_participants`.`participation_account`=%s
+                        )
+                        ORDER BY `message_time` {1}, `message_id` {1}
+                        LIMIT %s
+                    )
+                    UNION DISTINCT
+                    (
+                        SELECT * 
+                        FROM `messages` 
+                        WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s{0}
+                        ORDER BY `message_time` {1}, `message_id` {1}
+                        LIMIT %s
+                    )
+                    UNION DISTINCT
+                    (
+                        SELECT * 
+                        FROM `messages` 
+                        WHERE `gamespace_id`=%s AND `message_sender`=%s{0}
+                        ORDER BY `message_time` {1}, `message_id` {1}
+                        LIMIT %s
+                    )
+                    ORDER BY `message_time` {1}, `message_id` {1}
+                    LIMIT %s;
+                """.format(condition, order),
+                gamespace, *data, str(account_id), limit,
+                gamespace, CLASS_USER, str(account_id), *data, limit,
+                gamespace, str(account_id), *data, limit,
+                limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+
+        messages = await load_messages(self.db, messages)
+
+        if order == "ASC":
+            messages.reverse()
+
+        return messages
+
+    async def read_incoming_messages(self, gamespace, recipient_class, recipient, receiver):
+        """
+        Drains the messages not delivered to the recipient yet, oldest first, in chunks of
+            'message_incoming_chunk_size'. Each chunk is claimed (marked as delivered) in a short transaction
+            of its own, then passed to the receiver all at once (so the sends are pipelined, not awaited one
+            by one). The messages not received are released (marked as not delivered) afterwards, and the
+            received ones are removed if they have to be. So the rows stay unlocked while the messages are
+            being sent, the new messages of the recipient can be stored meanwhile, and two connections of
+            the same recipient never deliver the same message both.
+
+        :param receiver: a coroutine that accepts a MessageAdapter, returns True if the message has been received
+        """
+
+        last_id = 0
+
+        while True:
+            try:
+                messages = await self.__claim_incoming_messages__(gamespace, recipient_class, recipient, last_id)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to read incoming messages: " + e.args[1])
+
+            if not messages:
+                return
+
+            messages = await load_messages(self.db, messages)
+            last_id = messages[-1].message_id
+
+            received = await multi([receiver(m) for m in messages])
+
+            release_ids = []
+            remove_ids = []
+
+            for m, recv in zip(messages, received):
+                if not recv:
+                    release_ids.append(m.message_id)
+                elif MessageFlags.REMOVE_DELIVERED in m.flags:
+                    remove_ids.append(m.message_id)
+
+            if release_ids or remove_ids:
+                try:
+                    async with self.db.acquire(auto_commit=False) as db:
+                        try:
+                            if release_ids:
+                                await db.execute(
+                                    """
+                                        UPDATE `messages`
+                                        SET `message_delivered`=0
+                                        WHERE `gamespace_id`=%s AND `message_id` IN %s;
+                                    """, gamespace, release_ids)
+
+                            if remove_ids:
+                                await self.__delete_messages__(
+                                    """
+                                        `messages`.`gamespace_id`=%s AND `messages`.`message_id` IN %s
+                                    """, gamespace, remove_ids, db=db)
+
+                            await db.commit()
+                        except DatabaseError:
+                            # the connection goes back into the pool, so does the transaction otherwise
+                            await db.rollback()
+                            raise
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to mark incoming messages as delivered: " + e.args[1])
+
+            if len(release_ids) == len(messages):
+                # the receiver is gone, the rest will be delivered next time
+                return
+
+            if len(messages) < self.incoming_chunk_size:
+                return
+
+    async def __claim_incoming_messages__(self, gamespace, recipient_class, recipient, last_id):
+        """
+        Marks the next chunk of the messages not delivered to the recipient as delivered.
+            The locking read waits for the other connection claiming the same messages, and skips what it has
+            claimed once it commits.
+
+        :returns: the messages claimed, as selected
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
                 messages = await db.query(
                     """
                         SELECT *
                         FROM `messages`
-                        WHERE `message_recipient_class`=%s AND `message_recipient`=%s
-                            AND `gamespace_id`=%s AND `message_delivered`=0
+                        WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                            AND `message_delivered`=0 AND `message_id`>%s
+                        ORDER BY `message_id` ASC
+                        LIMIT %s
                         FOR UPDATE;
-                    """, recipient_class, recipient, gamespace)
-
-                mark_delivered_ids = []
-                remove_ids = []
+                    """, gamespace, recipient_class, recipient, last_id, self.incoming_chunk_size)
 
-                for m in map(MessageAdapter, messages):
-                    recv = await receiver(m)
-                    if recv:
-                        if MessageFlags.REMOVE_DELIVERED in m.flags:
-                            remove_ids.append(m.message_id)
-                        else:
-                            mark_delivered_ids.append(m.message_id)
-
-                if mark_delivered_ids:
-                    await db.query(
+                if messages:
+                    await db.execute(
                         """
                             UPDATE `messages`
                             SET `message_delivered`=1
                             WHERE `gamespace_id`=%s AND `message_id` IN %s;
-                        """, gamespace, mark_delivered_ids
-                    )
+                        """, gamespace, [message["message_id"] for message in messages])
 
-                if remove_ids:
-                    await db.query(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_id` IN %s;
-                        """, gamespace, remove_ids
-                    )
+                await db.commit()
+            except DatabaseError:
+                await db.rollback()
+                raise
+
+        return messages
 
+    async def __delete_messages__(self, condition, *args, db=None, changed=True):
+        """
+        Deletes the messages matching the condition, along with their counts
+        :param changed: whether the deletion is recorded into the change log of the accounts
+        """
+
+        if db is not None:
+            # the accounts are only known while the messages are there
+            seen = await self.__seen__(db, condition, *args) if changed and self.sync_log else None
+
+            await self.__messages_removed__(db, condition, *args)
+            await self.__payloads_removed__(db, condition, *args)
+            await db.execute(
+                """
+                    DELETE FROM `messages`
+                    WHERE {0};
+                """.format(condition), *args)
+
+            # recorded last, so the changes are committed as soon as possible after they're numbered
+            if seen:
+                await self.__changes_recorded__(db, MessagesHistoryModel.CHANGE_DELETED, seen)
+            return
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                await self.__delete_messages__(condition, *args, db=db, changed=changed)
                 await db.commit()
+            except DatabaseError:
+                await db.rollback()
+                raise
 
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to read incoming messages: " + e.args[1])
+    async def delete_messages_by_id(self, message_ids, db=None, changed=True):
+        """
+        Deletes the messages of the given ids, along with their counts
+        """
+
+        await self.__delete_messages__(
+            """
+                `messages`.`message_id` IN %s
+            """, message_ids, db=db, changed=changed)
 
     async def delete_messages(self, gamespace, recipient_class, recipient):
         try:
-            await self.db.execute(
+            await self.__delete_messages__(
                 """
-                    DELETE FROM `messages`
-                    WHERE `message_recipient_class`=%s AND `message_recipient`=%s AND `gamespace_id`=%s;
+                    `messages`.`message_recipient_class`=%s AND `messages`.`message_recipient`=%s
+                        AND `messages`.`gamespace_id`=%s
                 """, recipient_class, recipient, gamespace)
         except DatabaseError as e:
             raise MessageError(500, "Failed to delete messages: " + e.args[1])
 
+        await self.app.recent_messages.invalidate(gamespace, recipient_class, recipient)
+
     async def delete_messages_like(self, gamespace, recipient_class, recipient_like):
         try:
-            await self.db.execute(
+            await self.__delete_messages__(
                 """
-                    DELETE FROM `messages`
-                    WHERE `message_recipient_class` LIKE %s AND `message_recipient`=%s AND `gamespace_id`=%s;
+                    `messages`.`message_recipient_class` LIKE %s AND `messages`.`message_recipient`=%s
+                        AND `messages`.`gamespace_id`=%s
                 """, recipient_class, recipient_like, gamespace)
         except DatabaseError as e:
             raise MessageError(500, "Failed to delete messages: " + e.args[1])
 
+        await self.app.recent_messages.invalidate(gamespace)
+
     async def delete_message(self, gamespace, message_id):
         try:
-            await self.db.execute(
+            await self.__delete_messages__(
                 """
-                    DELETE FROM `messages`
-                    WHERE `message_id`=%s AND `gamespace_id`=%s;
+                    `messages`.`message_id`=%s AND `messages`.`gamespace_id`=%s
                 """, message_id, gamespace)
         except DatabaseError as e:
             raise MessageError(500, "Failed to delete a message: " + e.args[1])
 
+        await self.app.recent_messages.invalidate(gamespace)
+
     async def delete_message_concurrent(self, gamespace, sender, message_uuid):
+        self.app.replicas.written(gamespace, sender)
+
         async with self.db.acquire(auto_commit=False) as db:
             try:
                 message = await db.get(
@@ -489,25 +2125,26 @@ class MessagesHistoryModel(Model):
                 await self.app.message_queue.delete_message(
                     gamespace, sender, message_type, message_recipient_class, message_recipient, message_uuid)
 
-                await db.execute(
+                await self.__delete_messages__(
                     """
-                        DELETE FROM `messages`
-                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                        LIMIT 1;
-                    """, message_uuid, gamespace)
+                        `messages`.`message_uuid`=%s AND `messages`.`gamespace_id`=%s
+                    """, message_uuid, gamespace, db=db)
 
             except DatabaseError as e:
                 raise MessageError(500, "Failed to delete a message: " + e.args[1])
             finally:
                 await db.commit()
 
+        await self.app.recent_messages.invalidate(gamespace, message_recipient_class, message_recipient)
+
     async def update_message_concurrent(self, gamespace, sender, message_uuid, update):
+        self.app.replicas.written(gamespace, sender)
+
         async with self.db.acquire(auto_commit=False) as db:
             try:
                 message = await db.get(
                     """
-                        SELECT `message_recipient_class`, `message_recipient`, `message_payload`, 
-                            `message_flags`, `message_sender`, `message_type`
+                        SELECT *
                         FROM `messages`
                         WHERE `message_uuid`=%s AND `gamespace_id`=%s
                         LIMIT 1
@@ -529,6 +2166,13 @@ class MessagesHistoryModel(Model):
                 message_payload = message["message_payload"]
                 message_type = message["message_type"]
 
+                # the message gets a payload of its own once edited
+                shared = message.get("message_payload_hash")
+
+                if shared:
+                    message_payload = (await load_messages(db, [message]))[0].payload
+                    await self.__payloads_removed__(db, "`messages`.`message_id`=%s", message["message_id"])
+
                 try:
                     updated = Profile.merge_data(message_payload, update, None, merge=True)
                 except ProfileError as e:
@@ -541,19 +2185,26 @@ class MessagesHistoryModel(Model):
                 await db.execute(
                     """
                         UPDATE `messages`
-                        SET `message_payload`=%s
+                        SET `message_payload`=%s{0}
                         WHERE `message_uuid`=%s AND `gamespace_id`=%s
                         LIMIT 1;
-                    """, ujson.dumps(updated), message_uuid, gamespace)
+                    """.format(", `message_payload_hash`=NULL" if shared else ""),
+                    ujson.dumps(updated), message_uuid, gamespace)
+
+                if self.sync_log:
+                    await self.__changed__(
+                        db, MessagesHistoryModel.CHANGE_UPDATED, "`messages`.`message_id`=%s", message["message_id"])
 
             except DatabaseError as e:
                 raise MessageError(500, "Failed to delete a message: " + e.args[1])
             finally:
                 await db.commit()
 
+        await self.app.recent_messages.invalidate(gamespace, message_recipient_class, message_recipient)
+
     async def list_read_messages(self, gamespace_id, account_id, db=None):
         try:
-            read_messages = await (db or self.db).query(
+            read_messages = await (db or self.read_db(gamespace_id, account_id)).query(
                 """
                     SELECT *
                     FROM `last_read_message`
@@ -579,9 +2230,11 @@ class MessagesHistoryModel(Model):
         if not message:
             raise MessageNotFound()
 
-        return MessageAdapter(message)
+        return (await load_messages(self.db, [message]))[0]
 
     async def mark_message_as_read(self, gamespace, account_id, message_uuid):
+        self.app.replicas.written(gamespace, account_id)
+
         async with self.db.acquire() as db:
             try:
                 message = await db.get(
@@ -619,9 +2272,104 @@ class MessagesHistoryModel(Model):
                 """, gamespace, account_id, recipient_class, recipient, time, message_uuid
             )
 
+            if self.conversation_keys_maintained and message.get("message_conversation_key"):
+                try:
+                    await self.__conversation_read__(
+                        db, gamespace, account_id, message["message_conversation_key"], time)
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to update a conversation: " + e.args[1])
+
             return bool(rows_updated)
 
+    async def mark_messages_as_read(self, gamespace, account_id, message_uuids):
+        """
+        Marks a bunch of messages as read at once: only the newest message of each recipient is taken into
+            account, and the markers of all the recipients are updated with a single multi-row upsert.
+            Unknown messages are ignored.
+
+        :returns: amount of the recipients the markers have been set for
+        """
+
+        self.app.replicas.written(gamespace, account_id)
+
+        message_uuids = list(set(message_uuids))
+
+        if not message_uuids:
+            return 0
+
+        try:
+            async with self.db.acquire() as db:
+                messages = await db.query(
+                    """
+                        SELECT `message_uuid`, `message_recipient_class`, `message_recipient`, `message_time`{0}
+                        FROM `messages`
+                        WHERE `gamespace_id`=%s AND `message_uuid` IN %s;
+                    """.format(", `message_conversation_key`" if self.conversation_keys_maintained else ""),
+                    gamespace, message_uuids)
+
+                newest = {}
+
+                for message in messages:
+                    key = (message["message_recipient_class"], message["message_recipient"])
+                    marker = newest.get(key)
+                    if marker is None or message["message_time"] > marker["message_time"]:
+                        newest[key] = message
+
+                if not newest:
+                    return 0
+
+                rows = []
+                values = []
+
+                for (recipient_class, recipient), message in newest.items():
+                    rows.append("(%s, %s, %s, %s, %s, %s)")
+                    values.extend([gamespace, account_id, recipient_class, recipient,
+                                   message["message_time"], message["message_uuid"]])
+
+                # unlike 'mark_message_as_read', the uuid is not replaced with an older one either
+                #   (the uuid goes first, as the assignments see the values updated before them)
+                await db.execute(
+                    """
+                        INSERT INTO `last_read_message`
+                        (gamespace_id, account_id, message_recipient_class,
+                            message_recipient, last_message_time, last_message_uuid)
+                        VALUES {0}
+                        ON DUPLICATE KEY UPDATE
+                            last_message_uuid = IF(
+                                VALUES(last_message_time) > last_message_time,
+                                VALUES(last_message_uuid),
+                                last_message_uuid
+                            ),
+                            last_message_time = IF(
+                                VALUES(last_message_time) > last_message_time,
+                                VALUES(last_message_time),
+                                last_message_time
+                            );
+                    """.format(", ".join(rows)), *values)
+
+                # both directions of a direct conversation have the same key
+                conversations = {}
+
+                for message in newest.values():
+                    conversation_key = message.get("message_conversation_key")
+                    if not conversation_key:
+                        continue
+                    time = conversations.get(conversation_key)
+                    if time is None or message["message_time"] > time:
+                        conversations[conversation_key] = message["message_time"]
+
+                for conversation_key, time in conversations.items():
+                    await self.__conversation_read__(db, gamespace, account_id, conversation_key, time)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to mark messages as read: " + e.args[1])
+
+        return len(newest)
+
 
 class MessageNotFound(Exception):
     pass
 
+
+class MessageDuplicateError(MessageError):
+    pass
+
@@ -0,0 +1,42 @@
+from anthill.common.options import options
+
+from . import MessageError
+from . batch import BatchWriter
+
+import logging
+
+
+class ReadMarkersBuffer(object):
+
+    """
+    A write-behind buffer of the messages an account (connected over a single conversation) reports as read.
+
+    The messages are collected for up to 'message_read_flush_interval' seconds (or until there is
+    'message_read_flush_size' of them), then only the newest one for each recipient is written, with a single
+    multi-row upsert, see 'mark_messages_as_read'. The buffer has to be flushed once the conversation is over.
+    """
+
+    def __init__(self, history, gamespace, account_id):
+        self.history = history
+        self.gamespace = gamespace
+        self.account_id = account_id
+
+        self.writer = BatchWriter(
+            self.__flush__,
+            options.message_read_flush_size,
+            options.message_read_flush_interval)
+
+    def mark(self, message_uuid):
+        self.writer.add(message_uuid)
+
+    def flush(self):
+        return self.writer.flush()
+
+    async def __flush__(self, message_uuids):
+        try:
+            await self.history.mark_messages_as_read(self.gamespace, self.account_id, message_uuids)
+        except MessageError as e:
+            logging.error("Failed to mark {0} message(s) of account {1} as read: {2}".format(
+                len(message_uuids), self.account_id, e.message))
+
+        return [None] * len(message_uuids)
@@ -18,9 +18,10 @@ class BindError(Exception):
 
 
 class OnlineModel(Model):
-    def __init__(self, groups, history):
+    def __init__(self, groups, history, presence):
         self.groups = groups
         self.history = history
+        self.presence = presence
 
         self.groups.online = self
 
@@ -83,6 +84,12 @@ class OnlineModel(Model):
                 exchange_type='fanout',
                 auto_delete=True)
 
+            delivery_exchange = await channel.exchange(
+                exchange=AccountConversation.DELIVERY_EXCHANGE,
+                exchange_type='direct',
+                durable=True)
+
             await account_online.bind(exchange=group_exchange)
+            await group_exchange.bind(exchange=delivery_exchange, routing_key=group_exchange_name)
         finally:
             channel.close()
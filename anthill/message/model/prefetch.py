@@ -0,0 +1,69 @@
+class AdaptivePrefetch(object):
+
+    """
+    Adjusts the prefetch count of the incoming consumer, depending on how fast the messages are processed.
+
+    When the average processing latency goes above the target (say, the database is slow), the prefetch is cut
+    down multiplicatively, so the worker does not hold the messages it cannot process anyway. When the latency
+    is fine and the worker is busy with almost as many messages as the prefetch allows, the prefetch is raised
+    step by step. The prefetch always stays within [minimum, maximum].
+
+    If not adaptive, the prefetch stays the initial one, as configured, and is not limited by [minimum, maximum].
+    """
+
+    DECREASE_FACTOR = 0.75
+    INCREASE_STEP = 4
+    BUSY_RATIO = 0.8
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, initial, minimum, maximum, target_latency, adaptive=True):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.target_latency = target_latency
+        self.adaptive = adaptive
+
+        if adaptive:
+            self.prefetch_count = min(max(initial, self.minimum), self.maximum)
+        else:
+            self.prefetch_count = initial
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.latency = 0.0
+        self.processed_count = 0
+
+    def received(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def processed(self, latency):
+        self.in_flight -= 1
+        self.processed_count += 1
+        self.latency += (latency - self.latency) * AdaptivePrefetch.LATENCY_SMOOTHING
+
+    def update(self):
+        """
+        Called periodically to calculate a new prefetch count.
+        :returns: True if the prefetch count has been changed
+        """
+
+        old = self.prefetch_count
+
+        if not self.adaptive:
+            return False
+
+        if self.processed_count and self.latency > self.target_latency:
+            self.prefetch_count = max(int(old * AdaptivePrefetch.DECREASE_FACTOR), self.minimum)
+        elif self.peak_in_flight >= old * AdaptivePrefetch.BUSY_RATIO:
+            self.prefetch_count = min(old + AdaptivePrefetch.INCREASE_STEP, self.maximum)
+
+        self.peak_in_flight = self.in_flight
+        self.processed_count = 0
+
+        return self.prefetch_count != old
+
+    def dump(self):
+        return {
+            "prefetch_count": self.prefetch_count,
+            "in_flight": self.in_flight,
+            "latency": self.latency
+        }
@@ -0,0 +1,173 @@
+from tornado.ioloop import PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . import CLASS_USER
+from . conversation import AccountConversation
+
+import logging
+import time
+import uuid
+
+
+class PresenceModel(Model):
+
+    """
+    A registry of the account exchanges ('conv.user.<account>') currently bound on every node of the service,
+    so the incoming queue worker can skip live delivery to the accounts known to be offline, and store
+    the message straight away.
+
+    Each node announces the exchanges its conversations bind and release over a broker fanout, and
+    periodically broadcasts a snapshot of its own ones, so a node that has just started catches up, and the
+    exchanges of a node that went away expire. Until a node has seen the snapshots of the others it knows
+    nothing, so nobody is considered offline.
+
+    Group exchanges are not tracked, as accounts get bound to them by any node (see 'join_group'). The
+    delivery to an offline group is returned by the broker immediately anyway.
+    """
+
+    CHANNEL = "message_presence"
+
+    def __init__(self):
+        self.enabled = options.message_presence
+        self.sync_interval = options.message_presence_sync_interval
+
+        self.node_id = str(uuid.uuid4())
+
+        # exchange -> amount of conversations on this node that have bound it
+        self.local = {}
+        # node_id -> (set of exchanges, last seen time)
+        self.nodes = {}
+
+        self.started_at = None
+        self.publisher = None
+        self.subscriber = None
+        self.sync_callback = None
+
+    async def started(self, application):
+        if not self.enabled:
+            return
+
+        self.started_at = time.time()
+
+        # noinspection PyBroadException
+        try:
+            self.subscriber = await application.acquire_custom_subscriber("message.presence", round_robin=False)
+            await self.subscriber.handle(PresenceModel.CHANNEL, self.__on_event__)
+            self.publisher = await application.acquire_custom_publisher("message.presence")
+        except Exception:
+            logging.exception("Failed to start presence registry")
+            self.enabled = False
+            return
+
+        self.sync_callback = PeriodicCallback(self.__sync__, self.sync_interval * 1000)
+        self.sync_callback.start()
+
+        await self.__publish__(snapshot=list(self.local.keys()))
+
+        logging.info("Started presence registry")
+
+    async def stopped(self):
+        if self.sync_callback:
+            self.sync_callback.stop()
+            self.sync_callback = None
+
+        if self.publisher:
+            await self.__publish__(leave=True)
+            await self.publisher.release()
+            self.publisher = None
+
+        if self.subscriber:
+            await self.subscriber.release()
+            self.subscriber = None
+
+    @staticmethod
+    def __exchange__(account_id):
+        return AccountConversation.__id__(CLASS_USER, account_id)
+
+    async def account_bound(self, account_id):
+        exchange = PresenceModel.__exchange__(account_id)
+        count = self.local.get(exchange, 0)
+        self.local[exchange] = count + 1
+
+        if not count:
+            await self.__publish__(bind=exchange)
+
+    async def account_released(self, account_id):
+        exchange = PresenceModel.__exchange__(account_id)
+        count = self.local.get(exchange, 0) - 1
+
+        if count > 0:
+            self.local[exchange] = count
+            return
+
+        self.local.pop(exchange, None)
+        await self.__publish__(unbind=exchange)
+
+    def is_offline(self, recipient_class, recipient_key):
+        """
+        :returns: True only if the recipient is known for sure not to be bound on any node
+        """
+
+        if not self.enabled or self.publisher is None:
+            return False
+
+        if recipient_class != CLASS_USER:
+            return False
+
+        if time.time() - self.started_at < self.sync_interval * 2:
+            return False
+
+        exchange = PresenceModel.__exchange__(recipient_key)
+
+        if exchange in self.local:
+            return False
+
+        for exchanges, last_seen in self.nodes.values():
+            if exchange in exchanges:
+                return False
+
+        return True
+
+    async def __publish__(self, **event):
+        if self.publisher is None:
+            return
+
+        event["node"] = self.node_id
+
+        # noinspection PyBroadException
+        try:
+            await self.publisher.publish(PresenceModel.CHANNEL, event)
+        except Exception:
+            logging.exception("Failed to publish presence")
+
+    async def __sync__(self):
+        expire = time.time() - self.sync_interval * 3
+
+        for node_id in [node_id for node_id, (exchanges, last_seen) in self.nodes.items() if last_seen < expire]:
+            logging.info("Presence of node {0} expired".format(node_id))
+            del self.nodes[node_id]
+
+        await self.__publish__(snapshot=list(self.local.keys()))
+
+    async def __on_event__(self, event):
+        node_id = event.get("node")
+
+        if not node_id or node_id == self.node_id:
+            return
+
+        if event.get("leave"):
+            self.nodes.pop(node_id, None)
+            return
+
+        exchanges, last_seen = self.nodes.get(node_id, (set(), None))
+
+        if "snapshot" in event:
+            exchanges = set(event["snapshot"])
+        elif "bind" in event:
+            exchanges.add(event["bind"])
+        elif "unbind" in event:
+            exchanges.discard(event["unbind"])
+
+        self.nodes[node_id] = (exchanges, time.time())
@@ -0,0 +1,162 @@
+from tornado.gen import Future
+from tornado.locks import Semaphore, Lock
+
+import logging
+import pika
+
+
+class ConfirmPublisherChannel(object):
+
+    """
+    A long-lived channel in confirm mode. Every publish is assigned a delivery tag (the broker numbers
+    them sequentially starting from 1 once the confirm mode is enabled), so acks and nacks, including
+    the 'multiple' ones, are matched to the pending futures, allowing many publishes in flight at once.
+
+    The amount of publishes in flight is limited by 'max_in_flight'.
+    """
+
+    def __init__(self, connection, max_in_flight, on_return=None):
+        self.connection = connection
+        self.max_in_flight = max_in_flight
+        self.on_return = on_return
+
+        self.channel = None
+        self.delivery_tag = 0
+        self.pending = {}
+        self.slots = Semaphore(max_in_flight)
+
+    @property
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    async def open(self):
+        channel = await self.connection.channel()
+
+        channel.confirm_delivery(self.__on_confirm__)
+        channel.add_on_close_callback(self.__on_closed__)
+
+        if self.on_return:
+            channel.add_on_return_callback(self.on_return)
+
+        self.delivery_tag = 0
+        self.pending = {}
+        self.channel = channel
+
+    def close(self):
+        channel = self.channel
+        self.channel = None
+
+        self.__fail_pending__()
+
+        if channel and channel.is_open:
+            # noinspection PyBroadException
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+    async def publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        """
+        Publishes the body and waits for the broker to confirm it.
+        :returns: True if the broker has acked the publish, False otherwise
+        """
+
+        await self.slots.acquire()
+
+        try:
+            if not self.is_open:
+                return False
+
+            self.delivery_tag += 1
+            delivery_tag = self.delivery_tag
+
+            f = Future()
+            self.pending[delivery_tag] = f
+
+            try:
+                self.channel.basic_publish(
+                    exchange,
+                    routing_key,
+                    body,
+                    properties=properties,
+                    mandatory=mandatory)
+            except Exception:
+                self.pending.pop(delivery_tag, None)
+                raise
+
+            return await f
+        finally:
+            self.slots.release()
+
+    def __resolve__(self, delivery_tag, result):
+        f = self.pending.pop(delivery_tag, None)
+        if f is not None and not f.done():
+            f.set_result(result)
+
+    def __on_confirm__(self, m):
+        method = m.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+
+        if method.multiple:
+            for delivery_tag in [tag for tag in self.pending if tag <= method.delivery_tag]:
+                self.__resolve__(delivery_tag, acked)
+        else:
+            self.__resolve__(method.delivery_tag, acked)
+
+    def __fail_pending__(self):
+        pending = self.pending
+        self.pending = {}
+
+        for f in pending.values():
+            if not f.done():
+                f.set_result(False)
+
+    def __on_closed__(self, ch, reason, param):
+        logging.warning("Publisher channel closed: {0} {1}".format(reason, param))
+        self.channel = None
+        self.__fail_pending__()
+
+
+class ConfirmPublisherPool(object):
+
+    """
+    A fixed set of ConfirmPublisherChannel's, opened lazily and reopened once closed.
+    Each publish goes to the least busy channel.
+    """
+
+    def __init__(self, connection, channels_count, max_in_flight, on_return=None):
+        self.connection = connection
+        self.lock = Lock()
+        self.channels = [
+            ConfirmPublisherChannel(connection, max_in_flight, on_return=on_return)
+            for i in range(0, max(channels_count, 1))
+        ]
+
+    async def acquire(self):
+        channel = min(self.channels, key=lambda c: c.in_flight if c.is_open else 0)
+
+        if not channel.is_open:
+            async with self.lock:
+                if not channel.is_open:
+                    await channel.open()
+
+        return channel
+
+    async def publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        # noinspection PyBroadException
+        try:
+            channel = await self.acquire()
+            return await channel.publish(
+                exchange, routing_key, body,
+                properties=properties, mandatory=mandatory)
+        except Exception:
+            logging.exception("Failed to publish a message.")
+            return False
+
+    def release(self):
+        for channel in self.channels:
+            channel.close()
@@ -0,0 +1,356 @@
+from tornado.gen import sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+from anthill.common.options import options
+
+from . import MessageError, CLASS_USER
+
+import logging
+import ujson
+
+
+class PurgeJobAdapter(object):
+    def __init__(self, data):
+        self.job_id = data.get("job_id")
+        self.gamespace_id = data.get("gamespace_id")
+        self.kind = data.get("job_kind")
+        self.payload = data.get("job_payload")
+        if isinstance(self.payload, str):
+            self.payload = ujson.loads(self.payload)
+        self.status = data.get("job_status")
+        self.step = data.get("job_step", 0)
+        self.last_id = data.get("job_last_id", 0)
+        self.deleted = data.get("job_deleted", 0)
+        self.created = data.get("job_created")
+        self.updated = data.get("job_updated")
+        self.error = data.get("job_error")
+
+
+class PurgeModel(Model):
+
+    """
+    Background deletion of large amounts of data (everything of the deleted accounts, the history of the
+    deleted groups), so it does not happen in one huge DELETE that locks the tables for minutes.
+
+    A purge is recorded as a job in the 'purge_jobs' table, and consists of steps, each deleting the rows of
+    a single table matching a condition. A step deletes at most 'message_purge_chunk_size' rows at once, in a
+    transaction of its own (along with the progress of the job), and pauses for 'message_purge_pause' seconds
+    in between. The messages are deleted in the order of their ids, along with their counts.
+
+    Any node may pick a job up. While being processed, a job is kept alive by a heartbeat; if the node
+    processing it is gone (or has failed to proceed), the job is resumed by another one (or the same one,
+    once restarted) from the last chunk complete, once the heartbeat is 'message_purge_timeout' seconds old.
+    """
+
+    ACCOUNTS = "accounts"
+    GROUP_PARTICIPANTS = "group_participants"
+    GROUP = "group"
+
+    def __init__(self, db, history):
+        self.db = db
+        self.history = history
+
+        self.chunk_size = max(options.message_purge_chunk_size, 1)
+        self.pause = options.message_purge_pause
+        self.poll_interval = options.message_purge_poll_interval
+        self.timeout = options.message_purge_timeout
+
+        self.poll_callback = None
+        self.running = False
+        self.stopping = False
+
+    def get_setup_tables(self):
+        return ["purge_jobs"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(PurgeModel, self).started(application)
+
+        self.poll_callback = PeriodicCallback(self.__poll__, self.poll_interval * 1000)
+        self.poll_callback.start()
+
+        IOLoop.current().spawn_callback(self.__poll__)
+
+    async def stopped(self):
+        self.stopping = True
+
+        if self.poll_callback:
+            self.poll_callback.stop()
+            self.poll_callback = None
+
+    async def enqueue(self, gamespace, kind, payload):
+        """
+        Schedules a purge.
+        :param gamespace: the gamespace to purge the data of, or None to purge it from every gamespace
+        :param kind: ACCOUNTS, GROUP_PARTICIPANTS or GROUP, see 'steps'
+        """
+
+        try:
+            job_id = await self.db.insert(
+                """
+                    INSERT INTO `purge_jobs`
+                    (`gamespace_id`, `job_kind`, `job_payload`, `job_created`, `job_updated`)
+                    VALUES (%s, %s, %s, NOW(), NOW());
+                """, gamespace, kind, ujson.dumps(payload))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to schedule a purge: " + e.args[1])
+
+        # no need to wait for the next poll, if this node is idle
+        IOLoop.current().spawn_callback(self.__poll__)
+
+        return job_id
+
+    async def list_jobs(self, limit=100):
+        try:
+            jobs = await self.db.query(
+                """
+                    SELECT * FROM `purge_jobs`
+                    ORDER BY `job_id` DESC
+                    LIMIT %s;
+                """, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list purge jobs: " + e.args[1])
+
+        return list(map(PurgeJobAdapter, jobs))
+
+    def steps(self, job):
+        """
+        :returns: a list of (table, condition, arguments) of the rows the job deletes, in order
+        """
+
+        if job.gamespace_id is None:
+            where, args = "", []
+        else:
+            where, args = "`gamespace_id`=%s AND ", [job.gamespace_id]
+
+        if job.kind == PurgeModel.ACCOUNTS:
+            accounts = job.payload["accounts"]
+            account_keys = [str(account) for account in accounts]
+
+            return [
+                ("last_read_message", where + "`account_id` IN %s", [*args, accounts]),
+                ("account_inbox", where + "`account_id` IN %s", [*args, accounts]),
+                ("account_conversations", where + "`account_id` IN %s", [*args, accounts]),
+                ("messages", where + "`message_sender` IN %s", [*args, accounts]),
+                ("messages", where + "`message_recipient_class`=%s AND `message_recipient` IN %s",
+                 [*args, CLASS_USER, account_keys]),
+                # after the messages, as their deletion is recorded for the accounts themselves as well
+                ("message_changes", where + "`account_id` IN %s", [*args, accounts]),
+                ("message_counters", where + "`counter_kind`='account' AND `counter_key` IN %s",
+                 [*args, account_keys])
+            ]
+
+        if job.kind == PurgeModel.GROUP_PARTICIPANTS:
+            return [
+                ("group_participants", where + "`participation_account` IN %s", [*args, job.payload["accounts"]])
+            ]
+
+        if job.kind == PurgeModel.GROUP:
+            group_class = job.payload["group_class"]
+            group_key = job.payload["group_key"]
+
+            # the group itself, and each of its clusters
+            clusters = group_key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "-%"
+
+            return [
+                ("messages", where + "`message_recipient_class`=%s AND "
+                                     "(`message_recipient`=%s OR `message_recipient` LIKE %s)",
+                 [*args, group_class, group_key, clusters]),
+                ("message_counters", where + "`counter_kind`='recipient' AND `counter_class`=%s AND "
+                                             "(`counter_key`=%s OR `counter_key` LIKE %s)",
+                 [*args, group_class, group_key, clusters]),
+                ("account_conversations", where + "`conversation_class`=%s AND "
+                                                  "(`conversation_recipient`=%s OR `conversation_recipient` LIKE %s)",
+                 [*args, group_class, group_key, clusters])
+            ]
+
+        return []
+
+    async def __poll__(self):
+        if self.running or self.stopping:
+            return
+
+        self.running = True
+
+        try:
+            while not self.stopping:
+                job = await self.__claim__()
+
+                if job is None:
+                    return
+
+                await self.__run__(job)
+        except DatabaseError as e:
+            logging.error("Failed to process purge jobs: " + e.args[1])
+        finally:
+            self.running = False
+
+    async def __claim__(self):
+        async with self.db.acquire() as db:
+            job = await db.get(
+                """
+                    SELECT * FROM `purge_jobs`
+                    WHERE `job_status` IN ('pending', 'running')
+                        AND (`job_heartbeat` IS NULL OR `job_heartbeat`<NOW() - INTERVAL %s SECOND)
+                    ORDER BY `job_id` ASC
+                    LIMIT 1;
+                """, self.timeout)
+
+            if job is None:
+                return None
+
+            # someone else might have claimed it in the meantime
+            await db.execute(
+                """
+                    UPDATE `purge_jobs`
+                    SET `job_status`='running', `job_heartbeat`=NOW()
+                    WHERE `job_id`=%s
+                        AND (`job_heartbeat` IS NULL OR `job_heartbeat`<NOW() - INTERVAL %s SECOND);
+                """, job["job_id"], self.timeout)
+
+            claimed = await db.get(
+                """
+                    SELECT ROW_COUNT() AS `count`;
+                """)
+
+        if not claimed["count"]:
+            return None
+
+        return PurgeJobAdapter(job)
+
+    async def __run__(self, job):
+        steps = self.steps(job)
+
+        logging.info("Purging {0} (job {1}), step {2} of {3}".format(
+            job.kind, job.job_id, job.step + 1, len(steps)))
+
+        try:
+            while job.step < len(steps):
+                if self.stopping:
+                    await self.__release__(job)
+                    return
+
+                table, condition, args = steps[job.step]
+
+                if table == "messages":
+                    complete = await self.__purge_messages__(job, condition, args)
+                else:
+                    complete = await self.__purge_rows__(job, table, condition, args)
+
+                if complete:
+                    job.step += 1
+                    job.last_id = 0
+                else:
+                    await sleep(self.pause)
+
+            await self.db.execute(
+                """
+                    UPDATE `purge_jobs`
+                    SET `job_status`='done', `job_step`=%s, `job_heartbeat`=NULL, `job_error`=NULL,
+                        `job_updated`=NOW()
+                    WHERE `job_id`=%s;
+                """, job.step, job.job_id)
+        except DatabaseError as e:
+            # leave the heartbeat as it is, so the job is attempted again once it's timed out
+            logging.error("Failed to purge {0} (job {1}): {2}".format(job.kind, job.job_id, e.args[1]))
+
+            await self.db.execute(
+                """
+                    UPDATE `purge_jobs`
+                    SET `job_error`=%s, `job_updated`=NOW()
+                    WHERE `job_id`=%s;
+                """, e.args[1], job.job_id)
+            return
+
+        logging.info("Purged {0} (job {1}), {2} rows deleted".format(job.kind, job.job_id, job.deleted))
+
+        if job.kind != PurgeModel.GROUP_PARTICIPANTS:
+            await self.history.app.recent_messages.invalidate(job.gamespace_id)
+
+    async def __release__(self, job):
+        await self.db.execute(
+            """
+                UPDATE `purge_jobs`
+                SET `job_heartbeat`=NULL
+                WHERE `job_id`=%s;
+            """, job.job_id)
+
+    async def __progress__(self, db, job, deleted, last_id, complete):
+        job.deleted += deleted
+        job.last_id = last_id
+
+        await db.execute(
+            """
+                UPDATE `purge_jobs`
+                SET `job_step`=%s, `job_last_id`=%s, `job_deleted`=`job_deleted`+%s, `job_heartbeat`=NOW(),
+                    `job_updated`=NOW()
+                WHERE `job_id`=%s;
+            """, job.step + 1 if complete else job.step, 0 if complete else last_id, deleted, job.job_id)
+
+    async def __purge_rows__(self, job, table, condition, args):
+        """
+        Deletes a chunk of rows of the table
+        :returns: True if there's no more rows to delete
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                await db.execute(
+                    """
+                        DELETE FROM `{0}`
+                        WHERE {1}
+                        LIMIT %s;
+                    """.format(table, condition), *args, self.chunk_size)
+
+                deleted = await db.get(
+                    """
+                        SELECT ROW_COUNT() AS `count`;
+                    """)
+
+                deleted = deleted["count"]
+                complete = deleted < self.chunk_size
+
+                await self.__progress__(db, job, deleted, 0, complete)
+                await db.commit()
+            except DatabaseError:
+                # the connection goes back into the pool, so does the transaction (and its locks) otherwise
+                await db.rollback()
+                raise
+
+        return complete
+
+    async def __purge_messages__(self, job, condition, args):
+        """
+        Deletes a chunk of messages (in the order of their ids), along with their counts
+        :returns: True if there's no more messages to delete
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                messages = await db.query(
+                    """
+                        SELECT `message_id` FROM `messages`
+                        WHERE {0} AND `message_id`>%s
+                        ORDER BY `message_id` ASC
+                        LIMIT %s;
+                    """.format(condition), *args, job.last_id, self.chunk_size)
+
+                message_ids = [message["message_id"] for message in messages]
+
+                if message_ids:
+                    await self.history.delete_messages_by_id(message_ids, db=db)
+
+                complete = len(message_ids) < self.chunk_size
+
+                await self.__progress__(
+                    db, job, len(message_ids), message_ids[-1] if message_ids else job.last_id, complete)
+                await db.commit()
+            except DatabaseError:
+                await db.rollback()
+                raise
+
+        return complete
@@ -1,7 +1,6 @@
 
-from tornado.gen import Future, with_timeout, TimeoutError, convert_yielded
-from tornado.queues import Queue, QueueEmpty
-from tornado.ioloop import IOLoop
+from tornado.gen import Future, with_timeout, TimeoutError, convert_yielded, multi
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 from anthill.common.model import Model
 from anthill.common.rabbitconn import RabbitMQConnection
@@ -11,13 +10,18 @@ from anthill.common.access import utc_time
 
 from . import MessageSendError, MessageError
 from . conversation import AccountConversation, MessageFlags
+from . publisher import ConfirmPublisherPool
+from . batch import BatchWriter
+from . retry import MessagesRetry
+from . prefetch import AdaptivePrefetch
+from . dedupe import ProcessedMessages
 
 import logging
 import ujson
 import uuid
 import datetime
 import pytz
-import pika
+import random
 
 from pika import BasicProperties
 
@@ -28,6 +32,63 @@ class MessagesQueueError(Exception):
         self.requeue = requeue
 
 
+class IncomingShard(object):
+
+    """
+    One of the sharded incoming queues. A shard is consumed exclusively, so only one node processes it at a time,
+    keeping the messages of every recipient hashed into it in order.
+    """
+
+    def __init__(self, model, index):
+        self.model = model
+        self.index = index
+        self.name = "{0}.{1}".format(model.message_incoming_queue_name, index)
+
+        self.channel = None
+        self.queue = None
+        self.consumer = None
+
+        # the failed messages are retried within the shard, see MessagesQueueModel.__init__
+        self.retry = None
+
+    @property
+    def consuming(self):
+        return self.channel is not None and self.channel.is_open
+
+    async def consume(self):
+        channel = await self.model.connection.channel()
+        channel.add_on_close_callback(self.__closed__)
+        self.channel = channel
+
+        await channel.basic_qos(prefetch_count=self.model.prefetch.prefetch_count)
+
+        self.queue = await channel.queue(queue=self.name, durable=True)
+        # if the shard is being consumed by some other node, the broker would close the channel
+        self.consumer = await self.queue.consume(self.__on_message__, exclusive=True)
+
+    def __on_message__(self, channel, method, properties, body):
+        self.model.__on_message__(channel, method, properties, body, retry=self.retry)
+
+    def __closed__(self, ch, reason, param):
+        if self.channel is not None:
+            logging.info("Stopped consuming shard '{0}': {1} {2}".format(self.name, reason, param))
+
+        self.channel = None
+        self.queue = None
+        self.consumer = None
+
+    def release(self):
+        channel = self.channel
+        self.channel = None
+
+        if channel and channel.is_open:
+            # noinspection PyBroadException
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+
 class MessagesQueueModel(Model):
 
     """
@@ -38,18 +99,29 @@ class MessagesQueueModel(Model):
     2. That message goes into the incoming queue
     3. Then the message workers fetch the queue constantly for processing
     4. Upon processing, the message is tried to be delivered real time first, using recipient_class and recipient_key
-        as the queue name (such recipient should be listening on it if he's online)
+        as the routing key on the delivery exchange (such recipient should have his exchange bound to it
+        if he's online, otherwise the message is returned back)
     5. Then the message may be stored depending on the flags of the message itself and whenever it was delivered
 
     Same cycle applies for updating and deleting the message
 
+    In sharded mode (see 'message_incoming_shards' option) the incoming queue is split into several ones
+    behind a consistent-hash exchange, keyed by the recipient, and each node consumes only some of them.
+
     """
 
     DELIVERY_TIMEOUT = 5
     PROCESS_TIMEOUT = 60
+    SHARDS_ACQUIRE_INTERVAL = 10
+    PREFETCH_UPDATE_INTERVAL = 5
+    STATS_INTERVAL = 10
 
-    def __init__(self, history):
+    def __init__(self, history, presence, recent_messages, consume=True):
         self.history = history
+        self.presence = presence
+        self.recent_messages = recent_messages
+        # if False, messages are only published into the incoming queue, but not processed by this node
+        self.consume = consume
 
         self.connection = RabbitMQConnection(options.message_broker, connection_name="message.queue")
         self.channel = None
@@ -58,9 +130,67 @@ class MessagesQueueModel(Model):
         self.callback_queue = None
         self.handle_futures = {}
 
-        self.outgoing_message_workers = options.outgoing_message_workers
         self.message_incoming_queue_name = options.message_incoming_queue_name
-        self.message_prefetch_count = options.message_prefetch_count
+
+        self.application = None
+        self.prefetch = AdaptivePrefetch(
+            options.message_prefetch_count,
+            options.message_prefetch_min,
+            options.message_prefetch_max,
+            options.message_prefetch_target_latency / 1000.0,
+            adaptive=options.message_prefetch_adaptive)
+        self.prefetch_adaptive = options.message_prefetch_adaptive
+        self.prefetch_callback = None
+
+        self.processed = ProcessedMessages(options.message_dedupe_size)
+        # redelivered messages found to be stored already (while missing in the cache)
+        self.processed_stored = 0
+        self.stats_callback = None
+
+        self.message_incoming_exchange_name = self.message_incoming_queue_name + ".shards"
+        self.message_incoming_shards_per_node = options.message_incoming_shards_per_node
+        self.shards = [
+            IncomingShard(self, index)
+            for index in range(0, options.message_incoming_shards)
+        ]
+        self.shards_callback = None
+
+        # exchange_id -> a future of the latest delivery to it, so deliveries to the same recipient keep order
+        # (in sharded mode only)
+        self.deliveries = {}
+
+        self.publisher = ConfirmPublisherPool(
+            self.connection,
+            options.message_publisher_channels,
+            options.message_publisher_max_in_flight)
+
+        self.delivery = ConfirmPublisherPool(
+            self.connection,
+            options.message_delivery_channels,
+            options.message_delivery_max_in_flight,
+            on_return=self.__on_returned__)
+
+        self.retry = MessagesRetry(
+            self.message_incoming_queue_name,
+            self.publisher,
+            options.message_retry_attempts,
+            options.message_retry_delay)
+
+        # a failed message is retried through the delay queues of its own shard, so it goes back into that shard
+        #   (and the node consuming it), the dead letters of every shard are kept in the same queue though
+        for shard in self.shards:
+            shard.retry = MessagesRetry(
+                shard.name,
+                self.publisher,
+                options.message_retry_attempts,
+                options.message_retry_delay,
+                dead_queue_name=self.retry.dead_queue_name)
+
+        # stored messages are written in batches, each message is acknowledged once its batch is committed
+        self.store = BatchWriter(
+            self.history.add_messages,
+            options.message_store_batch_size,
+            options.message_store_batch_window / 1000.0)
 
         self.actions = {
             AccountConversation.ACTION_NEW_MESSAGE: self.__action_new_message__
@@ -69,26 +199,151 @@ class MessagesQueueModel(Model):
     # noinspection PyBroadException
     async def started(self, application):
 
+        self.application = application
+
         try:
             self.channel = await self.connection.channel()
 
-            await self.channel.basic_qos(prefetch_count=self.message_prefetch_count)
+            await self.channel.basic_qos(prefetch_count=self.prefetch.prefetch_count)
+
+            self.exchange = await self.channel.exchange(
+                exchange=AccountConversation.DELIVERY_EXCHANGE,
+                exchange_type='direct',
+                durable=True)
 
             self.queue = await self.channel.queue(queue=self.message_incoming_queue_name, durable=True)
+            await self.retry.declare(self.channel)
+
+            if self.shards:
+                await self.__declare_shards__()
+
+            if not self.consume:
+                logging.info("Started message queue (publishing only)")
+                return
+
             self.callback_queue = await self.channel.queue(exclusive=True)
 
             await self.queue.consume(self.__on_message__)
             await self.callback_queue.consume(self.__on_callback__, no_ack=True)
 
+            if self.shards:
+                await self.__start_shards__()
+
+            self.stats_callback = PeriodicCallback(
+                self.__report_stats__, MessagesQueueModel.STATS_INTERVAL * 1000)
+            self.stats_callback.start()
+
+            if self.prefetch_adaptive:
+                self.prefetch_callback = PeriodicCallback(
+                    self.__update_prefetch__, MessagesQueueModel.PREFETCH_UPDATE_INTERVAL * 1000)
+                self.prefetch_callback.start()
+
         except Exception:
             logging.exception("Failed to start message consuming queue")
         else:
             logging.info("Started message consuming queue")
 
+    async def __declare_shards__(self):
+        await self.channel.exchange(
+            exchange=self.message_incoming_exchange_name,
+            exchange_type='x-consistent-hash',
+            durable=True)
+
+        # every node declares every shard, so the messages are spread equally even if nobody consumes some
+        for shard in self.shards:
+            queue = await self.channel.queue(queue=shard.name, durable=True)
+            # for consistent-hash exchange the routing key of a binding is the weight of the queue
+            await queue.bind(exchange=self.message_incoming_exchange_name, routing_key="1")
+            await shard.retry.declare(self.channel)
+
+    async def __start_shards__(self):
+        await self.__acquire_shards__()
+
+        self.shards_callback = PeriodicCallback(
+            self.__acquire_shards__, MessagesQueueModel.SHARDS_ACQUIRE_INTERVAL * 1000)
+        self.shards_callback.start()
+
+        logging.info("Started sharded incoming queue ({0} shards)".format(len(self.shards)))
+
+    async def __acquire_shards__(self):
+        """
+        Tries to consume the shards nobody else consumes, until the 'message_incoming_shards_per_node' limit.
+        Shards are tried starting from a random one, so nodes tend to pick up different ones.
+        """
+
+        limit = self.message_incoming_shards_per_node or len(self.shards)
+        offset = random.randrange(len(self.shards))
+
+        for i in range(0, len(self.shards)):
+            if sum(1 for s in self.shards if s.consuming) >= limit:
+                break
+
+            shard = self.shards[(offset + i) % len(self.shards)]
+
+            if shard.consuming:
+                continue
+
+            # noinspection PyBroadException
+            try:
+                await shard.consume()
+            except Exception:
+                logging.exception("Failed to consume shard '{0}'".format(shard.name))
+                shard.release()
+
+    def __incoming_route__(self, recipient_class, recipient_key):
+        """
+        :returns: exchange and routing key to publish a message into the incoming queue with
+        """
+
+        if self.shards:
+            return self.message_incoming_exchange_name, AccountConversation.__id__(recipient_class, recipient_key)
+
+        return '', self.message_incoming_queue_name
+
+    # noinspection PyBroadException
+    async def __update_prefetch__(self):
+        if self.prefetch.update():
+            prefetch_count = self.prefetch.prefetch_count
+
+            logging.info("Incoming prefetch count changed to {0} (latency {1:.3f}s)".format(
+                prefetch_count, self.prefetch.latency))
+
+            channels = [self.channel] + [shard.channel for shard in self.shards if shard.consuming]
+
+            for channel in channels:
+                try:
+                    await channel.basic_qos(prefetch_count=prefetch_count)
+                except Exception:
+                    logging.exception("Failed to update prefetch count")
+
+        self.application.monitor_action("queue.prefetch", self.prefetch.dump())
+
+    def __report_stats__(self):
+        stats = self.processed.dump()
+        stats["stored"] = self.processed_stored
+        self.application.monitor_action("queue.dedupe", stats)
+
     async def stopped(self):
         logging.info("Releasing message consuming queue")
 
-        if self.queue:
+        if self.stats_callback:
+            self.stats_callback.stop()
+            self.stats_callback = None
+
+        if self.prefetch_callback:
+            self.prefetch_callback.stop()
+            self.prefetch_callback = None
+
+        if self.shards_callback:
+            self.shards_callback.stop()
+            self.shards_callback = None
+
+        for shard in self.shards:
+            shard.release()
+
+        await self.store.flush()
+
+        if self.queue and self.consume:
             await self.queue.delete()
 
         if self.channel:
@@ -98,12 +353,21 @@ class MessagesQueueModel(Model):
             except:
                 pass
 
+        self.publisher.release()
+        self.delivery.release()
+
         self.connection = None
 
         self.exchange = None
         self.queue = None
 
-    def __on_message__(self, channel, method, properties, body):
+    def __on_message__(self, channel, method, properties, body, retry=None):
+        """
+        :param retry: the MessagesRetry of the queue the message has been consumed from, the legacy one if None
+        """
+
+        retry = retry or self.retry
+
         try:
             coroutine = self.__process__(channel, method, properties, body)
         except MessagesQueueError as e:
@@ -113,30 +377,82 @@ class MessagesQueueModel(Model):
 
         f = convert_yielded(coroutine)
 
+        self.prefetch.received()
+        received_at = IOLoop.current().time()
+
         def process_callback(f):
+            self.prefetch.processed(IOLoop.current().time() - received_at)
+
             exc = f.exception()
             if exc:
                 logging.error("Failed to process incoming message: " + str(exc))
-                if isinstance(exc, MessagesQueueError):
-                    channel.basic_nack(delivery_tag=method.delivery_tag, requeue=exc.requeue)
-                else:
-                    channel.basic_nack(delivery_tag=method.delivery_tag)
+                requeue = exc.requeue if isinstance(exc, MessagesQueueError) else True
+                IOLoop.current().spawn_callback(
+                    self.__failed__, channel, method, properties, body, exc, requeue, retry)
             else:
                 channel.basic_ack(delivery_tag=method.delivery_tag)
 
         IOLoop.current().add_future(f, process_callback)
 
-    def __on_callback__(self, channel, method, properties, body):
+    async def __failed__(self, channel, method, properties, body, error, requeue, retry):
+        moved = await retry.failed(properties, body, error, retry=requeue)
 
-        message_uuid = properties.correlation_id
-        delivered = body == b'true'
-
-        try:
-            f = self.handle_futures.pop(message_uuid)
-        except KeyError:
-            pass
+        if moved:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
         else:
-            f.set_result(delivered)
+            # could not schedule a retry, fall back to the broker
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=requeue)
+
+    async def list_dead_letters(self, limit=100):
+        return await self.retry.browse(self.connection, limit)
+
+    async def replay_dead_letters(self, message_uuid=None, limit=100):
+        """
+        Puts the dead lettered messages back into the incoming queue, with their attempts reset.
+        :param message_uuid: replay only the message with that uuid, otherwise all of them (up to the limit)
+        :returns: an amount of messages replayed
+        """
+
+        properties = BasicProperties(
+            delivery_mode=2,
+        )
+
+        replayed = []
+
+        async def replay(letter):
+            if message_uuid and letter.message_uuid != message_uuid:
+                return False
+
+            if isinstance(letter.message, dict):
+                exchange, routing_key = self.__incoming_route__(letter.recipient_class, letter.recipient)
+            else:
+                exchange, routing_key = '', self.message_incoming_queue_name
+
+            result = await self.publisher.publish(
+                exchange, routing_key, letter.body, properties=properties, mandatory=True)
+
+            if result:
+                replayed.append(letter)
+
+            return result
+
+        await self.retry.browse(self.connection, limit, process=replay)
+        return len(replayed)
+
+    async def discard_dead_letters(self, message_uuid, limit=100):
+        """
+        Removes the dead lettered message with that uuid for good.
+        """
+
+        async def discard(letter):
+            return letter.message_uuid == message_uuid
+
+        letters = await self.retry.browse(self.connection, limit, process=discard)
+        return sum(1 for letter in letters if letter.message_uuid == message_uuid)
+
+    def __on_callback__(self, channel, method, properties, body):
+        delivered = body == b'true'
+        self.__resolve_delivery__(properties.correlation_id, delivered)
 
     async def __process__(self, channel, method, properties, body):
         try:
@@ -153,9 +469,43 @@ class MessagesQueueModel(Model):
         except KeyError as e:
             raise MessagesQueueError("Missing field: " + e.args[0], False)
 
+        message_uuid = message.get(AccountConversation.MESSAGE_UUID)
+
+        # only new messages are deduplicated, updates and deletes share the uuid of the message they apply to
+        dedupe = (action == AccountConversation.ACTION_NEW_MESSAGE) and message_uuid
+
+        if dedupe:
+            redelivered = method.redelivered or MessagesRetry.ATTEMPT_HEADER in (properties.headers or {})
+            if await self.__already_processed__(gamespace_id, message_uuid, redelivered):
+                logging.info("Message '{0}' has been processed already, skipping.".format(message_uuid))
+                return
+
         action_method = self.actions.get(action, self.__action_simple_deliver__)
         await action_method(gamespace_id, sender, recipient_class, recipient_key, message)
 
+        if dedupe:
+            self.processed.add(message_uuid)
+
+    async def __already_processed__(self, gamespace_id, message_uuid, redelivered):
+        if self.processed.check(message_uuid):
+            return True
+
+        if not redelivered:
+            return False
+
+        # the node that processed the message before might be gone, so the cache is empty,
+        # but the message could have been stored already
+        try:
+            exists = await self.history.message_exists(gamespace_id, message_uuid)
+        except MessageError as e:
+            raise MessagesQueueError(e.message, True)
+
+        if exists:
+            self.processed.add(message_uuid)
+            self.processed_stored += 1
+
+        return exists
+
     def __action_simple_deliver__(self, gamespace_id, sender, recipient_class, recipient_key, message):
         try:
             message_uuid = message[AccountConversation.MESSAGE_UUID]
@@ -184,8 +534,6 @@ class MessagesQueueModel(Model):
             logging.exception("Failed to deliver message")
             return
 
-        history = self.history
-
         flags = MessageFlags(message.get(AccountConversation.FLAGS, []))
 
         if MessageFlags.DO_NOT_STORE in flags:
@@ -194,157 +542,144 @@ class MessagesQueueModel(Model):
         if delivered and (MessageFlags.REMOVE_DELIVERED in flags):
             return delivered
 
+        message_time = datetime.datetime.fromtimestamp(time, tz=pytz.utc)
+
         try:
-            await history.add_message(
+            message_id = await self.store.add((
                 gamespace_id,
                 sender,
                 message_uuid,
                 str(recipient_class),
                 str(recipient_key),
-                datetime.datetime.fromtimestamp(time, tz=pytz.utc),
+                message_time,
                 message_type,
                 payload,
                 flags,
-                delivered=delivered)
+                delivered))
         except MessageError as e:
             raise MessagesQueueError(e.message, e.code >= 500)
 
+        # None means the message had been stored already
+        if message_id is not None:
+            await self.recent_messages.stored(
+                gamespace_id, message_id, message_uuid, sender, str(recipient_class), str(recipient_key),
+                message_time, message_type, payload, flags, delivered)
+
         return delivered
 
+    def __resolve_delivery__(self, correlation_id, delivered):
+        try:
+            f = self.handle_futures.pop(correlation_id)
+        except KeyError:
+            pass
+        else:
+            if not f.done():
+                f.set_result(delivered)
+
+    def __on_returned__(self, channel, method, properties, body):
+        # nobody has bound the recipient's exchange to the delivery one, meaning recipient is offline
+        self.__resolve_delivery__(properties.correlation_id, False)
+
     async def __deliver_message__(self, message_uuid, message_type, recipient_class, recipient_key, message):
 
         if not isinstance(message, dict):
             raise MessageSendError(400, "Payload message to be a dict")
 
+        if self.presence.is_offline(recipient_class, recipient_key):
+            logging.debug("Message '{0}' has not been delivered: recipient is offline.".format(message_uuid))
+            return False
+
         exchange_id = AccountConversation.__id__(recipient_class, recipient_key)
 
-        channel = await self.connection.channel()
+        if not self.shards:
+            delivered = await self.__deliver_message_to__(exchange_id, message_type, message)
+            logging.debug("Message '{0}' {1} been delivered.".format(
+                message_uuid, "has" if delivered else "has not"))
+            return delivered
+
+        # in sharded mode each recipient is processed by a single node, so deliveries to it are done in order
+        previous = self.deliveries.get(exchange_id)
+        done = Future()
+        self.deliveries[exchange_id] = done
 
         try:
-            f = Future()
+            if previous is not None:
+                await previous
 
-            def cancel_handle():
-                try:
-                    del self.handle_futures[message_uuid]
-                except KeyError:
-                    pass
-
-            def delivered_(m):
-                if not f.done():
-                    if not isinstance(m.method, pika.spec.Basic.Ack):
-                        cancel_handle()
-                        f.set_result(False)
-
-            def closed(ch, reason, param):
-                if not f.done():
-                    cancel_handle()
-                    f.set_result(False)
-
-            # add the future to the handles in case callback_queue will bring something
-            self.handle_futures[message_uuid] = f
-
-            channel.confirm_delivery(delivered_)
-            channel.add_on_close_callback(closed)
-
-            from pika import BasicProperties
-
-            dumped = ujson.dumps(message)
-
-            properties = BasicProperties(
-                content_type='text/plain',
-                reply_to=self.callback_queue.routing_key,
-                correlation_id=message_uuid,
-                headers={
-                    AccountConversation.TYPE: message_type
-                })
-
-            channel.basic_publish(
-                exchange_id,
-                '',
-                dumped,
-                properties=properties,
-                mandatory=True)
-
-            try:
-                delivered = await with_timeout(
-                    timeout=datetime.timedelta(seconds=MessagesQueueModel.DELIVERY_TIMEOUT),
-                    future=f)
-            except TimeoutError:
-                cancel_handle()
-                delivered = False
+            delivered = await self.__deliver_message_to__(exchange_id, message_type, message)
         finally:
-            if channel.is_open:
-                channel.close()
+            done.set_result(True)
+            if self.deliveries.get(exchange_id) is done:
+                del self.deliveries[exchange_id]
 
         logging.debug("Message '{0}' {1} been delivered.".format(message_uuid, "has" if delivered else "has not"))
 
         return delivered
 
-    # noinspection PyBroadException
-    async def __outgoing_message_worker__(self, gamespace, sender, queue):
-
-        channel = await self.connection.channel()
+    async def __deliver_message_to__(self, exchange_id, message_type, message):
 
-        properties = BasicProperties(
-            delivery_mode=2,
-        )
+        # each delivery attempt has its own correlation id, as same message_uuid may be
+        # delivered several times (for example, updated right after being sent)
+        correlation_id = str(uuid.uuid4())
 
-        class Wrapper(object):
-            future = None
+        f = Future()
+        self.handle_futures[correlation_id] = f
 
-        wrapped = Wrapper()
-
-        def delivered_(m):
-            import pika
-            f = wrapped.future
-            if not f or f.done():
-                return
-            f.set_result(isinstance(m.method, pika.spec.Basic.Ack))
+        properties = BasicProperties(
+            content_type='text/plain',
+            reply_to=self.callback_queue.routing_key,
+            correlation_id=correlation_id,
+            headers={
+                AccountConversation.TYPE: message_type
+            })
 
-        def closed(ch, reason, param):
-            f = wrapped.future
-            if not f or f.done():
-                return
-            f.set_result(False)
+        def confirmed(c):
+            if not c.result():
+                self.__resolve_delivery__(correlation_id, False)
 
-        channel.confirm_delivery(delivered_)
-        channel.add_on_close_callback(closed)
+        IOLoop.current().add_future(convert_yielded(self.delivery.publish(
+            AccountConversation.DELIVERY_EXCHANGE,
+            exchange_id,
+            ujson.dumps(message),
+            properties=properties,
+            mandatory=True)), confirmed)
 
         try:
-            while True:
-                wrapped.future = Future()
-
-                try:
-                    body = queue.get_nowait()
-                except QueueEmpty:
-                    return True
-
-                try:
-                    channel.basic_publish(
-                        '',
-                        self.message_incoming_queue_name,
-                        body,
-                        mandatory=True,
-                        properties=properties)
-                except Exception:
-                    logging.exception("Failed to public message.")
-
-                success = await wrapped.future
-                wrapped.future = None
-                queue.task_done()
-
-                if not success:
-                    return False
+            delivered = await with_timeout(
+                timeout=datetime.timedelta(seconds=MessagesQueueModel.DELIVERY_TIMEOUT),
+                future=f)
+        except TimeoutError:
+            delivered = False
         finally:
-            channel.close()
+            self.handle_futures.pop(correlation_id, None)
+
+        return delivered
 
     @validate(gamespace="int", sender="int", messages="json_list", authoritative="bool")
     async def add_messages(self, gamespace, sender, messages, authoritative=False):
+        """
+        Publishes a batch of messages into the incoming queue. The whole batch is pipelined over the
+            publisher channels, without waiting for every single message to be confirmed before sending the next.
 
-        out_queue = Queue()
+        :returns: a list of results, one for each message, in the same order:
+            {"uuid": <message uuid>, "success": <whenever the message has been accepted>}
+            or {"success": False, "error": <reason>} if the message is malformed
+        """
 
         time = utc_time()
 
+        # the messages are stored by a worker, but the sender reads them from this node
+        self.history.app.replicas.written(gamespace, sender)
+
+        properties = BasicProperties(
+            delivery_mode=2,  # make message persistent
+        )
+
+        results = []
+        accepted = []
+
+        # the whole batch is validated before anything is published, so a bad message does not fail the request
+        #   after the messages before it have been sent already
         for message in messages:
 
             try:
@@ -352,14 +687,16 @@ class MessagesQueueModel(Model):
                 recipient_key = message["recipient_key"]
                 message_type = message["message_type"]
                 payload = message["payload"]
-            except (KeyError, ValueError):
+            except (KeyError, ValueError, TypeError):
                 logging.error("A message '{0}' skipped since missing fields.".format(ujson.dumps(message)))
+                results.append({"success": False, "error": "Missing fields"})
                 continue
 
             flags_ = message.get("flags", [])
 
             if flags_ and not isinstance(flags_, list):
                 logging.error("A message '{0}' flags should be a list.".format(ujson.dumps(message)))
+                results.append({"success": False, "error": "Flags should be a list"})
                 continue
 
             flags = MessageFlags(flags_)
@@ -386,14 +723,32 @@ class MessagesQueueModel(Model):
                 AccountConversation.TIME: time
             })
 
-            out_queue.put_nowait(body)
+            result = {"uuid": message_uuid}
+            results.append(result)
 
-        workers_count = min(self.outgoing_message_workers, out_queue.qsize())
+            accepted.append((result, self.__incoming_route__(recipient_class, recipient_key), body))
 
-        for i in range(0, workers_count):
-            IOLoop.current().add_callback(self.__outgoing_message_worker__, gamespace, sender, out_queue)
+        publishes = [
+            (result, convert_yielded(self.publisher.publish(
+                exchange,
+                routing_key,
+                body,
+                properties=properties,
+                mandatory=True)))
+            for result, (exchange, routing_key), body in accepted
+        ]
+
+        try:
+            await with_timeout(
+                timeout=datetime.timedelta(seconds=MessagesQueueModel.PROCESS_TIMEOUT),
+                future=multi([f for result, f in publishes]))
+        except TimeoutError:
+            logging.error("Timed out while publishing a batch of {0} messages.".format(len(publishes)))
 
-        await out_queue.join(timeout=datetime.timedelta(seconds=MessagesQueueModel.PROCESS_TIMEOUT))
+        for result, f in publishes:
+            result["success"] = f.done() and f.result()
+
+        return results
 
     @validate(gamespace="int", sender="int", recipient_class="str",
               recipient_key="str", message_type="str", payload="json_dict",
@@ -408,6 +763,8 @@ class MessagesQueueModel(Model):
         if authoritative:
             flags.set(MessageFlags.SERVER)
 
+        self.history.app.replicas.written(gamespace, sender)
+
         message_uuid = str(uuid.uuid4())
 
         message = {
@@ -461,42 +818,19 @@ class MessagesQueueModel(Model):
     @validate(message="json_dict")
     async def __enqueue_message__(self, message):
 
-        channel = await self.connection.channel()
-
         properties = BasicProperties(
             delivery_mode=2,  # make message persistent
         )
 
-        # noinspection PyBroadException
-        try:
-            body = ujson.dumps(message)
-
-            f = Future()
-
-            def delivered_(m):
-                import pika
-                if not f.done():
-                    f.set_result(isinstance(m.method, pika.spec.Basic.Ack))
+        body = ujson.dumps(message)
 
-            def closed(ch, reason, param):
-                if not f.done():
-                    f.set_result(False)
-
-            channel.confirm_delivery(delivered_)
-            channel.add_on_close_callback(closed)
-
-            channel.basic_publish(
-                '',
-                self.message_incoming_queue_name,
-                body,
-                mandatory=True,
-                properties=properties)
-
-            result = await f
-        except Exception as e:
-            logging.exception("Failed to public message.")
-            result = False
-        finally:
-            channel.close()
+        exchange, routing_key = self.__incoming_route__(
+            message[AccountConversation.RECIPIENT_CLASS],
+            message[AccountConversation.RECIPIENT_KEY])
 
-        return result
+        return await self.publisher.publish(
+            exchange,
+            routing_key,
+            body,
+            properties=properties,
+            mandatory=True)
@@ -0,0 +1,259 @@
+from tornado.ioloop import PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from . import CLASS_USER
+from . history import MessageAdapter, MessagesQuery
+
+from collections import OrderedDict, deque
+
+import datetime
+import logging
+import time
+
+
+class RecentMessages(object):
+    def __init__(self, size, messages, count):
+        # newest first
+        self.messages = deque(messages, maxlen=size)
+        self.uuids = set(message.message_uuid for message in self.messages)
+        self.count = count
+        self.filled = time.time()
+
+    def add(self, message):
+        if message.message_uuid in self.uuids:
+            return
+
+        if len(self.messages) == self.messages.maxlen:
+            self.uuids.discard(self.messages[-1].message_uuid)
+
+        self.messages.appendleft(message)
+        self.uuids.add(message.message_uuid)
+
+        if self.count is not None:
+            self.count += 1
+
+
+class RecentMessagesModel(Model):
+
+    """
+    An in-process cache of the last messages sent to the groups (recipients other than accounts), so the
+    inbox of a large group, polled by all of its members, is not queried from the database over and over.
+
+    The cache is read-through: a recipient is cached once its inbox is requested. The node that stores a message
+    announces it over a broker fanout, so every node adds it to the recipient's messages, if it has them
+    cached. Updates and deletions of messages invalidate the recipient on every node the same way. In case an
+    announcement is lost, each recipient is refilled from the database every 'message_recent_cache_ttl' seconds.
+    """
+
+    CHANNEL = "message_recent"
+    STATS_INTERVAL = 10
+
+    def __init__(self, history):
+        self.history = history
+
+        self.enabled = options.message_recent_cache
+        self.size = options.message_recent_cache_size
+        self.max_recipients = options.message_recent_cache_recipients
+        self.ttl = options.message_recent_cache_ttl
+
+        # (gamespace, recipient_class, recipient) -> RecentMessages, least recently used first
+        self.recipients = OrderedDict()
+
+        # the recipients being filled at the moment -> amount of fills, and the sequence of the last change
+        #   seen for each of them, to drop the fills raced by a change
+        self.filling = {}
+        self.changed = {}
+        self.sequence = 0
+
+        self.publisher = None
+        self.subscriber = None
+        self.stats_callback = None
+
+        self.hits = 0
+        self.misses = 0
+
+    async def started(self, application):
+        if not self.enabled:
+            return
+
+        # noinspection PyBroadException
+        try:
+            self.subscriber = await application.acquire_custom_subscriber("message.recent", round_robin=False)
+            await self.subscriber.handle(RecentMessagesModel.CHANNEL, self.__on_event__)
+            self.publisher = await application.acquire_custom_publisher("message.recent")
+        except Exception:
+            logging.exception("Failed to start recent messages cache")
+            self.enabled = False
+            return
+
+        self.stats_callback = PeriodicCallback(
+            lambda: application.monitor_action("recent_messages", self.dump()),
+            RecentMessagesModel.STATS_INTERVAL * 1000)
+        self.stats_callback.start()
+
+        logging.info("Started recent messages cache")
+
+    async def stopped(self):
+        if self.stats_callback:
+            self.stats_callback.stop()
+            self.stats_callback = None
+
+        if self.publisher:
+            await self.publisher.release()
+            self.publisher = None
+
+        if self.subscriber:
+            await self.subscriber.release()
+            self.subscriber = None
+
+        self.recipients.clear()
+
+    def cacheable(self, recipient_class, limit):
+        return self.publisher is not None and recipient_class != CLASS_USER and limit <= self.size
+
+    async def get(self, gamespace, recipient_class, recipient, limit):
+        """
+        :returns: a pair of the last 'limit' messages sent to the recipient (newest first) and their total count
+        """
+
+        key = (int(gamespace), str(recipient_class), str(recipient))
+        entry = self.recipients.get(key)
+
+        if entry is not None and time.time() - entry.filled < self.ttl:
+            self.recipients.move_to_end(key)
+            self.hits += 1
+            return list(entry.messages)[:limit], entry.count
+
+        self.misses += 1
+
+        started = self.sequence
+        self.filling[key] = self.filling.get(key, 0) + 1
+
+        try:
+            entry = await self.__fill__(*key)
+        finally:
+            fills = self.filling.pop(key) - 1
+            raced = self.changed.get(key, started) > started
+
+            if fills:
+                self.filling[key] = fills
+            else:
+                self.changed.pop(key, None)
+
+        # the recipient has changed while being filled, so the result may miss that change
+        if not raced:
+            self.recipients[key] = entry
+            self.recipients.move_to_end(key)
+
+            while len(self.recipients) > self.max_recipients:
+                self.recipients.popitem(last=False)
+
+        return list(entry.messages)[:limit], entry.count
+
+    async def __fill__(self, gamespace, recipient_class, recipient):
+        # a replica might miss the messages stored just before the fill
+        q = MessagesQuery(gamespace, self.history.db)
+
+        q.message_recipient_class = recipient_class
+        q.message_recipient = recipient
+        q.limit = self.size
+
+        if self.history.counters:
+            messages = await q.query()
+            count = await self.history.count_recipient_messages(gamespace, recipient_class, recipient)
+        else:
+            messages, count = await q.query(count=True)
+
+        return RecentMessages(self.size, messages, count)
+
+    async def stored(self, gamespace, message_id, message_uuid, sender, recipient_class, recipient, message_time,
+                     message_type, payload, flags, delivered):
+        """
+        Announces a message that has just been stored
+        """
+
+        if self.publisher is None or recipient_class == CLASS_USER:
+            return
+
+        await self.__publish__(stored={
+            "gamespace_id": gamespace,
+            "message_id": message_id,
+            "message_uuid": message_uuid,
+            "message_sender": sender,
+            "message_recipient_class": recipient_class,
+            "message_recipient": recipient,
+            "message_time": int(message_time.timestamp()),
+            "message_type": message_type,
+            "message_payload": payload,
+            "message_flags": flags.dump(),
+            "message_delivered": delivered
+        })
+
+    async def invalidate(self, gamespace=None, recipient_class=None, recipient=None):
+        """
+        Drops the recipient from the cache of every node. If the recipient is not specified, drops all of the
+            recipients of the gamespace, or just everything if the gamespace is not specified either.
+        """
+
+        if self.publisher is None:
+            return
+
+        await self.__publish__(invalidate={
+            "gamespace_id": gamespace,
+            "message_recipient_class": recipient_class,
+            "message_recipient": recipient
+        })
+
+    def dump(self):
+        return {
+            "recipients": len(self.recipients),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    async def __publish__(self, **event):
+        # noinspection PyBroadException
+        try:
+            await self.publisher.publish(RecentMessagesModel.CHANNEL, event)
+        except Exception:
+            logging.exception("Failed to publish recent messages event")
+
+    def __changed__(self, key):
+        self.sequence += 1
+
+        if key in self.filling:
+            self.changed[key] = self.sequence
+
+    async def __on_event__(self, event):
+        if "stored" in event:
+            data = event["stored"]
+            key = (int(data["gamespace_id"]), str(data["message_recipient_class"]), str(data["message_recipient"]))
+
+            self.__changed__(key)
+
+            entry = self.recipients.get(key)
+            if entry is None:
+                return
+
+            data["message_time"] = datetime.datetime.utcfromtimestamp(data["message_time"])
+            entry.add(MessageAdapter(data))
+
+        elif "invalidate" in event:
+            data = event["invalidate"]
+            gamespace = data.get("gamespace_id")
+            recipient_class = data.get("message_recipient_class")
+            recipient = data.get("message_recipient")
+
+            if gamespace is not None and recipient_class is not None and recipient is not None:
+                keys = [(int(gamespace), str(recipient_class), str(recipient))]
+            else:
+                keys = [
+                    key for key in list(self.recipients.keys()) + list(self.filling.keys())
+                    if gamespace is None or key[0] == int(gamespace)
+                ]
+
+            for key in keys:
+                self.__changed__(key)
+                self.recipients.pop(key, None)
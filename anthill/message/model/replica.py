@@ -0,0 +1,155 @@
+from tornado.ioloop import PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+from anthill.common.options import options
+
+import logging
+import time
+
+
+class ReplicaAdapter(object):
+    def __init__(self, host, db):
+        self.host = host
+        self.db = db
+        # seconds behind the primary, None if unknown (or the replica is not reachable)
+        self.lag = None
+
+
+class ReplicaRouter(Model):
+
+    """
+    Routes the read-only queries (the listings of messages and group participants) to the read replicas,
+    keeping the primary for the inserts and the locking updates.
+
+    The lag of each replica is measured with a heartbeat: the primary updates a timestamp every
+    'message_replica_heartbeat_interval' seconds, and the replicas are checked for how old is the timestamp
+    they have. A replica lagging more than 'message_replica_max_lag' seconds behind (or unreachable) is
+    not read from until it catches up. If none of the replicas is fine, the reads go to the primary.
+
+    An account that has just written something (sent a message, joined a group, etc) is read from the primary
+    for the lag allowed, so it sees what it has written. That only works on the node that has served the write.
+    """
+
+    HEARTBEAT_ID = 1
+
+    def __init__(self, db, replicas):
+        """
+        :param db: the primary database
+        :param replicas: a list of (host, database) of the read replicas
+        """
+
+        self.db = db
+        self.replicas = [ReplicaAdapter(host, replica) for host, replica in replicas]
+
+        self.max_lag = options.message_replica_max_lag
+        self.heartbeat_interval = options.message_replica_heartbeat_interval
+
+        # the heartbeat read by a replica might be up to an interval old
+        self.sticky_time = self.max_lag + self.heartbeat_interval
+
+        # (gamespace, account) -> until when the account is read from the primary
+        self.sticky = {}
+
+        self.heartbeat_callback = None
+        self.next = 0
+
+    def get_setup_tables(self):
+        return ["replica_heartbeat"]
+
+    def get_setup_db(self):
+        return self.db
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    async def started(self, application):
+        await super(ReplicaRouter, self).started(application)
+
+        if not self.enabled:
+            return
+
+        self.heartbeat_callback = PeriodicCallback(self.__heartbeat__, self.heartbeat_interval * 1000)
+        self.heartbeat_callback.start()
+
+        await self.__heartbeat__()
+
+        logging.info("Routing reads to {0} replica(s)".format(len(self.replicas)))
+
+    async def stopped(self):
+        if self.heartbeat_callback:
+            self.heartbeat_callback.stop()
+            self.heartbeat_callback = None
+
+    def read(self, gamespace=None, account=None):
+        """
+        :returns: the database to read from, for the account if it's known
+        """
+
+        if not self.enabled:
+            return self.db
+
+        if account is not None:
+            until = self.sticky.get((str(gamespace), str(account)))
+            if until is not None and until > time.monotonic():
+                return self.db
+
+        healthy = [
+            replica for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+        ]
+
+        if not healthy:
+            return self.db
+
+        self.next = (self.next + 1) % len(healthy)
+        return healthy[self.next].db
+
+    def written(self, gamespace, account):
+        """
+        Reads of the account go to the primary for a while, since it has just written something
+        """
+
+        if not self.enabled:
+            return
+
+        self.sticky[(str(gamespace), str(account))] = time.monotonic() + self.sticky_time
+
+    def dump(self):
+        return {
+            replica.host: replica.lag
+            for replica in self.replicas
+        }
+
+    async def __heartbeat__(self):
+        try:
+            await self.db.execute(
+                """
+                    INSERT INTO `replica_heartbeat`
+                    (`heartbeat_id`, `heartbeat_time`)
+                    VALUES (%s, UTC_TIMESTAMP(6))
+                    ON DUPLICATE KEY UPDATE `heartbeat_time`=VALUES(`heartbeat_time`);
+                """, ReplicaRouter.HEARTBEAT_ID)
+        except DatabaseError as e:
+            logging.error("Failed to update the replica heartbeat: " + e.args[1])
+
+        for replica in self.replicas:
+            try:
+                heartbeat = await replica.db.get(
+                    """
+                        SELECT TIMESTAMPDIFF(MICROSECOND, `heartbeat_time`, UTC_TIMESTAMP(6)) AS `lag`
+                        FROM `replica_heartbeat`
+                        WHERE `heartbeat_id`=%s;
+                    """, ReplicaRouter.HEARTBEAT_ID)
+            except DatabaseError as e:
+                logging.warning("Failed to check replica {0}: {1}".format(replica.host, e.args[1]))
+                replica.lag = None
+            else:
+                replica.lag = heartbeat["lag"] / 1000000.0 if heartbeat and heartbeat["lag"] is not None else None
+
+        now = time.monotonic()
+
+        for key, until in list(self.sticky.items()):
+            if until <= now:
+                del self.sticky[key]
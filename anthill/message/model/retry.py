@@ -0,0 +1,156 @@
+from tornado.gen import Future, with_timeout, TimeoutError, multi, convert_yielded
+
+from . conversation import AccountConversation
+
+from pika import BasicProperties
+
+import logging
+import datetime
+import ujson
+
+
+class DeadLetterAdapter(object):
+    def __init__(self, method, properties, body):
+        headers = properties.headers or {}
+
+        self.delivery_tag = method.delivery_tag
+        self.attempts = headers.get(MessagesRetry.ATTEMPT_HEADER, 0)
+        self.error = headers.get(MessagesRetry.ERROR_HEADER, "")
+        self.body = body
+
+        try:
+            self.message = ujson.loads(body)
+        except (KeyError, ValueError):
+            self.message = None
+
+        message = self.message if isinstance(self.message, dict) else {}
+
+        self.message_uuid = message.get(AccountConversation.MESSAGE_UUID)
+        self.action = message.get(AccountConversation.ACTION)
+        self.gamespace = message.get(AccountConversation.GAMESPACE)
+        self.sender = message.get(AccountConversation.SENDER)
+        self.recipient_class = message.get(AccountConversation.RECIPIENT_CLASS)
+        self.recipient = message.get(AccountConversation.RECIPIENT_KEY)
+        self.message_type = message.get(AccountConversation.TYPE)
+        self.payload = message.get(AccountConversation.PAYLOAD)
+
+
+class MessagesRetry(object):
+
+    """
+    Handles the incoming messages that failed to be processed.
+
+    Instead of being requeued immediately (and redelivered in a hot loop), a failed message is published into
+    one of the delay queues, depending on how many attempts it has had already. Delay queues have no consumers,
+    once the message expires there (each next queue has twice the delay of the previous one), the broker
+    dead-letters it back into the incoming queue. Once out of attempts, or if the message cannot be processed at
+    all (corrupted), it goes into the dead letter queue, where it stays for inspection or replay.
+    """
+
+    ATTEMPT_HEADER = "x-message-attempt"
+    ERROR_HEADER = "x-message-error"
+
+    BROWSE_TIMEOUT = 1
+
+    def __init__(self, incoming_queue_name, publisher, attempts, delay, dead_queue_name=None):
+        """
+        :param incoming_queue_name: the queue the retried messages go back into
+        :param dead_queue_name: the dead letter queue, '<incoming_queue_name>.dead' if not specified
+        """
+
+        self.incoming_queue_name = incoming_queue_name
+        self.publisher = publisher
+        self.attempts = attempts
+        self.delay = delay
+
+        self.dead_queue_name = dead_queue_name or (incoming_queue_name + ".dead")
+
+    def retry_queue_name(self, attempt):
+        return "{0}.retry.{1}".format(self.incoming_queue_name, attempt)
+
+    async def declare(self, channel):
+        for attempt in range(0, self.attempts):
+            await channel.queue(queue=self.retry_queue_name(attempt), durable=True, arguments={
+                "x-message-ttl": int(self.delay * (2 ** attempt) * 1000),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.incoming_queue_name
+            })
+
+        await channel.queue(queue=self.dead_queue_name, durable=True)
+
+    async def failed(self, properties, body, error, retry=True):
+        """
+        Schedules a retry of the failed message, or moves it into the dead letter queue.
+        :returns: True if the message has been safely moved and the original could be acknowledged
+        """
+
+        headers = dict(properties.headers or {})
+        attempt = headers.get(MessagesRetry.ATTEMPT_HEADER, 0)
+
+        headers[MessagesRetry.ATTEMPT_HEADER] = attempt + 1
+        headers[MessagesRetry.ERROR_HEADER] = str(error)
+
+        if retry and attempt < self.attempts:
+            routing_key = self.retry_queue_name(attempt)
+        else:
+            logging.error("Message is dead lettered after {0} attempt(s): {1}".format(attempt + 1, error))
+            routing_key = self.dead_queue_name
+
+        return await self.publisher.publish(
+            '',
+            routing_key,
+            body,
+            properties=BasicProperties(
+                delivery_mode=2,
+                content_type=properties.content_type,
+                headers=headers),
+            mandatory=True)
+
+    async def browse(self, connection, limit, process=None):
+        """
+        Reads up to 'limit' messages from the dead letter queue, without removing them.
+
+        :param process: a coroutine, called for each message read; if it returns True, the message is
+            removed from the queue
+        :returns: a list of DeadLetterAdapter
+        """
+
+        channel = await connection.channel()
+
+        collected = []
+        processes = []
+        enough = Future()
+
+        def on_message(ch, method, properties, body):
+            letter = DeadLetterAdapter(method, properties, body)
+            collected.append(letter)
+
+            if process:
+                processes.append((letter, convert_yielded(process(letter))))
+
+            if len(collected) >= limit and not enough.done():
+                enough.set_result(True)
+
+        try:
+            await channel.basic_qos(prefetch_count=limit)
+            queue = await channel.queue(queue=self.dead_queue_name, durable=True)
+            consumer = await queue.consume(on_message)
+
+            try:
+                await with_timeout(datetime.timedelta(seconds=MessagesRetry.BROWSE_TIMEOUT), enough)
+            except TimeoutError:
+                pass
+
+            await consumer.cancel()
+
+            if processes:
+                results = await multi([f for letter, f in processes])
+                for (letter, f), result in zip(processes, results):
+                    if result:
+                        channel.basic_ack(delivery_tag=letter.delivery_tag)
+        finally:
+            # the messages left unacknowledged are returned back to the queue
+            if channel.is_open:
+                channel.close()
+
+        return collected
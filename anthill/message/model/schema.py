@@ -0,0 +1,194 @@
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+
+from . import MessageError
+
+import logging
+import os
+import re
+
+
+class MigrationAdapter(object):
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        self.applied = None
+
+    def statements(self):
+        with open(self.path) as f:
+            lines = [line for line in f.read().splitlines() if not line.strip().startswith("--")]
+
+        return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+class QueryPlanAdapter(object):
+    """
+    A single row of EXPLAIN output
+    """
+
+    FULL_SCAN_TYPES = ["ALL", "index"]
+
+    def __init__(self, query_name, data):
+        self.query_name = query_name
+        self.table = data.get("table")
+        self.type = data.get("type")
+        self.key = data.get("key")
+        self.rows = data.get("rows")
+        self.extra = data.get("Extra") or ""
+
+    @property
+    def full_scan(self):
+        return self.type in QueryPlanAdapter.FULL_SCAN_TYPES
+
+    @property
+    def filesort(self):
+        return "Using filesort" in self.extra
+
+
+class SchemaModel(Model):
+
+    """
+    Versioned schema migrations, on top of the tables created by 'get_setup_tables'.
+
+    Each migration is a file 'sql/migrations/<version>_<name>.sql', applied once, in the order of versions,
+        by the first node that starts after it has been shipped (the others wait for it on a named lock).
+        The versions applied are recorded in the 'schema_migrations' table. A failed migration stops the
+        ones after it, and the node from starting; it is attempted again on the next start.
+    """
+
+    MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql", "migrations")
+    MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+    LOCK_NAME = "message_schema_migrations"
+    LOCK_TIMEOUT = 600
+
+    def __init__(self, db, models):
+        self.db = db
+        self.models = models
+        self.migrations = SchemaModel.__list_migrations__()
+
+    def get_setup_tables(self):
+        return ["schema_migrations"]
+
+    def get_setup_db(self):
+        return self.db
+
+    @staticmethod
+    def __list_migrations__():
+        if not os.path.isdir(SchemaModel.MIGRATIONS_PATH):
+            return []
+
+        migrations = []
+
+        for file_name in os.listdir(SchemaModel.MIGRATIONS_PATH):
+            match = SchemaModel.MIGRATION_FILE.match(file_name)
+            if not match:
+                continue
+            migrations.append(MigrationAdapter(
+                int(match.group(1)), match.group(2), os.path.join(SchemaModel.MIGRATIONS_PATH, file_name)))
+
+        return sorted(migrations, key=lambda m: m.version)
+
+    async def started(self, application):
+        await super(SchemaModel, self).started(application)
+
+        # the models rely on the schema being up to date, so the node does not start otherwise
+        try:
+            await self.migrate()
+        except MessageError as e:
+            logging.error("Failed to migrate the schema: " + e.message)
+            raise
+
+    async def list_migrations(self):
+        """
+        :returns: a list of all the migrations known, with 'applied' time set for the ones applied already
+        """
+
+        try:
+            applied = await self.db.query(
+                """
+                    SELECT `migration_version`, `migration_applied`
+                    FROM `schema_migrations`;
+                """)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list schema migrations: " + e.args[1])
+
+        applied = {
+            row["migration_version"]: row["migration_applied"]
+            for row in applied
+        }
+
+        for migration in self.migrations:
+            migration.applied = applied.get(migration.version)
+
+        return self.migrations
+
+    async def migrate(self):
+        """
+        Applies the migrations not applied yet.
+        :returns: a list of migrations applied
+        """
+
+        result = []
+
+        try:
+            async with self.db.acquire() as db:
+                lock = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, %s) AS `locked`;
+                    """, SchemaModel.LOCK_NAME, SchemaModel.LOCK_TIMEOUT)
+
+                if not lock or not lock["locked"]:
+                    raise MessageError(409, "Failed to acquire the schema migrations lock")
+
+                try:
+                    for migration in await self.list_migrations():
+                        if migration.applied:
+                            continue
+
+                        logging.info("Applying schema migration {0}: {1}".format(migration.version, migration.name))
+
+                        for statement in migration.statements():
+                            await db.execute(statement)
+
+                        await db.execute(
+                            """
+                                INSERT INTO `schema_migrations`
+                                (`migration_version`, `migration_name`, `migration_applied`)
+                                VALUES (%s, %s, NOW());
+                            """, migration.version, migration.name)
+
+                        result.append(migration)
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s) AS `released`;
+                        """, SchemaModel.LOCK_NAME)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to apply a schema migration: " + e.args[1])
+
+        return result
+
+    async def explain(self):
+        """
+        Runs EXPLAIN over the hot queries of the models (see 'get_hot_queries'), to catch the ones that end up
+            scanning a whole table (or a whole index) once the indexes no longer match them. The plans only make
+            sense on a populated database, the optimizer prefers full scans of small tables anyway.
+
+        :returns: a list of QueryPlanAdapter
+        """
+
+        plans = []
+
+        async with self.db.acquire() as db:
+            for model in self.models:
+                for name, query, args in model.get_hot_queries():
+                    try:
+                        rows = await db.query("EXPLAIN " + query, *args)
+                    except DatabaseError as e:
+                        raise MessageError(500, "Failed to explain query '{0}': {1}".format(name, e.args[1]))
+
+                    plans.extend(QueryPlanAdapter(name, row) for row in rows)
+
+        return plans
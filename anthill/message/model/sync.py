@@ -0,0 +1,277 @@
+from tornado.gen import sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+from anthill.common.options import options
+
+from . import MessageError
+from . history import MessagesHistoryModel, load_messages, dump_messages_json
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+import binascii
+import logging
+import time
+import ujson
+
+
+class SyncCursor(object):
+
+    """
+    An opaque position in the change log of an account: the id of the last change synced, and when the cursor
+    has been issued, to tell if the changes past it might have expired already.
+    """
+
+    def __init__(self, change_id, issued):
+        self.change_id = change_id
+        self.issued = issued
+
+    def dump(self):
+        value = str(self.change_id) + "|" + str(int(self.issued))
+        return urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def parse(value):
+        if not value:
+            return None
+
+        try:
+            change_id, issued = urlsafe_b64decode(value.encode()).decode().split("|")
+            return SyncCursor(int(change_id), int(issued))
+        except (ValueError, TypeError, binascii.Error):
+            raise MessageError(400, "Bad cursor")
+
+
+class SyncPage(object):
+    def __init__(self, cursor, reset=False, more=False, new=None, updated=None, deleted=None):
+        self.cursor = cursor
+        # the changes before the cursor are not known anymore, so the inbox has to be fetched as a whole
+        self.reset = reset
+        # there's more changes past the cursor, the page is limited
+        self.more = more
+        self.new = new or []
+        self.updated = updated or []
+        self.deleted = deleted or []
+
+    def __header__(self):
+        return {
+            "cursor": self.cursor.dump(),
+            "reset": self.reset,
+            "more": self.more,
+            "deleted": self.deleted
+        }
+
+    def dump_json(self, gamespace):
+        """
+        :returns: the page serialized, the payloads of the messages are written as stored, see
+            MessageAdapter.dump_json
+        """
+
+        return ujson.dumps(self.__header__(), escape_forward_slashes=False)[:-1] + \
+            ',"new":' + dump_messages_json(self.new, gamespace) + \
+            ',"updated":' + dump_messages_json(self.updated, gamespace) + "}"
+
+    def dump(self, gamespace):
+        result = self.__header__()
+
+        result["new"] = [SyncPage.__dump_message__(message, gamespace) for message in self.new]
+        result["updated"] = [SyncPage.__dump_message__(message, gamespace) for message in self.updated]
+
+        return result
+
+    @staticmethod
+    def __dump_message__(message, gamespace):
+        return {
+            "uuid": message.message_uuid,
+            "recipient_class": message.recipient_class,
+            "sender": message.sender,
+            "recipient": message.recipient,
+            "gamespace": int(gamespace),
+            "time": str(message.time),
+            "type": message.message_type,
+            "payload": message.payload
+        }
+
+
+class MessageSyncModel(Model):
+
+    """
+    Incremental sync of the messages, for the clients that reconnect: instead of listing their inbox again,
+    they ask for what has changed since a cursor.
+
+    While 'message_sync' is enabled, every message stored, updated or deleted is recorded into the
+    'message_changes' log of each account that sees it (the same accounts the 'account_inbox' is fanned out
+    to), in the same transaction, so the log cannot miss a change. The ids of the changes only grow, yet a change
+    may get committed after a change with a greater id, so a change is only synced once it's
+    'message_sync_settle' seconds old. The log is read from the primary database only, as the settle period
+    does not cover the lag of a read replica.
+
+    The changes are kept for 'message_sync_retention_hours', a cursor older than that gets a reset: the client
+    has to fetch its inbox as a whole, and carry on syncing with the cursor it's given.
+    """
+
+    # seconds between the chunks of the expired changes deleted
+    PRUNE_PAUSE = 1
+
+    def __init__(self, db, history):
+        self.db = db
+        self.history = history
+
+        self.retention = options.message_sync_retention_hours * 3600
+        self.settle = options.message_sync_settle
+        self.prune_interval = options.message_sync_prune_interval
+        self.prune_chunk_size = max(options.message_sync_prune_chunk_size, 1)
+
+        self.prune_callback = None
+        self.running = False
+
+    def get_setup_tables(self):
+        return ["message_changes"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(MessageSyncModel, self).started(application)
+
+        self.prune_callback = PeriodicCallback(self.__prune__, self.prune_interval * 1000)
+        self.prune_callback.start()
+
+        IOLoop.current().spawn_callback(self.__prune__)
+
+    async def stopped(self):
+        if self.prune_callback:
+            self.prune_callback.stop()
+            self.prune_callback = None
+
+    async def sync(self, gamespace, account_id, cursor=None, limit=100):
+        """
+        :param cursor: a SyncCursor returned by the previous sync, or None to start syncing
+        :returns: a SyncPage of the changes of the messages the account sees, past the cursor
+        """
+
+        if limit < 1 or limit > 1000:
+            raise MessageError(400, "Bad limit")
+
+        if not self.history.sync_log:
+            raise MessageError(409, "Message sync is not enabled")
+
+        issued = int(time.time())
+
+        try:
+            # never a read replica: a replica lagging behind the settle period would return a change without
+            #   the ones before it, and the cursor would skip those for good
+            async with self.db.acquire() as db:
+                if cursor is None or cursor.issued < issued - self.retention:
+                    return await self.__reset__(db, gamespace, account_id, issued)
+
+                changes = await db.query(
+                    """
+                        SELECT `change_id`, `message_id`, `message_uuid`, `change_kind`
+                        FROM `message_changes`
+                        WHERE `gamespace_id`=%s AND `account_id`=%s AND `change_id`>%s
+                            AND `change_time`<=NOW() - INTERVAL %s SECOND
+                        ORDER BY `change_id` ASC
+                        LIMIT %s;
+                    """, gamespace, account_id, cursor.change_id, self.settle, limit)
+
+                if not changes:
+                    return SyncPage(SyncCursor(cursor.change_id, issued))
+
+                # the last change of each message is what matters
+                last = {}
+                new = set()
+
+                for change in changes:
+                    last[change["message_id"]] = change
+                    if change["change_kind"] == MessagesHistoryModel.CHANGE_NEW:
+                        new.add(change["message_id"])
+
+                deleted = [
+                    change["message_uuid"]
+                    for change in last.values()
+                    if change["change_kind"] == MessagesHistoryModel.CHANGE_DELETED
+                ]
+
+                existing = [
+                    message_id
+                    for message_id, change in last.items()
+                    if change["change_kind"] != MessagesHistoryModel.CHANGE_DELETED
+                ]
+
+                messages = await db.query(
+                    """
+                        SELECT * FROM `messages`
+                        WHERE `gamespace_id`=%s AND `message_id` IN %s
+                        ORDER BY `message_time` ASC, `message_id` ASC;
+                    """, gamespace, existing) if existing else []
+
+                messages = await load_messages(db, messages)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to sync messages: " + e.args[1])
+
+        # a message missing has been deleted by a change past this page
+        return SyncPage(
+            SyncCursor(changes[-1]["change_id"], issued),
+            more=len(changes) == limit,
+            new=[message for message in messages if message.message_id in new],
+            updated=[message for message in messages if message.message_id not in new],
+            deleted=deleted)
+
+    async def __reset__(self, db, gamespace, account_id, issued):
+        # the changes are not settled past that point yet, so they are to be synced with the next cursor
+        last = await db.get(
+            """
+                SELECT MAX(`change_id`) AS `change_id`
+                FROM `message_changes`
+                WHERE `gamespace_id`=%s AND `account_id`=%s
+                    AND `change_time`<=NOW() - INTERVAL %s SECOND;
+            """, gamespace, account_id, self.settle)
+
+        return SyncPage(SyncCursor((last["change_id"] or 0) if last else 0, issued), reset=True)
+
+    async def __prune__(self):
+        if self.running:
+            return
+
+        self.running = True
+
+        try:
+            await self.prune()
+        except MessageError as e:
+            logging.error("Failed to prune the message changes: " + e.message)
+        finally:
+            self.running = False
+
+    async def prune(self):
+        """
+        Deletes the changes past the retention period, in chunks
+        :returns: how many changes have been deleted
+        """
+
+        pruned = 0
+
+        while True:
+            async with self.db.acquire() as db:
+                try:
+                    await db.execute(
+                        """
+                            DELETE FROM `message_changes`
+                            WHERE `change_time`<NOW() - INTERVAL %s SECOND
+                            LIMIT %s;
+                        """, self.retention, self.prune_chunk_size)
+
+                    deleted = await db.get(
+                        """
+                            SELECT ROW_COUNT() AS `count`;
+                        """)
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to prune the message changes: " + e.args[1])
+
+            pruned += deleted["count"]
+
+            if deleted["count"] < self.prune_chunk_size:
+                return pruned
+
+            await sleep(MessageSyncModel.PRUNE_PAUSE)
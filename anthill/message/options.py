@@ -18,6 +18,17 @@ define("name",
        help="Service short name. User to discover by discovery service.",
        type=str)
 
+define("role",
+       default="all",
+       help="What this instance does: 'gateway' serves the clients (including /listen WebSockets) but does not "
+            "process the incoming queue, 'worker' only processes the incoming queue, 'all' does both",
+       type=str)
+
+define("worker_processes",
+       default=1,
+       help="How many processes to run in 'worker' role (0 means one per CPU core)",
+       type=int)
+
 # MySQL database
 
 define("db_host",
@@ -70,10 +81,328 @@ define("message_prefetch_count",
        default=32,
        type=int,
        group="message",
-       help="How much of messages can be prefetch")
+       help="How much of messages can be prefetch (initial value if adaptive prefetch is enabled)")
+
+define("message_prefetch_adaptive",
+       default=False,
+       type=bool,
+       group="message",
+       help="Adjust the prefetch count depending on how fast incoming messages are processed")
+
+define("message_prefetch_min",
+       default=4,
+       type=int,
+       group="message",
+       help="Lowest prefetch count the adaptive prefetch may go down to")
 
-define("outgoing_message_workers",
+define("message_prefetch_max",
+       default=256,
+       type=int,
+       group="message",
+       help="Highest prefetch count the adaptive prefetch may go up to")
+
+define("message_prefetch_target_latency",
+       default=200,
+       type=int,
+       group="message",
+       help="Processing latency (in milliseconds) of a message the adaptive prefetch tries to stay below")
+
+define("message_publisher_channels",
+       default=4,
+       type=int,
+       group="message",
+       help="How many long-lived confirm mode channels are used to publish into the incoming queue")
+
+define("message_publisher_max_in_flight",
+       default=256,
+       type=int,
+       group="message",
+       help="How many unconfirmed messages may be in flight on a single publisher channel")
+
+define("message_delivery_channels",
+       default=4,
+       type=int,
+       group="message",
+       help="How many long-lived channels are used to deliver messages to the online recipients")
+
+define("message_delivery_max_in_flight",
+       default=1024,
+       type=int,
+       group="message",
+       help="How many unconfirmed deliveries may be in flight on a single delivery channel")
+
+define("message_store_batch_size",
        default=32,
        type=int,
        group="message",
-       help="How much workers process the outgoing messages")
+       help="How many incoming messages are stored with a single INSERT at most")
+
+define("message_store_batch_window",
+       default=10,
+       type=int,
+       group="message",
+       help="How long (in milliseconds) incoming messages are collected into a single INSERT")
+
+define("message_presence",
+       default=False,
+       type=bool,
+       group="message",
+       help="Track online accounts across the nodes to skip live delivery attempts to the offline ones")
+
+define("message_presence_sync_interval",
+       default=10,
+       type=int,
+       group="message",
+       help="How often (in seconds) each node broadcasts the accounts online on it")
+
+define("message_incoming_shards",
+       default=0,
+       type=int,
+       group="message",
+       help="Split the incoming queue into this many queues behind a consistent-hash exchange keyed by the "
+            "recipient (requires rabbitmq_consistent_hash_exchange plugin). 0 means no sharding.")
+
+define("message_incoming_shards_per_node",
+       default=0,
+       type=int,
+       group="message",
+       help="How many incoming shards a single node may consume at most. 0 means no limit.")
+
+define("message_retry_attempts",
+       default=5,
+       type=int,
+       group="message",
+       help="How many times a message that failed to be processed is retried before being dead lettered")
+
+define("message_retry_delay",
+       default=1,
+       type=float,
+       group="message",
+       help="Delay (in seconds) before the first retry of a failed message, each next one is twice as long")
+
+define("message_dedupe_size",
+       default=100000,
+       type=int,
+       group="message",
+       help="How many recently processed message uuids to remember, to skip redelivered ones. 0 to disable.")
+
+define("message_account_inbox_maintain",
+       default=False,
+       type=bool,
+       group="message",
+       help="Maintain the 'account_inbox' index as the messages are stored, and as the accounts join the groups. "
+            "Has to be enabled on every node before the index is backfilled (see 'Account inbox' in admin).")
+
+define("message_account_inbox",
+       default=False,
+       type=bool,
+       group="message",
+       help="Read the messages of an account from the 'account_inbox' index instead of the messages table. "
+            "Enable once the index is maintained (see 'message_account_inbox_maintain') and has been backfilled.")
+
+define("message_counters",
+       default=False,
+       type=bool,
+       group="message",
+       help="Serve the total counts of messages from the 'message_counters' table instead of FOUND_ROWS(). "
+            "The counters are always maintained, enable once they have been recounted (see 'Account inbox' in "
+            "admin). The account totals are only correct if 'message_account_inbox' is enabled as well.")
+
+define("message_admin_approximate_count",
+       default=False,
+       type=bool,
+       group="message",
+       help="Admin screens page through the messages using approximate totals (maintained counters, or the "
+            "optimizer estimate) instead of counting the rows exactly.")
+
+define("message_recent_cache",
+       default=False,
+       type=bool,
+       group="message",
+       help="Cache the last messages of the group inboxes in memory of each node")
+
+define("message_recent_cache_size",
+       default=100,
+       type=int,
+       group="message",
+       help="How many last messages are cached per group, larger inbox requests are not cached")
+
+define("message_recent_cache_recipients",
+       default=10000,
+       type=int,
+       group="message",
+       help="How many groups may be cached at once on a node, the least recently used ones are evicted")
+
+define("message_recent_cache_ttl",
+       default=60,
+       type=int,
+       group="message",
+       help="How long (in seconds) a cached group is served before being refilled from the database")
+
+define("message_incoming_chunk_size",
+       default=100,
+       type=int,
+       group="message",
+       help="How many stored messages are sent at once to an account that has just connected, "
+            "each chunk is marked as delivered in a transaction of its own")
+
+define("message_read_flush_interval",
+       default=1.0,
+       type=float,
+       group="message",
+       help="How long (in seconds) the messages marked as read over a conversation are collected, "
+            "before being written at once")
+
+define("message_read_flush_size",
+       default=64,
+       type=int,
+       group="message",
+       help="How many messages marked as read over a conversation are written at once at most")
+
+define("message_purge_chunk_size",
+       default=1000,
+       type=int,
+       group="message",
+       help="How many rows a purge (of the deleted accounts or groups) deletes at once, "
+            "each chunk is deleted in a transaction of its own")
+
+define("message_purge_pause",
+       default=0.1,
+       type=float,
+       group="message",
+       help="How long (in seconds) a purge pauses between the chunks, to let the live traffic through")
+
+define("message_purge_poll_interval",
+       default=30,
+       type=int,
+       group="message",
+       help="How often (in seconds) a node checks for the purge jobs to process")
+
+define("message_purge_timeout",
+       default=120,
+       type=int,
+       group="message",
+       help="How long (in seconds) a purge job may go without progress, before it is resumed by another node")
+
+define("message_retention_days",
+       default=0,
+       type=int,
+       group="message",
+       help="How long (in days) the messages are kept in the history, before being moved to the archive "
+            "(0 to keep them forever)")
+
+define("message_archive_retention_months",
+       default=0,
+       type=int,
+       group="message",
+       help="How long (in months) the archived messages are kept, before their partitions are dropped "
+            "(0 to keep them forever)")
+
+define("message_archive_interval",
+       default=3600,
+       type=int,
+       group="message",
+       help="How often (in seconds) the messages past the retention period are archived")
+
+define("message_archive_chunk_size",
+       default=1000,
+       type=int,
+       group="message",
+       help="How many messages are archived at once, each chunk is moved in a transaction of its own")
+
+define("message_archive_pause",
+       default=0.1,
+       type=float,
+       group="message",
+       help="How long (in seconds) the archiving pauses between the chunks")
+
+define("message_payload_dedupe",
+       default=False,
+       type=bool,
+       group="message",
+       help="Store the large message payloads once in a shared table, referenced by each message with "
+            "the same payload (like the broadcasts)")
+
+define("message_payload_dedupe_size",
+       default=1024,
+       type=int,
+       group="message",
+       help="How large (in bytes, serialized) a message payload has to be to be shared")
+
+define("message_db_replicas",
+       default="",
+       type=str,
+       group="message",
+       help="Comma-separated hosts of the read replicas of the database, the history and group listings "
+            "are read from them")
+
+define("message_db_replica_username",
+       default="",
+       type=str,
+       group="message",
+       help="Username to access the read replicas with, 'db_username' if empty")
+
+define("message_db_replica_password",
+       default="",
+       type=str,
+       group="message",
+       help="Password to access the read replicas with, 'db_password' if empty")
+
+define("message_replica_max_lag",
+       default=5,
+       type=int,
+       group="message",
+       help="How far behind (in seconds) a read replica may lag before the reads go elsewhere")
+
+define("message_replica_heartbeat_interval",
+       default=1,
+       type=int,
+       group="message",
+       help="How often (in seconds) the lag of the read replicas is measured")
+
+define("message_conversation_keys_maintain",
+       default=False,
+       type=bool,
+       group="message",
+       help="Set the conversation keys of the messages as they are stored, and maintain the conversations of the "
+            "accounts. Has to be enabled on every node before the keys are backfilled (see 'Account inbox' in admin).")
+
+define("message_conversation_keys",
+       default=False,
+       type=bool,
+       group="message",
+       help="Read the direct messages between two accounts by the conversation key. Enable once the keys are "
+            "maintained (see 'message_conversation_keys_maintain') and the backfill is complete.")
+
+define("message_sync",
+       default=False,
+       type=bool,
+       group="message",
+       help="Record the changes of the messages for the clients to sync them since a cursor. "
+            "Has to be enabled on every node, the changes made by the other nodes are missing otherwise.")
+
+define("message_sync_retention_hours",
+       default=72,
+       type=int,
+       group="message",
+       help="How long (in hours) the changes of the messages are kept for the clients to sync, "
+            "a client with an older cursor has to fetch its inbox again")
+
+define("message_sync_settle",
+       default=2,
+       type=int,
+       group="message",
+       help="How old (in seconds) a change has to be to get synced, so the changes committed "
+            "out of order are not skipped")
+
+define("message_sync_prune_interval",
+       default=600,
+       type=int,
+       group="message",
+       help="How often (in seconds) the expired changes of the messages are deleted")
+
+define("message_sync_prune_chunk_size",
+       default=10000,
+       type=int,
+       group="message",
+       help="How many expired changes are deleted at once")
@@ -1,19 +1,40 @@
 
+from tornado import process
+
 from anthill.common.options import options
 from anthill.common import server, database, access
 
 from . model.history import MessagesHistoryModel
 from . model.group import GroupsModel
 from . model.online import OnlineModel
+from . model.presence import PresenceModel
+from . model.recent import RecentMessagesModel
 from . model.queue import MessagesQueueModel
+from . model.schema import SchemaModel
+from . model.purge import PurgeModel
+from . model.archive import MessagesArchiveModel
+from . model.replica import ReplicaRouter
+from . model.sync import MessageSyncModel
 from . import handler as h
 from . import admin
 from . import options as _opts
 
 
+ROLE_ALL = "all"
+ROLE_GATEWAY = "gateway"
+ROLE_WORKER = "worker"
+
+ROLES = [ROLE_ALL, ROLE_GATEWAY, ROLE_WORKER]
+
+
 class MessagesServer(server.Server):
     # noinspection PyShadowingNames
     def __init__(self):
+        self.role = options.role
+
+        if self.role not in ROLES:
+            raise server.ServerError("Unknown role: " + self.role)
+
         super(MessagesServer, self).__init__()
 
         self.db = database.Database(
@@ -22,10 +43,26 @@ class MessagesServer(server.Server):
             user=options.db_username,
             password=options.db_password)
 
+        self.replicas = ReplicaRouter(self.db, [
+            (host, database.Database(
+                host=host,
+                database=options.db_name,
+                user=options.message_db_replica_username or options.db_username,
+                password=options.message_db_replica_password or options.db_password))
+            for host in options.message_db_replicas.split(",") if host.strip()
+        ])
+
         self.history = MessagesHistoryModel(self.db, self)
         self.groups = GroupsModel(self.db, self)
-        self.online = OnlineModel(self.groups, self.history)
-        self.message_queue = MessagesQueueModel(self.history)
+        self.schema = SchemaModel(self.db, [self.history, self.groups])
+        self.purge = PurgeModel(self.db, self.history)
+        self.archive = MessagesArchiveModel(self.db, self.history)
+        self.sync = MessageSyncModel(self.db, self.history)
+        self.presence = PresenceModel()
+        self.recent_messages = RecentMessagesModel(self.history)
+        self.online = OnlineModel(self.groups, self.history, self.presence)
+        self.message_queue = MessagesQueueModel(
+            self.history, self.presence, self.recent_messages, consume=self.role != ROLE_GATEWAY)
 
     def get_metadata(self):
         return {
@@ -48,11 +85,28 @@ class MessagesServer(server.Server):
             "user": admin.UserController,
             "messages": admin.MessagesController,
             "history": admin.MessagesHistoryController,
-            "user_messages": admin.UserMessagesController
+            "user_messages": admin.UserMessagesController,
+            "dead_letters": admin.DeadLettersController,
+            "account_inbox": admin.AccountInboxController,
+            "schema": admin.SchemaController,
+            "purge_jobs": admin.PurgeJobsController,
+            "archive": admin.ArchiveController
         }
 
     def get_models(self):
-        return [self.groups, self.history, self.online, self.message_queue]
+        if self.role == ROLE_WORKER:
+            return [self.groups, self.history, self.schema, self.replicas, self.purge, self.archive, self.sync,
+                    self.presence, self.recent_messages, self.message_queue]
+
+        return [self.groups, self.history, self.schema, self.replicas, self.purge, self.archive, self.sync,
+                self.presence, self.recent_messages, self.online, self.message_queue]
+
+    def listen_server(self):
+        # extra worker processes only process the incoming queue, the first one serves the requests
+        if process.task_id():
+            return
+
+        super(MessagesServer, self).listen_server()
 
     def get_internal_handler(self):
         return h.InternalHandler(self)
@@ -63,19 +117,31 @@ class MessagesServer(server.Server):
         }
 
     def get_handlers(self):
-        return [
+        handlers = [
             (r"/group/(\w+)/(.*)/join", h.JoinGroupHandler),
             (r"/group/(\w+)/(.*)", h.ReadGroupInboxHandler),
             (r"/send/(\w+)/(\w+)", h.SendMessageHandler),
             (r"/send", h.SendMessagesHandler),
             (r"/messages", h.ReadMessagesHandler),
             (r"/messages/with/(.*)", h.ReadMessagesRecipientHandler),
-            (r"/message/(.*)", h.MessageHandler),
-            (r"/listen", h.ConversationEndpointHandler)
+            (r"/message/(.*)", h.MessageHandler)
         ]
 
+        if self.role != ROLE_WORKER:
+            handlers.extend([
+                (r"/conversations", h.ConversationsHandler),
+                (r"/sync", h.SyncHandler),
+                (r"/listen", h.ConversationEndpointHandler)
+            ])
+
+        return handlers
+
 
 if __name__ == "__main__":
     stt = server.init()
     access.AccessToken.init([access.public()])
+
+    if options.role == ROLE_WORKER and options.worker_processes != 1:
+        process.fork_processes(options.worker_processes)
+
     server.start(MessagesServer)
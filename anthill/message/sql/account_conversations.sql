@@ -0,0 +1,14 @@
+CREATE TABLE `account_conversations` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `conversation_key` varchar(255) NOT NULL,
+  `conversation_class` varchar(64) NOT NULL,
+  `conversation_recipient` varchar(255) NOT NULL DEFAULT '',
+  `message_id` int(11) unsigned NOT NULL,
+  `message_uuid` varchar(40) DEFAULT NULL,
+  `message_time` datetime NOT NULL,
+  `conversation_unread` int(11) unsigned NOT NULL DEFAULT '0',
+  `conversation_read_time` datetime DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`,`account_id`,`conversation_key`),
+  KEY `activity` (`gamespace_id`,`account_id`,`message_time`,`message_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,10 @@
+CREATE TABLE `account_inbox` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `message_id` int(11) unsigned NOT NULL,
+  `message_time` datetime NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`account_id`,`message_id`),
+  KEY `account_time` (`gamespace_id`,`account_id`,`message_time`,`message_id`),
+  KEY `message_id` (`message_id`),
+  CONSTRAINT `account_inbox_ibfk_1` FOREIGN KEY (`message_id`) REFERENCES `messages` (`message_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,12 @@
+CREATE TABLE `message_changes` (
+  `change_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `message_id` int(11) unsigned NOT NULL,
+  `message_uuid` varchar(40) DEFAULT NULL,
+  `change_kind` enum('new','updated','deleted') NOT NULL,
+  `change_time` datetime NOT NULL,
+  PRIMARY KEY (`change_id`),
+  KEY `account_changes` (`gamespace_id`,`account_id`,`change_id`),
+  KEY `change_time` (`change_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
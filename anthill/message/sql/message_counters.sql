@@ -0,0 +1,8 @@
+CREATE TABLE `message_counters` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `counter_kind` enum('recipient','account') NOT NULL,
+  `counter_class` varchar(64) NOT NULL DEFAULT '',
+  `counter_key` varchar(255) NOT NULL DEFAULT '',
+  `counter_value` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`counter_kind`,`counter_class`,`counter_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
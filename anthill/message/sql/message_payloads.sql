@@ -0,0 +1,7 @@
+CREATE TABLE `message_payloads` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `payload_hash` char(40) NOT NULL,
+  `payload` json NOT NULL,
+  `payload_refs` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`payload_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,20 @@
+CREATE TABLE `messages_archive` (
+  `message_id` int(11) unsigned NOT NULL,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `message_uuid` varchar(40) DEFAULT NULL,
+  `message_sender` int(11) NOT NULL,
+  `message_recipient_class` varchar(64) NOT NULL,
+  `message_recipient` varchar(255) NOT NULL DEFAULT '',
+  `message_time` datetime NOT NULL,
+  `message_type` varchar(64) NOT NULL,
+  `message_payload` json NOT NULL,
+  `message_delivered` tinyint(1) NOT NULL DEFAULT '0',
+  `message_flags` set('REMOVE_DELIVERED','EDITABLE','DELETABLE','SERVER') DEFAULT NULL,
+  `message_archived` datetime NOT NULL,
+  PRIMARY KEY (`message_id`,`message_time`),
+  KEY `recipient_time` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_time`,`message_id`),
+  KEY `sender_time` (`gamespace_id`,`message_sender`,`message_time`,`message_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 ROW_FORMAT=COMPRESSED
+PARTITION BY RANGE COLUMNS(`message_time`) (
+  PARTITION `p_max` VALUES LESS THAN (MAXVALUE)
+);
\ No newline at end of file
@@ -0,0 +1,8 @@
+-- read_incoming_messages: undelivered messages of a recipient
+-- MessagesQuery (group inbox), list_messages_recipient_count: messages of a recipient, newest first
+-- list_messages_account: messages sent by an account, newest first
+ALTER TABLE `messages`
+  ADD KEY `recipient_delivered` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_delivered`),
+  ADD KEY `recipient_time` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_time`,`message_id`),
+  ADD KEY `sender_time` (`gamespace_id`,`message_sender`,`message_time`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
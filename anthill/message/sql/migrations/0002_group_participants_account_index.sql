@@ -0,0 +1,4 @@
+-- list_groups_account_participates, list_participants_by_account: groups of an account within a gamespace
+ALTER TABLE `group_participants`
+  ADD KEY `gamespace_account` (`gamespace_id`,`participation_account`),
+  ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,4 @@
+-- MessagesArchiveModel: the messages past the retention period, oldest first
+ALTER TABLE `messages`
+  ADD KEY `message_time` (`message_time`),
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
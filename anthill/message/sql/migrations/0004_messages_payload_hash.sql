@@ -0,0 +1,4 @@
+-- MessagesHistoryModel: the payloads shared in `message_payloads` (see message_payload_dedupe)
+ALTER TABLE `messages`
+  ADD COLUMN `message_payload_hash` char(40) DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
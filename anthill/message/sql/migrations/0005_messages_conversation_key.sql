@@ -0,0 +1,5 @@
+-- MessagesHistoryModel.list_messages_recipient_count: the direct messages between two accounts, newest first
+ALTER TABLE `messages`
+  ADD COLUMN `message_conversation_key` varchar(255) DEFAULT NULL,
+  ADD KEY `conversation_time` (`gamespace_id`,`message_conversation_key`,`message_time`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
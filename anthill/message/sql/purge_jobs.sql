@@ -0,0 +1,16 @@
+CREATE TABLE `purge_jobs` (
+  `job_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned DEFAULT NULL,
+  `job_kind` varchar(64) NOT NULL,
+  `job_payload` json NOT NULL,
+  `job_status` enum('pending','running','done') NOT NULL DEFAULT 'pending',
+  `job_step` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_last_id` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_deleted` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_created` datetime NOT NULL,
+  `job_updated` datetime NOT NULL,
+  `job_heartbeat` datetime DEFAULT NULL,
+  `job_error` text,
+  PRIMARY KEY (`job_id`),
+  KEY `job_status` (`job_status`,`job_heartbeat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
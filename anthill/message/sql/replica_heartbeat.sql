@@ -0,0 +1,5 @@
+CREATE TABLE `replica_heartbeat` (
+  `heartbeat_id` int(11) unsigned NOT NULL,
+  `heartbeat_time` datetime(6) NOT NULL,
+  PRIMARY KEY (`heartbeat_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,6 @@
+CREATE TABLE `schema_migrations` (
+  `migration_version` int(11) unsigned NOT NULL,
+  `migration_name` varchar(255) NOT NULL DEFAULT '',
+  `migration_applied` datetime NOT NULL,
+  PRIMARY KEY (`migration_version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
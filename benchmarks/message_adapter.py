@@ -0,0 +1,114 @@
+"""
+Compares listing a page of messages the old way (every payload and flags parsed into a MessageAdapter,
+then each message converted into a dict and serialized back) with the lazy MessageAdapter serialized with
+'dump_messages_json', which writes the payloads as stored.
+
+    python benchmarks/message_adapter.py [--rows 10000] [--repeat 10]
+"""
+
+from anthill.message.model import MessageFlags
+from anthill.message.model.history import MessageAdapter, dump_messages_json
+
+import argparse
+import datetime
+import timeit
+import tracemalloc
+import ujson
+
+
+GAMESPACE = 1
+
+
+class EagerMessageAdapter(object):
+    # MessageAdapter as it used to be
+    def __init__(self, data):
+        self.message_id = data.get("message_id")
+        self.message_uuid = data.get("message_uuid")
+        self.recipient_class = str(data.get("message_recipient_class"))
+        self.sender = str(data.get("message_sender"))
+        self.recipient = str(data.get("message_recipient"))
+        self.time = data.get("message_time")
+        self.message_type = data.get("message_type")
+        self.payload = data.get("message_payload")
+        if isinstance(self.payload, str):
+            self.payload = ujson.loads(self.payload)
+        self.delivered = data.get("message_delivered")
+        self.flags = MessageFlags(data.get("message_flags", "").lower().split(","))
+
+
+def rows(count):
+    time = datetime.datetime(2026, 1, 1)
+
+    return [
+        {
+            "message_id": message_id,
+            "gamespace_id": GAMESPACE,
+            "message_uuid": "00000000-0000-0000-0000-{0:012d}".format(message_id),
+            "message_sender": 1000 + message_id % 100,
+            "message_recipient_class": "group",
+            "message_recipient": "clan-1",
+            "message_time": time + datetime.timedelta(seconds=message_id),
+            "message_type": "chat",
+            "message_payload": ujson.dumps({
+                "text": "message number {0}".format(message_id),
+                "attachments": [{"kind": "item", "id": i, "amount": i * 10} for i in range(8)],
+                "meta": {"client": "benchmark", "version": "1.0.0", "locale": "en"}
+            }),
+            "message_delivered": 0,
+            "message_flags": "EDITABLE,DELETABLE"
+        }
+        for message_id in range(1, count + 1)
+    ]
+
+
+def eager(data):
+    messages = list(map(EagerMessageAdapter, data))
+
+    return ujson.dumps([
+        {
+            "uuid": message.message_uuid,
+            "recipient_class": message.recipient_class,
+            "sender": message.sender,
+            "recipient": message.recipient,
+            "gamespace": GAMESPACE,
+            "time": str(message.time),
+            "type": message.message_type,
+            "payload": message.payload
+        }
+        for message in messages
+    ])
+
+
+def lazy(data):
+    messages = list(map(MessageAdapter, data))
+    return dump_messages_json(messages, GAMESPACE)
+
+
+def memory(adapter, data):
+    tracemalloc.start()
+    messages = list(map(adapter, data))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del messages
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    data = rows(args.rows)
+
+    # both produce the same document
+    assert ujson.loads(eager(data)) == ujson.loads(lazy(data))
+
+    for name, serialize, adapter in [("eager", eager, EagerMessageAdapter), ("lazy", lazy, MessageAdapter)]:
+        seconds = min(timeit.repeat(lambda: serialize(data), number=1, repeat=args.repeat))
+        print("{0:>6}: {1:8.2f} ms per {2} rows, adapters take {3:8.2f} KiB".format(
+            name, seconds * 1000, args.rows, memory(adapter, data) / 1024.0))
+
+
+if __name__ == "__main__":
+    main()